@@ -0,0 +1,53 @@
+"""
+Measures the cold start cost of "import pinthesky.resource" in fresh
+interpreters. The "lazy" import is what a Lambda pays before its first
+frame, while "eager" also imports every route module up front the way
+the resource package did before routes were loaded on demand.
+
+python benchmarks/cold_start.py --runs 20
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+SCENARIOS = {
+    'lazy': 'import pinthesky.resource',
+    'eager': 'import pinthesky.resource; pinthesky.resource.load_all_routes()',
+}
+
+
+def measure(statement, runs):
+    script = '\n'.join([
+        'import time',
+        'start = time.perf_counter()',
+        statement,
+        'print(time.perf_counter() - start)',
+    ])
+    env = {'AWS_DEFAULT_REGION': 'us-east-1', **os.environ}
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', script],
+            check=True,
+            capture_output=True,
+            text=True,
+            env=env)
+        timings.append(float(output.stdout.strip().splitlines()[-1]) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark for pinthesky.resource')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+    for name, statement in SCENARIOS.items():
+        timings = measure(statement, args.runs)
+        print(f'{name:>6}: median {statistics.median(timings):8.2f} ms, '
+              f'min {min(timings):8.2f} ms, max {max(timings):8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Compares the frame encodings on the replies that grow the largest: a
+"listSessions" page across a manager's connections, and a "status" with
+its resolved claims. Each encoding reports the frame size, and the time
+to encode and decode one frame through pinthesky.codec. Encodings whose
+library is not installed are skipped.
+
+python benchmarks/encoding.py --sessions 10 100 --iterations 2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from decimal import Decimal
+from throughput import ROOT
+
+
+def list_sessions_reply(sessions):
+    expires_in = Decimal(int(time.time()) + 3600)
+    return {
+        'response': {
+            'action': 'listSessions',
+            'statusCode': 200,
+            'body': {
+                'items': [
+                    {
+                        'invokeId': f'7d9c3a4e-3c1b-4f0a-9a53-{index:012d}',
+                        'connectionId': f'connection-{index % 8}=',
+                        'expiresIn': expires_in,
+                        'camera': f'PitsCamera{index % 4}',
+                        'event': {'name': 'record', 'session': {'start': True, 'stop': False}},
+                    }
+                    for index in range(sessions)
+                ],
+                'nextToken': None,
+                'connectionId': 'connection-0=',
+                'connectionIds': [f'connection-{index}=' for index in range(8)],
+            },
+            'requestId': 'page-1',
+        }
+    }
+
+
+def status_reply():
+    return {
+        'response': {
+            'action': 'status',
+            'statusCode': 200,
+            'body': {
+                'connectionId': 'connection-0=',
+                'manager': True,
+                'authorized': True,
+                'activeSessions': Decimal(3),
+                'activeChildren': Decimal(7),
+                'expiresIn': Decimal(int(time.time()) + 3600),
+                'claims': {
+                    'sub': '98498077-4c1d-4ffb-ab3d-8532dce5db4d',
+                    'email': 'viewer@example.com',
+                    'token_use': 'id',
+                    'auth_time': Decimal(int(time.time())),
+                    'exp': Decimal(int(time.time()) + 3600),
+                    'cognito:groups': ['viewers', 'operators'],
+                },
+            },
+            'requestId': 'status-1',
+        }
+    }
+
+
+def measure(codec, encoding, reply, iterations):
+    data = codec.dumps(reply, encoding)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.dumps(reply, encoding)
+    encode_us = (time.perf_counter() - start) / iterations * 1e6
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.loads(data, encoding)
+    decode_us = (time.perf_counter() - start) / iterations * 1e6
+    return {
+        'bytes': len(data),
+        'encodeUs': encode_us,
+        'decodeUs': decode_us,
+    }
+
+
+def run(sessions, iterations):
+    from pinthesky import codec
+
+    replies = {'status': status_reply()}
+    for count in sessions:
+        replies[f'listSessions[{count}]'] = list_sessions_reply(count)
+    results = {}
+    for name, reply in replies.items():
+        results[name] = {
+            encoding: measure(codec, encoding, reply, iterations)
+            for encoding in codec.ENCODINGS
+            if codec.is_available(encoding)
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Frame encoding benchmark for pinthesky')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    results = run(args.sessions, args.iterations)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, encodings in results.items():
+        baseline = encodings['json']['bytes']
+        print(f'{name}:')
+        for encoding, result in encodings.items():
+            print(f'  {encoding:>8}: {result["bytes"]:7} bytes ({result["bytes"] / baseline:4.0%}), '
+                  f'encode {result["encodeUs"]:8.2f} us, decode {result["decodeUs"]:8.2f} us')
+
+
+if __name__ == '__main__':
+    main()
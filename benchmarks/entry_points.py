@@ -0,0 +1,63 @@
+"""
+Measures the import time and peak memory of each slim entry point in
+fresh interpreters, against the monolithic router with every route
+loaded.
+
+python benchmarks/entry_points.py --runs 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MONOLITH = 'import pinthesky.resource; pinthesky.resource.load_all_routes()'
+
+
+def scenarios():
+    from pinthesky.entry import ENTRY_POINTS
+
+    yield 'monolith', MONOLITH
+    for route_key, module in ENTRY_POINTS.items():
+        yield route_key, f'import pinthesky.entry.{module}'
+
+
+def measure(statement, runs):
+    script = '\n'.join([
+        'import resource',
+        'import time',
+        'start = time.perf_counter()',
+        statement,
+        'elapsed = time.perf_counter() - start',
+        'print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)',
+    ])
+    env = {'AWS_DEFAULT_REGION': 'us-east-1', **os.environ}
+    timings = []
+    memory = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', script],
+            check=True,
+            capture_output=True,
+            text=True,
+            env=env)
+        elapsed, max_rss = output.stdout.strip().splitlines()[-1].split()
+        timings.append(float(elapsed) * 1000)
+        memory.append(int(max_rss) / 1024)
+    return timings, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark for the pinthesky entry points')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+    for name, statement in scenarios():
+        timings, memory = measure(statement, args.runs)
+        print(f'{name:>13}: median {statistics.median(timings):8.2f} ms, '
+              f'max {max(timings):8.2f} ms, peak rss {max(memory):7.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
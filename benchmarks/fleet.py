@@ -0,0 +1,200 @@
+"""
+Simulates a fleet of websocket clients against the api router on the
+local stand-ins, growing the number of managers at each step. Every
+manager opens N session tabs, each tab logs in through its manager and
+invokes "health" and starts a "record" session on each of K cameras,
+the manager lists each tab's sessions, and finally every tab and then
+every manager disconnects.
+
+With --batch, each tab sends its invocations in one "batch" frame
+rather than a frame apiece.
+
+Each step reports throughput, the latency of every routeKey, the
+DynamoDB operations made, the share of writes landing on the hottest
+partition, and the routes ranked by the capacity units each frame
+consumes.
+
+python benchmarks/fleet.py --managers 1 4 16 --tabs 4 --cameras 3 [--batch]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from throughput import ROOT, percentile
+
+
+def fleet_events(managers, tabs, cameras, jwt, batch=False):
+    """
+    Yields (routeKey, event arguments) in the order the fleet sends them.
+    """
+    manager_ids = [f'manager-{m}' for m in range(managers)]
+    tab_ids = {
+        manager_id: [f'{manager_id}-tab-{n}' for n in range(tabs)]
+        for manager_id in manager_ids
+    }
+    claims = {'sub': 'fleet-user', 'token_use': 'id', 'exp': int(time.time()) + 3600}
+    for manager_id in manager_ids:
+        yield '$connect', {
+            'connectionId': manager_id,
+            'headers': {'Sec-WebSocket-Protocol': 'manager'},
+            'authoizer': claims,
+        }
+    for manager_id in manager_ids:
+        for tab_id in tab_ids[manager_id]:
+            yield '$connect', {
+                'connectionId': tab_id,
+                'headers': {'Sec-WebSocket-Protocol': 'session', 'ManagerId': manager_id},
+            }
+            yield 'login', {
+                'connectionId': tab_id,
+                'body': {'payload': {'managerId': manager_id, 'tokenId': f'token-{tab_id}', 'jwtId': jwt}},
+            }
+    for manager_id in manager_ids:
+        for tab_id in tab_ids[manager_id]:
+            invokes = [
+                {'action': 'invoke', 'payload': {'camera': f'camera-{k}', 'event': event}}
+                for k in range(cameras)
+                for event in [{'name': 'health'}, {'name': 'record', 'session': {'start': True}}]
+            ]
+            if batch:
+                yield 'batch', {
+                    'connectionId': tab_id,
+                    'body': {'payload': {'actions': invokes}},
+                }
+            for body in invokes if not batch else []:
+                yield 'invoke', {
+                    'connectionId': tab_id,
+                    'body': body,
+                }
+            yield 'listSessions', {
+                'connectionId': manager_id,
+                'body': {'payload': {'connectionId': tab_id}},
+            }
+    for manager_id in manager_ids:
+        for tab_id in tab_ids[manager_id]:
+            yield '$disconnect', {'connectionId': tab_id}
+        yield '$disconnect', {'connectionId': manager_id}
+
+
+def run_step(ddb, managers, tabs, cameras, jwt, batch=False):
+    """
+    Starts each step from an empty table, as the repositories hold on to
+    the table handle injected when the routes were loaded.
+    """
+    from ophis.globals import app_context
+    from pinthesky import api, metrics
+    from pinthesky.database import DataTokens
+    from pinthesky.local.services import use_local_services
+    from resources import Context, make_event, read_template
+
+    table = app_context.resolve()['table']
+    table.delete()
+    ddb.Table(table.name)
+    management_api, _ = use_local_services()
+    account_id = read_template()['requestContext']['accountId']
+    tokens = DataTokens(table=table)
+    for m in range(managers):
+        for n in range(tabs):
+            tokens.create(account_id, item={
+                'id': f'token-manager-{m}-tab-{n}',
+                'expiresIn': False,
+                'authorization': {'activated': False},
+            })
+    ddb.operations.clear()
+    ddb.partition_reads.clear()
+    ddb.partition_writes.clear()
+    ddb.consumed.clear()
+    metrics.reset_capacity()
+    context = Context(invoked_function_arn=f'arn:aws:lambda:us-east-1:{account_id}:function:Fleet')
+    latencies = defaultdict(list)
+    failures = Counter()
+    start = time.perf_counter()
+    for route_key, kwargs in fleet_events(managers, tabs, cameras, jwt, batch=batch):
+        frame = make_event(f'/{route_key}', routeKey=route_key, **kwargs)
+        frame_start = time.perf_counter()
+        output = api(frame, context)
+        latencies[route_key].append((time.perf_counter() - frame_start) * 1000)
+        if output['statusCode'] >= 400:
+            failures[route_key] += 1
+    elapsed = time.perf_counter() - start
+    for frames in management_api.frames.values():
+        for data in frames:
+            reply = json.loads(data)['response']
+            if reply['statusCode'] >= 400:
+                failures[reply['action']] += 1
+            for response in reply.get('body', {}).get('responses', []) if reply['action'] == 'batch' else []:
+                if response['statusCode'] >= 400:
+                    failures['batch'] += 1
+    events = sum(len(values) for values in latencies.values())
+    writes = sum(ddb.partition_writes.values())
+    hottest, hottest_writes = ddb.partition_writes.most_common(1)[0] if writes > 0 else (None, 0)
+    routes = {}
+    for route_key, values in latencies.items():
+        values.sort()
+        routes[route_key] = {
+            'count': len(values),
+            'failures': failures[route_key],
+            'p50Ms': percentile(values, 0.5),
+            'p99Ms': percentile(values, 0.99),
+            'maxMs': values[-1],
+        }
+    return {
+        'managers': managers,
+        'connections': managers * (tabs + 1),
+        'events': events,
+        'eventsPerSecond': events / elapsed,
+        'routes': routes,
+        'dbOperations': dict(ddb.operations),
+        'hottestPartition': hottest[1] if hottest is not None else None,
+        'hottestPartitionWriteShare': hottest_writes / writes if writes > 0 else 0,
+        'capacity': metrics.capacity_summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated websocket fleet for pinthesky')
+    parser.add_argument('--managers', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--tabs', type=int, default=4)
+    parser.add_argument('--cameras', type=int, default=3)
+    parser.add_argument('--batch', action='store_true', help='Send each tab\'s invocations in one batch frame')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, 'tests'))
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('SERVICE_DOMAIN', 'local')
+    os.environ.setdefault('METRICS_NAMESPACE', '')
+    logging.disable(logging.WARNING)
+
+    from pinthesky.local.database import use_memory_tables
+    from pinthesky.local.identity import LocalIdentity
+    from pinthesky.resource import load_all_routes
+
+    ddb = use_memory_tables()
+    load_all_routes()
+    jwt = LocalIdentity().install().token('fleet-user')
+    results = [run_step(ddb, managers, args.tabs, args.cameras, jwt, batch=args.batch) for managers in args.managers]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f'{result["managers"]} managers, {result["connections"]} connections: '
+              f'{result["events"]} events at {result["eventsPerSecond"]:.1f}/s, '
+              f'hottest partition {result["hottestPartition"]} takes '
+              f'{result["hottestPartitionWriteShare"]:.0%} of writes')
+        for route_key, route in result['routes'].items():
+            print(f'  {route_key:>13}: {route["count"]:6} frames, {route["failures"]} failed, '
+                  f'p50 {route["p50Ms"]:7.3f} ms, p99 {route["p99Ms"]:7.3f} ms, max {route["maxMs"]:7.3f} ms')
+        print(f'  {"dynamodb":>13}: ' + ', '.join(
+            f'{operation} {count}' for operation, count in sorted(result['dbOperations'].items())))
+        for row in result['capacity']:
+            print(f'  {row["routeKey"]:>13}: {row["unitsPerFrame"]:6.2f} units/frame, '
+                  f'{row["readUnits"]:.1f} RCU, {row["writeUnits"]:.1f} WCU')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Cold start benchmark suite, written as JSON so results can be compared
+between commits. Every measurement runs in a fresh interpreter:
+
+- "imports": self and cumulative import time of each pinthesky module,
+  from "python -X importtime" with every route module imported
+- "routes": latency of the first frame each routeKey handles, through
+  tests/resources.Resources against the in-memory tables, and the peak
+  RSS of the interpreter afterwards
+
+boto3 is imported before the first frame so that the management and
+iot-data clients can be replaced with stand-ins, which means the route
+latency covers the route modules but not boto3 itself.
+
+python benchmarks/suite.py --runs 5 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCOUNT_ID = '123456789012'
+CONNECTION_ID = 'benchmark-connection'
+ROUTE_REQUESTS = {
+    '$connect': {
+        'headers': {'Sec-WebSocket-Protocol': 'manager'},
+        'authorizer': {'sub': 'benchmark', 'token_use': 'id', 'exp': 4102444800},
+    },
+    '$disconnect': {},
+    '$default': {},
+    'status': {
+        'body': {},
+    },
+    'invoke': {
+        'body': {'payload': {'camera': 'PitsCamera1', 'event': {'name': 'health'}}},
+    },
+    'listSessions': {
+        'body': {},
+    },
+    'login': {
+        'body': {},
+    },
+    'keepalive': {
+        'body': {},
+    },
+    'batch': {
+        'body': {'payload': {'actions': [{'action': 'status'}, {'action': 'listSessions'}]}},
+    },
+}
+
+
+def environment():
+    return {
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'fake',
+        'AWS_SECRET_ACCESS_KEY': 'fake',
+        'SERVICE_DOMAIN': 'benchmark.local',
+        'LOG_LEVEL': 'WARNING',
+        **os.environ,
+    }
+
+
+IMPORT_ROUTES = """
+import json
+import pinthesky.resource
+modules = list(dict.fromkeys(
+    f'pinthesky.resource.{name}' for names in pinthesky.resource.ROUTES.values() for name in names))
+for module in modules:
+    __import__(module)
+print(json.dumps(modules))
+"""
+
+
+def measure_imports(runs):
+    """
+    The route modules are imported with __import__ rather than through
+    load_all_routes: "-X importtime" does not report modules loaded with
+    importlib.import_module.
+    """
+    samples = {}
+    expected = set()
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', IMPORT_ROUTES],
+            check=True,
+            capture_output=True,
+            text=True,
+            cwd=ROOT,
+            env=environment())
+        for line in output.stderr.splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            name = name.strip()
+            if not name.startswith('pinthesky'):
+                continue
+            sample = samples.setdefault(name, {'self_us': [], 'cumulative_us': []})
+            sample['self_us'].append(int(self_us))
+            sample['cumulative_us'].append(int(cumulative_us))
+        expected.update(json.loads(output.stdout.strip().splitlines()[-1]))
+    missing = sorted(expected - set(samples))
+    if len(missing) > 0:
+        raise RuntimeError(f'Route modules missing from the import times: {", ".join(missing)}')
+    return {
+        name: {
+            'self_us': statistics.median(sample['self_us']),
+            'cumulative_us': statistics.median(sample['cumulative_us']),
+        }
+        for name, sample in sorted(samples.items(), key=lambda pair: -statistics.median(pair[1]['cumulative_us']))
+    }
+
+
+def first_invocation(route_key):
+    """
+    Runs in the child interpreter: seeds the in-memory tables and times
+    the first frame for the routeKey.
+    """
+    import boto3
+    import resource
+    from unittest.mock import MagicMock
+
+    sys.path.insert(0, os.path.join(ROOT, 'tests'))
+    from resources import Resources
+    from pinthesky.database import DataConnections
+    from pinthesky.local.database import use_memory_tables
+    import pinthesky.resource
+
+    boto3.client = MagicMock()
+    table = use_memory_tables().Table(os.getenv('TABLE_NAME', 'Pits'))
+    if route_key != '$connect':
+        DataConnections(table=table).create(ACCOUNT_ID, item={
+            'connectionId': CONNECTION_ID,
+            'authorized': True,
+            'manager': True,
+            'expiresIn': 4102444800,
+        })
+    resources = Resources(pinthesky.resource)
+    start = time.perf_counter()
+    response = resources(routeKey=route_key, connectionId=CONNECTION_ID, **ROUTE_REQUESTS[route_key])
+    elapsed = time.perf_counter() - start
+    return {
+        'first_invocation_ms': elapsed * 1000,
+        'status_code': response.code,
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def measure_routes(runs):
+    results = {}
+    for route_key in ROUTE_REQUESTS:
+        samples = []
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--route', route_key],
+                check=True,
+                capture_output=True,
+                text=True,
+                cwd=ROOT,
+                env=environment())
+            samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        results[route_key] = {
+            'first_invocation_ms': statistics.median(sample['first_invocation_ms'] for sample in samples),
+            'max_first_invocation_ms': max(sample['first_invocation_ms'] for sample in samples),
+            'status_code': samples[-1]['status_code'],
+            'peak_rss_kib': max(sample['peak_rss_kib'] for sample in samples),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark suite for pinthesky')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='Write the JSON results to this file rather than stdout')
+    parser.add_argument('--route', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.route is not None:
+        sys.path.insert(0, ROOT)
+        print(json.dumps(first_invocation(args.route)))
+        return
+    results = {
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'runs': args.runs,
+        'imports': measure_imports(args.runs),
+        'routes': measure_routes(args.runs),
+    }
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
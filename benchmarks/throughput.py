@@ -0,0 +1,132 @@
+"""
+Drives the handlers through the real api router as fast as a single
+thread can, against the in-memory tables and the local management,
+iot-data and identity stand-ins. Events come from the cached factory in
+tests/resources, and only the api call itself is timed. Logging and the
+metric log lines are turned off so they don't dominate the results.
+
+python benchmarks/throughput.py --requests 2000
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTES = ['$connect', 'login', 'invoke', 'listSessions', 'status', '$disconnect']
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def setup(requests):
+    from ophis.globals import app_context
+    from pinthesky.database import DataTokens
+    from pinthesky.local.database import use_memory_tables
+    from pinthesky.local.identity import LocalIdentity
+    from pinthesky.local.services import use_local_services
+    from pinthesky.resource import load_all_routes
+    from resources import make_event, read_template
+
+    ddb = use_memory_tables()
+    management_api, _ = use_local_services()
+    load_all_routes()
+    identity = LocalIdentity().install()
+    account_id = read_template()['requestContext']['accountId']
+    tokens = DataTokens(table=app_context.resolve()['table'])
+    jwt = identity.token('benchmark-user')
+    bodies = {
+        '$connect': lambda index: None,
+        'login': lambda index: {'payload': {'tokenId': f'token-{index}', 'jwtId': jwt}},
+        'invoke': lambda index: {'payload': {'camera': 'PitsCamera1', 'event': {'name': 'health'}}},
+        'listSessions': lambda index: {},
+        'status': lambda index: {},
+        '$disconnect': lambda index: None,
+    }
+    for index in range(requests):
+        tokens.create(account_id, item={
+            'id': f'token-{index}',
+            'expiresIn': False,
+            'authorization': {'activated': False},
+        })
+
+    def event(route_key, index):
+        return make_event(
+            f'/{route_key}',
+            routeKey=route_key,
+            connectionId=f'connection-{index}',
+            headers={'Sec-WebSocket-Protocol': 'manager'},
+            body=bodies[route_key](index))
+
+    return ddb, management_api, event
+
+
+def last_reply(management_api, connection_id):
+    frames = management_api.frames.get(connection_id, None)
+    if not frames:
+        return None
+    return json.loads(frames[-1])['response']
+
+
+def run(requests):
+    from pinthesky import api
+    from resources import Context
+
+    ddb, management_api, event = setup(requests)
+    context = Context(invoked_function_arn='arn:aws:lambda:us-east-1:123456789012:function:Benchmark')
+    results = {}
+    for route_key in ROUTES:
+        latencies = []
+        before = sum(ddb.operations.values())
+        start = time.perf_counter()
+        for index in range(requests):
+            frame = event(route_key, index)
+            frame_start = time.perf_counter()
+            output = api(frame, context)
+            latencies.append((time.perf_counter() - frame_start) * 1000)
+            if output['statusCode'] >= 400:
+                raise RuntimeError(f'{route_key} failed with {output}')
+        elapsed = time.perf_counter() - start
+        reply = last_reply(management_api, f'connection-{requests - 1}')
+        if reply is not None and reply['action'] == route_key and reply['statusCode'] >= 400:
+            raise RuntimeError(f'{route_key} replied with {reply}')
+        latencies.sort()
+        results[route_key] = {
+            'requests': requests,
+            'rps': requests / elapsed,
+            'p50Ms': percentile(latencies, 0.5),
+            'p99Ms': percentile(latencies, 0.99),
+            'p999Ms': percentile(latencies, 0.999),
+            'dbOperationsPerRequest': (sum(ddb.operations.values()) - before) / requests,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Handler throughput benchmark for pinthesky')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, 'tests'))
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('SERVICE_DOMAIN', 'local')
+    os.environ.setdefault('METRICS_NAMESPACE', '')
+    logging.disable(logging.WARNING)
+    results = run(args.requests)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for route_key, result in results.items():
+        print(f'{route_key:>13}: {result["rps"]:9.1f} rps, p50 {result["p50Ms"]:7.3f} ms, '
+              f'p99 {result["p99Ms"]:7.3f} ms, p999 {result["p999Ms"]:7.3f} ms, '
+              f'{result["dbOperationsPerRequest"]:.1f} db ops')
+
+
+if __name__ == '__main__':
+    main()
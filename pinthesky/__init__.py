@@ -1,13 +1,24 @@
 import logging
 import os
 from ophis import set_stream_logger
-from ophis.router import Router
+from pinthesky.metrics import MetricsRouter
+from pinthesky.profiling import ProfilingRouter
 from pinthesky.util import ManagementWrapper
+from pinthesky.warmup import WarmupRouter
 
 
 logging.getLogger('pinthesky').addHandler(logging.NullHandler())
 set_stream_logger('ophis', level=os.getenv('LOG_LEVEL', 'INFO'))
 set_stream_logger('pinthesky', level=os.getenv('LOG_LEVEL', 'INFO'))
 
-api = Router()
+
+class PitsRouter(WarmupRouter, MetricsRouter, ProfilingRouter):
+    """
+    Warmup frames are answered first, every other frame is measured, and
+    a sample of them is profiled when enabled.
+    """
+    pass
+
+
+api = PitsRouter()
 management = ManagementWrapper()
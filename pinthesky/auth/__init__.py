@@ -8,6 +8,8 @@ from requests import get
 
 
 logger = logging.getLogger(__name__)
+known_keys = {}
+public_keys = {}
 
 
 class JWTAuthorizer:
@@ -27,6 +29,28 @@ class JWTAuthorizer:
         payload = res.json()
         return payload['keys']
 
+    def cached_keys(pool_id, region=None):
+        """
+        The pool's keys are fetched once per container and kept for
+        JWKS_TTL seconds, so frames after the first skip the request.
+        """
+        aws_region = os.getenv("AWS_REGION") if region is None else region
+        cache_key = (aws_region, pool_id)
+        cached = known_keys.get(cache_key, None)
+        ttl = float(os.getenv('JWKS_TTL', '3600'))
+        if cached is None or time.monotonic() - cached[0] > ttl:
+            cached = (time.monotonic(), JWTAuthorizer.pull_known_keys(pool_id, region=aws_region))
+            known_keys[cache_key] = cached
+        return cached[1]
+
+    def public_key(key):
+        cache_key = tuple(sorted(key.items()))
+        public_key = public_keys.get(cache_key, None)
+        if public_key is None:
+            public_key = jwk.construct(key)
+            public_keys[cache_key] = public_key
+        return public_key
+
     def generate_policy(principal, effect, resource, context={}):
         return {
             'principalId': principal,
@@ -55,7 +79,7 @@ class JWTAuthorizer:
         if key_index == -1:
             logger.info('Could not find an applicable public key.')
             return None
-        public_key = jwk.construct(self.keys[key_index])
+        public_key = JWTAuthorizer.public_key(self.keys[key_index])
         message, encoded_signature = str(token).rsplit('.', 1)
         decoded_signature = base64url_decode(encoded_signature.encode('utf-8'))
         if not public_key.verify(message.encode('utf-8'), decoded_signature):
@@ -95,7 +119,7 @@ def user_jwt(event, context):
         return JWTAuthorizer.generate_policy(connectionId, 'Allow', event['methodArn'])
     logger.debug(f'Provided token {token}')
     try:
-        keys = JWTAuthorizer.pull_known_keys(os.getenv("USER_POOL_ID"))
+        keys = JWTAuthorizer.cached_keys(os.getenv("USER_POOL_ID"))
         authorizer = JWTAuthorizer(os.getenv("USER_CLIENT_ID"), keys)
         claims = authorizer.authorize(token=token)
         if claims is not None:
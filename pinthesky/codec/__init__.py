@@ -0,0 +1,106 @@
+"""
+Binary frame encodings, negotiated by suffixing the websocket subprotocol
+with the encoding, like "manager+msgpack" or "session+cbor". Frames are
+JSON otherwise. The libraries are optional, installed with the "msgpack"
+and "cbor" extras, and only imported once a frame needs them.
+
+An encoded map starts with a byte that no JSON object starts with in
+either format, so an incoming frame is decoded by its first byte. Frames
+sent to a connection are encoded like the "encoding" negotiated and
+stored on its row, whatever the frame they answer was sent in.
+"""
+import json
+from decimal import Decimal
+from ophis.router import RouterEncoder
+
+
+ENCODINGS = ['json', 'msgpack', 'cbor']
+
+
+def split_protocol(protocol):
+    """
+    Splits "manager+msgpack" into ("manager", "msgpack"), where a protocol
+    without a suffix is ("manager", "json").
+    """
+    role, _, encoding = protocol.strip().partition('+')
+    return role, encoding if encoding != '' else 'json'
+
+
+def library(encoding):
+    if encoding == 'msgpack':
+        import msgpack
+
+        return msgpack
+    import cbor2
+
+    return cbor2
+
+
+def is_available(encoding):
+    if encoding not in ENCODINGS:
+        return False
+    if encoding == 'json':
+        return True
+    try:
+        library(encoding)
+    except ImportError:
+        return False
+    return True
+
+
+def negotiate(offered, roles):
+    """
+    Picks the first protocol in a comma separated Sec-WebSocket-Protocol
+    header with a known role and an installed encoding. Returns
+    (protocol, role, encoding), or None if nothing offered is supported.
+    """
+    for protocol in (offered or '').split(','):
+        role, encoding = split_protocol(protocol)
+        if role in roles and is_available(encoding):
+            return protocol.strip(), role, encoding
+    return None
+
+
+def sniff(data):
+    if isinstance(data, str) or len(data) == 0:
+        return 'json'
+    first = data[0]
+    if 0x80 <= first <= 0x8F or first in [0xDE, 0xDF]:
+        return 'msgpack'
+    if 0xA0 <= first <= 0xBF:
+        return 'cbor'
+    return 'json'
+
+
+def native(value):
+    """
+    Numbers read from DynamoDB are Decimals, which msgpack sends as an
+    integer or a float. CBOR has its own decimal fraction tag.
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+
+def dumps(value, encoding='json'):
+    if encoding == 'msgpack':
+        return library(encoding).packb(value, default=native)
+    if encoding == 'cbor':
+        return library(encoding).dumps(value, default=lambda encoder, value: encoder.encode(native(value)))
+    return json.dumps(value, cls=RouterEncoder).encode('utf-8')
+
+
+def loads(data, encoding=None):
+    """
+    Decodes a frame, with its encoding recognized from the first byte
+    unless one is given.
+    """
+    if encoding is None:
+        encoding = sniff(data)
+    if encoding == 'msgpack':
+        return library(encoding).unpackb(data)
+    if encoding == 'cbor':
+        return library(encoding).loads(data)
+    return json.loads(data)
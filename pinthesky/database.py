@@ -1,4 +1,118 @@
-from ophis.database import Repository
+import json
+import time
+from botocore.exceptions import ClientError
+from decimal import Decimal
+from ophis.database import CON_CHECK_CODE, ConflictException, NotFoundException, Repository
+from ophis.globals import app_context
+
+
+TRANSACTION_CANCELED = 'TransactionCanceledException'
+TRANSACTION_LIMIT = 100
+
+
+class TransactionConflictException(ConflictException):
+    """
+    Raised when a transaction is canceled. The reasons line up with the
+    submitted updates, such as "None" or "ConditionalCheckFailed".
+    """
+    def __init__(self, reasons, *args: object) -> None:
+        super().__init__(*args)
+        self.reasons = reasons
+
+
+def transact_write(*args, updates, ddb=None, table=None):
+    """
+    The transactional counterpart to Repository.batch_write. Updates take
+    the same "repository", "item" and "parent_ids" fields, and can also set:
+
+    - "condition": a dict with "expression", and optional "names" and "values"
+    - "update": set the item fields onto an existing item rather than put it
+    - "add": with "update", a dict of counters to add to, like increment
+    - "delete": remove the item
+
+    Either every update is applied or none are, in a single round trip.
+    """
+    if table is None:
+        table = app_context.resolve('GLOBAL')['table']
+    if ddb is None:
+        ddb = app_context.resolve('GLOBAL')['dynamodb']
+    transact_items = []
+    for update in updates:
+        keys = list(args) + update.get('parent_ids', [])
+        repository = update['repository']
+        operation = {'TableName': table.name}
+        names = {}
+        values = {}
+        if update.get('update', False):
+            dto = repository.make_dto(*keys, item=update['item'], time_fields=['update'])
+            expression = []
+            for key, value in dto.items():
+                if key in ['PK', 'SK'] or key in repository.fields_to_keys:
+                    continue
+                names[f'#{key}'] = key
+                values[f':{key}'] = value
+                expression.append(f'#{key} = :{key}')
+            operation['Key'] = {'PK': dto['PK'], 'SK': dto['SK']}
+            operation['UpdateExpression'] = f'SET {", ".join(expression)}'
+            counters = update.get('add', {})
+            for field, amount in counters.items():
+                names[f'#{field}'] = field
+                values[f':{field}'] = amount
+            if len(counters) > 0:
+                operation['UpdateExpression'] += f' ADD {", ".join(f"#{field} :{field}" for field in counters)}'
+            action = 'Update'
+        elif update.get('delete', False):
+            dto = repository.make_dto(*keys, item=update['item'], time_fields=[])
+            operation['Key'] = {'PK': dto['PK'], 'SK': dto['SK']}
+            action = 'Delete'
+        else:
+            dto = repository.make_dto(*keys, item=update['item'])
+            operation['Item'] = dto
+            action = 'Put'
+        if 'condition' in update:
+            operation['ConditionExpression'] = update['condition']['expression']
+            names.update(update['condition'].get('names', {}))
+            values.update(update['condition'].get('values', {}))
+        if len(names) > 0:
+            operation['ExpressionAttributeNames'] = names
+        if len(values) > 0:
+            operation['ExpressionAttributeValues'] = values
+        transact_items.append({action: operation})
+    try:
+        ddb.meta.client.transact_write_items(TransactItems=transact_items)
+    except ClientError as e:
+        if e.response['Error']['Code'] == TRANSACTION_CANCELED:
+            reasons = [
+                reason.get('Code', 'None')
+                for reason in e.response.get('CancellationReasons', [])
+            ]
+            raise TransactionConflictException(
+                reasons,
+                f'The transaction was canceled: {", ".join(reasons)}')
+        raise e
+
+
+def extend_expiry(repository, *args, item_id, expires_in):
+    """
+    Moves "expiresIn" out to expires_in, and never earlier. Returns
+    False if the row is gone or already expires later.
+    """
+    try:
+        repository.table.update_item(
+            Key={
+                'PK': repository.make_hash_key(*args),
+                'SK': item_id,
+            },
+            ConditionExpression='attribute_exists(PK) AND (attribute_not_exists(#expiresIn) OR #expiresIn < :expiresIn)',
+            UpdateExpression='SET #expiresIn = :expiresIn',
+            ExpressionAttributeNames={'#expiresIn': 'expiresIn'},
+            ExpressionAttributeValues={':expiresIn': expires_in},
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == CON_CHECK_CODE:
+            return False
+        raise e
 
 
 class DataConnections(Repository):
@@ -7,6 +121,38 @@ class DataConnections(Repository):
             'connectionId': 'SK',
         })
 
+    def increment(self, *args, item_id, counters):
+        """
+        Atomically adds to the counters on an existing connection row, like
+        "activeChildren" or "activeSessions". Returns the updated counters,
+        or None if the connection no longer exists.
+        """
+        names = {}
+        values = {}
+        for field, amount in counters.items():
+            names[f'#{field}'] = field
+            values[f':{field}'] = amount
+        try:
+            response = self.table.update_item(
+                Key={
+                    'PK': self.make_hash_key(*args),
+                    'SK': item_id,
+                },
+                ConditionExpression='attribute_exists(PK)',
+                UpdateExpression=f'ADD {", ".join(f"#{field} :{field}" for field in counters)}',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues='UPDATED_NEW',
+            )
+            return self.prune_dto(response['Attributes'])
+        except ClientError as e:
+            if e.response['Error']['Code'] == CON_CHECK_CODE:
+                return None
+            raise e
+
+    def extend(self, *args, item_id, expires_in):
+        return extend_expiry(self, *args, item_id=item_id, expires_in=expires_in)
+
 
 class DataSessions(Repository):
     def __init__(self, table=None) -> None:
@@ -14,9 +160,342 @@ class DataSessions(Repository):
             'invokeId': 'SK',
         })
 
+    def remove(self, *args, item_id):
+        """
+        Deletes the session, returning it if it existed so that callers
+        only adjust counters for sessions that were actually removed.
+        """
+        response = self.table.delete_item(
+            Key={
+                'PK': self.make_hash_key(*args),
+                'SK': item_id,
+            },
+            ReturnValues='ALL_OLD',
+        )
+        return self.prune_dto(response.get('Attributes', None))
+
+    def extend(self, *args, item_ids, expires_in, attempts=3, ddb=None):
+        """
+        Sets "expiresIn" on existing sessions, with one transaction of
+        conditional updates per TRANSACTION_LIMIT sessions. Sessions removed
+        in the meantime fail their condition, and the rest of the chunk is
+        retried without them. Returns the ids that were extended.
+        """
+        extended = []
+        for start in range(0, len(item_ids), TRANSACTION_LIMIT):
+            chunk = list(item_ids[start:start + TRANSACTION_LIMIT])
+            attempt = 1
+            while len(chunk) > 0:
+                try:
+                    transact_write(*args, ddb=ddb, table=self.table, updates=[
+                        {
+                            'repository': self,
+                            'update': True,
+                            'item': {
+                                'invokeId': item_id,
+                                'expiresIn': expires_in,
+                            },
+                            'condition': {
+                                'expression': 'attribute_exists(PK)',
+                            },
+                        }
+                        for item_id in chunk
+                    ])
+                    extended.extend(chunk)
+                    break
+                except TransactionConflictException as e:
+                    removed = [
+                        item_id for item_id, reason in zip(chunk, e.reasons)
+                        if reason == 'ConditionalCheckFailed'
+                    ]
+                    if len(removed) == 0 and attempt >= attempts:
+                        raise e
+                    attempt += 1
+                    chunk = [item_id for item_id in chunk if item_id not in removed]
+        return extended
+
+
+class DataDeviceSessions(Repository):
+    """
+    A session on the device shared by every viewer of the same camera and
+    event name. The "viewers" string set holds the viewers' invokeIds, and
+    the record lives for as long as the set is not empty.
+    """
+    def __init__(self, table=None) -> None:
+        super().__init__(table=table, type="DataDeviceSessions", fields_to_keys={
+            'name': 'SK',
+        })
+
+    def attach(self, *args, item_id, viewer, invoke_id, expires_in=None):
+        """
+        Adds the viewer, creating the record with "invoke_id" when there is
+        none. The returned record keeps the invokeId of whoever created it,
+        so the caller created it if the invokeIds match. The record keeps
+        the latest "expiresIn" of its viewers.
+        """
+        names = {'#invokeId': 'invokeId', '#viewers': 'viewers', '#updateTime': 'updateTime'}
+        values = {':invokeId': invoke_id, ':viewer': {viewer}, ':now': int(time.time())}
+        expression = 'SET #invokeId = if_not_exists(#invokeId, :invokeId), #updateTime = :now'
+        if expires_in is not None:
+            names['#expiresIn'] = 'expiresIn'
+            values[':expiresIn'] = expires_in
+            expression += ', #expiresIn = if_not_exists(#expiresIn, :expiresIn)'
+        response = self.table.update_item(
+            Key={
+                'PK': self.make_hash_key(*args),
+                'SK': item_id,
+            },
+            UpdateExpression=f'{expression} ADD #viewers :viewer',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW',
+        )
+        device = self.prune_dto(response['Attributes'])
+        if expires_in is not None and int(device.get('expiresIn', 0)) < int(expires_in):
+            if self.extend(*args, item_id=item_id, expires_in=expires_in):
+                device['expiresIn'] = int(expires_in)
+        return device
+
+    def extend(self, *args, item_id, expires_in):
+        return extend_expiry(self, *args, item_id=item_id, expires_in=expires_in)
+
+    def detach(self, *args, item_id, viewer):
+        """
+        Removes the viewer, and the record too when it was the last one.
+        Returns the removed record, or None while other viewers remain.
+        A viewer attaching in between keeps the record alive.
+        """
+        key = {
+            'PK': self.make_hash_key(*args),
+            'SK': item_id,
+        }
+        try:
+            response = self.table.update_item(
+                Key=key,
+                ConditionExpression='attribute_exists(PK)',
+                UpdateExpression='DELETE #viewers :viewer',
+                ExpressionAttributeNames={'#viewers': 'viewers'},
+                ExpressionAttributeValues={':viewer': {viewer}},
+                ReturnValues='ALL_NEW',
+            )
+            if len(response['Attributes'].get('viewers', [])) > 0:
+                return None
+            response = self.table.delete_item(
+                Key=key,
+                ConditionExpression='attribute_exists(PK) AND attribute_not_exists(#viewers)',
+                ExpressionAttributeNames={'#viewers': 'viewers'},
+                ReturnValues='ALL_OLD',
+            )
+            return self.prune_dto(response.get('Attributes', None))
+        except ClientError as e:
+            if e.response['Error']['Code'] == CON_CHECK_CODE:
+                return None
+            raise e
+
+
+class DataRequests(Repository):
+    """
+    Remembers what a client "requestId" was answered with for a short
+    window, so that a retried frame gets the same answer without doing
+    the work twice.
+    """
+    def __init__(self, table=None) -> None:
+        super().__init__(table=table, type="DataRequests", fields_to_keys={
+            'requestId': 'SK',
+        })
+
+    def claim(self, *args, item_id, item, ttl):
+        """
+        Stores the item for "ttl" seconds unless an unexpired one holds the
+        requestId already. Returns None when claimed, or the held item.
+        """
+        now = int(time.time())
+        dto = self.make_dto(*args, item={**item, 'requestId': item_id, 'expiresIn': now + ttl})
+        try:
+            self.table.put_item(
+                Item=dto,
+                ConditionExpression='attribute_not_exists(PK) OR expiresIn < :now',
+                ExpressionAttributeValues={':now': now},
+            )
+            return None
+        except ClientError as e:
+            if e.response['Error']['Code'] != CON_CHECK_CODE:
+                raise e
+        response = self.table.get_item(
+            Key={
+                'PK': dto['PK'],
+                'SK': item_id,
+            },
+            ConsistentRead=True,
+        )
+        held = self.prune_dto(response.get('Item', None))
+        if held is not None and 'body' in held:
+            held['body'] = json.loads(held['body'])
+        return held if held is not None else {'requestId': item_id}
+
+    def answer(self, *args, item_id, body):
+        """
+        Keeps the reply body on a claimed requestId, for retries to be sent
+        the same reply. The body is kept as JSON, so numbers are not read
+        back as Decimal. Returns False if the claim is gone.
+        """
+        try:
+            self.update(*args, item={'requestId': item_id, 'body': json.dumps(body)})
+            return True
+        except NotFoundException:
+            return False
+
+
+class DataBuckets(Repository):
+    """
+    Token buckets shared between containers. Taking a token reads the
+    bucket and writes it back on the condition that nobody refilled it
+    in between, retrying a few times under contention.
+    """
+    def __init__(self, table=None) -> None:
+        super().__init__(table=table, type="DataBuckets", fields_to_keys={
+            'id': 'SK',
+        })
+
+    def take(self, *args, item_id, capacity, rate, amount=1, attempts=3):
+        key = {
+            'PK': self.make_hash_key(*args),
+            'SK': item_id,
+        }
+        for _ in range(attempts):
+            now = time.time()
+            item = self.table.get_item(Key=key, ConsistentRead=True).get('Item', None)
+            tokens = capacity
+            if item is not None:
+                tokens = min(capacity, float(item['tokens']) + (now - float(item['refilled'])) * rate)
+            if tokens < amount:
+                return False
+            values = {
+                ':tokens': Decimal(str(round(tokens - amount, 6))),
+                ':refilled': Decimal(str(round(now, 6))),
+                ':expiresIn': int(now + (capacity / rate if rate > 0 else 86400)) + 60,
+            }
+            condition = 'attribute_not_exists(PK)'
+            if item is not None:
+                condition = 'refilled = :previous'
+                values[':previous'] = item['refilled']
+            try:
+                self.table.update_item(
+                    Key=key,
+                    ConditionExpression=condition,
+                    UpdateExpression='SET tokens = :tokens, refilled = :refilled, expiresIn = :expiresIn',
+                    ExpressionAttributeValues=values,
+                )
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] != CON_CHECK_CODE:
+                    raise e
+        return False
+
 
 class DataTokens(Repository):
     def __init__(self, table=None) -> None:
         super().__init__(table=table, type="DataTokens", fields_to_keys={
             'id': 'SK',
         })
+
+
+class DataClaims(Repository):
+    """
+    Authorizer claims are stored once per subject and token expiry.
+    Connection rows only hold the "claimsId" reference, which is
+    resolved through a cache that lives as long as the container.
+    """
+    def __init__(self, table=None, max_cached=1000) -> None:
+        super().__init__(table=table, type="DataClaims", fields_to_keys={
+            'id': 'SK',
+        })
+        self.max_cached = max_cached
+        self.cache = {}
+
+    @staticmethod
+    def claims_id(claims):
+        if claims is None or 'sub' not in claims:
+            return None
+        return f'{claims["sub"]}:{claims.get("exp", 0)}'
+
+    @staticmethod
+    def from_item(value):
+        """
+        Numbers are read back as Decimal, at any depth, and are converted
+        to int, or to float when they have a fraction, so that resolved
+        claims equal the stored ones.
+        """
+        if type(value) is Decimal:
+            return int(value) if value % 1 == 0 else float(value)
+        if isinstance(value, dict):
+            return {key: DataClaims.from_item(nested) for key, nested in value.items()}
+        if isinstance(value, list):
+            return [DataClaims.from_item(nested) for nested in value]
+        return value
+
+    @staticmethod
+    def to_item(value):
+        """
+        Claims can carry floats, like a fractional "auth_time", which are
+        only stored as Decimal.
+        """
+        if isinstance(value, float):
+            return Decimal(str(value))
+        if isinstance(value, dict):
+            return {key: DataClaims.to_item(nested) for key, nested in value.items()}
+        if isinstance(value, list):
+            return [DataClaims.to_item(nested) for nested in value]
+        return value
+
+    def make_item(self, claims):
+        item = {
+            'id': DataClaims.claims_id(claims),
+            'claims': DataClaims.to_item(claims),
+        }
+        if 'exp' in claims:
+            item['expiresIn'] = claims['exp']
+        return item
+
+    def is_cached(self, account_id, claims_id):
+        return (account_id, claims_id) in self.cache
+
+    def remember(self, account_id, claims, claims_id=None):
+        if claims_id is None:
+            claims_id = DataClaims.claims_id(claims)
+        if len(self.cache) >= self.max_cached:
+            now = time.time()
+            for key, value in list(self.cache.items()):
+                if now > int(value.get('exp', now)):
+                    del self.cache[key]
+            while len(self.cache) >= self.max_cached:
+                del self.cache[next(iter(self.cache))]
+        self.cache[(account_id, claims_id)] = claims
+        return claims_id
+
+    def store(self, account_id, claims):
+        """
+        Stores the claims unless this container has already seen them,
+        returning the reference to place on connection rows.
+        """
+        claims_id = DataClaims.claims_id(claims)
+        if claims_id is None:
+            return None
+        if not self.is_cached(account_id, claims_id):
+            try:
+                self.create(account_id, item=self.make_item(claims))
+            except ConflictException:
+                pass
+            self.remember(account_id, claims)
+        return claims_id
+
+    def resolve(self, account_id, claims_id):
+        if claims_id is None:
+            return None
+        if not self.is_cached(account_id, claims_id):
+            item = self.get(account_id, item_id=claims_id)
+            if item is None:
+                return None
+            claims = DataClaims.from_item(item['claims'])
+            self.remember(account_id, claims, claims_id=claims_id)
+        return self.cache[(account_id, claims_id)]
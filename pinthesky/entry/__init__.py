@@ -0,0 +1,34 @@
+"""
+Slim Lambda entry points, one module per routeKey. Each module only
+imports the route modules its handler needs, so a function deployed for
+a single route never pays for the others. Point the function handler
+at the module's router, for example "pinthesky.entry.invoke.api".
+"""
+from pinthesky.resource import ROUTES, load_route
+
+
+ENTRY_POINTS = {
+    '$connect': 'connect',
+    '$disconnect': 'disconnect',
+    '$default': 'default',
+    'status': 'status',
+    'invoke': 'invoke',
+    'listSessions': 'list_sessions',
+    'login': 'login',
+    'keepalive': 'keepalive',
+    'batch': 'batch',
+}
+
+
+def entry_point(route_key):
+    """
+    Loads the handler for the routeKey up front, rather than on the first
+    frame, and returns the router to use as the function handler.
+    """
+    from pinthesky import api
+
+    if route_key != '$default' and route_key not in ROUTES:
+        raise ValueError(f'There is no route for {route_key}')
+    load_route(route_key)
+    api.route_keys = [route_key]
+    return api
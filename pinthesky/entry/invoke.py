@@ -0,0 +1,4 @@
+from pinthesky.entry import entry_point
+
+
+api = entry_point('invoke')
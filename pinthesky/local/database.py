@@ -0,0 +1,917 @@
+import copy
+import math
+import os
+import re
+import threading
+import time
+from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+from botocore.exceptions import ClientError
+from collections import Counter
+from decimal import Decimal
+from ophis.globals import app_context
+from pinthesky.metrics import record_capacity
+
+
+MISSING = object()
+TOKENS = re.compile(r'\s*(?:(<>|<=|>=|[=<>(),.\[\]+\-])|([#:]?[A-Za-z_][A-Za-z0-9_]*)|(\d+))')
+KEYWORDS = ['AND', 'OR', 'NOT', 'BETWEEN', 'IN', 'SET', 'REMOVE', 'ADD', 'DELETE']
+READ_UNIT_BYTES = 4096
+WRITE_UNIT_BYTES = 1024
+
+
+def client_error(code, message, operation, **extra):
+    return ClientError({'Error': {'Code': code, 'Message': message}, **extra}, operation)
+
+
+def to_dynamo(value):
+    """
+    Converts Python values the way the boto3 resource does before they are
+    stored, so reads return Decimal numbers just like a real table.
+    """
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, dict):
+        return {k: to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamo(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return set(to_dynamo(v) for v in value)
+    return value
+
+
+def dynamo_type(value):
+    if isinstance(value, bool):
+        return 'BOOL'
+    if value is None:
+        return 'NULL'
+    if isinstance(value, Decimal):
+        return 'N'
+    if isinstance(value, str):
+        return 'S'
+    if isinstance(value, bytes):
+        return 'B'
+    if isinstance(value, dict):
+        return 'M'
+    if isinstance(value, list):
+        return 'L'
+    if isinstance(value, set):
+        return 'NS' if all(isinstance(v, Decimal) for v in value) else 'SS'
+    return type(value).__name__
+
+
+def item_size(value):
+    """
+    Approximates the size DynamoDB bills for a stored value: the UTF-8
+    length of strings and attribute names, about a byte per two digits of
+    a number, and a few bytes of overhead per list or map element.
+    """
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, Decimal):
+        digits = len(value.as_tuple().digits)
+        return (digits + 1) // 2 + 1
+    if isinstance(value, dict):
+        return 3 + sum(1 + len(key.encode('utf-8')) + item_size(v) for key, v in value.items())
+    if isinstance(value, list):
+        return 3 + sum(1 + item_size(v) for v in value)
+    if isinstance(value, set):
+        return sum(item_size(v) for v in value)
+    return len(str(value))
+
+
+def read_units(size, consistent=False):
+    units = math.ceil(max(size, 1) / READ_UNIT_BYTES)
+    return float(units) if consistent else units / 2
+
+
+def write_units(size):
+    return float(math.ceil(max(size, 1) / WRITE_UNIT_BYTES))
+
+
+class Expression:
+    """
+    A small recursive descent parser for the condition, key condition and
+    update expressions used against the table.
+    """
+    def __init__(self, expression, names=None, values=None) -> None:
+        self.tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = TOKENS.match(expression, position)
+            if match is None or match.end() == position:
+                raise client_error(
+                    'ValidationException',
+                    f'Invalid expression: {expression}',
+                    'Expression')
+            self.tokens.append(match.group(0).strip())
+            position = match.end()
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self, offset=0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def keyword(self, offset=0):
+        token = self.peek(offset)
+        return token.upper() if token is not None and token.upper() in KEYWORDS else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise client_error(
+                'ValidationException',
+                f'Invalid expression: expected {expected} but found {token}',
+                'Expression')
+        self.position += 1
+        return token
+
+    def done(self):
+        return self.position >= len(self.tokens)
+
+    def name(self, token):
+        if token.startswith('#'):
+            return self.names[token]
+        return token
+
+    def path(self):
+        segments = [self.name(self.take())]
+        while self.peek() in ['.', '[']:
+            if self.take() == '.':
+                segments.append(self.name(self.take()))
+            else:
+                segments.append(int(self.take()))
+                self.take(']')
+        return ('path', segments)
+
+    def operand(self):
+        token = self.peek()
+        if token.startswith(':'):
+            self.take()
+            return ('value', to_dynamo(self.values[token]))
+        if self.peek(1) == '(' and not token.startswith('#'):
+            function = self.take()
+            self.take('(')
+            arguments = [self.operand()]
+            while self.peek() == ',':
+                self.take(',')
+                arguments.append(self.operand())
+            self.take(')')
+            return ('function', function, arguments)
+        return self.path()
+
+    def condition(self):
+        node = self.conjunction()
+        while self.keyword() == 'OR':
+            self.take()
+            node = ('or', node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.keyword() == 'AND':
+            self.take()
+            node = ('and', node, self.negation())
+        return node
+
+    def negation(self):
+        if self.keyword() == 'NOT':
+            self.take()
+            return ('not', self.negation())
+        if self.peek() == '(':
+            self.take('(')
+            node = self.condition()
+            self.take(')')
+            return node
+        left = self.operand()
+        if self.keyword() == 'BETWEEN':
+            self.take()
+            low = self.operand()
+            self.take('AND')
+            return ('between', left, low, self.operand())
+        if self.keyword() == 'IN':
+            self.take()
+            self.take('(')
+            options = [self.operand()]
+            while self.peek() == ',':
+                self.take(',')
+                options.append(self.operand())
+            self.take(')')
+            return ('in', left, options)
+        if self.peek() in ['=', '<>', '<', '<=', '>', '>=']:
+            return ('compare', self.take(), left, self.operand())
+        return left
+
+    def updates(self):
+        actions = []
+        while not self.done():
+            clause = self.take().upper()
+            while True:
+                if clause == 'SET':
+                    target = self.path()
+                    self.take('=')
+                    value = self.operand()
+                    if self.peek() in ['+', '-']:
+                        value = ('arithmetic', self.take(), value, self.operand())
+                    actions.append(('set', target, value))
+                elif clause == 'REMOVE':
+                    actions.append(('remove', self.path()))
+                elif clause in ['ADD', 'DELETE']:
+                    actions.append((clause.lower(), self.path(), self.operand()))
+                else:
+                    raise client_error(
+                        'ValidationException',
+                        f'Invalid update clause: {clause}',
+                        'UpdateExpression')
+                if self.peek() != ',':
+                    break
+                self.take(',')
+        return actions
+
+
+def resolve_path(item, segments):
+    value = item
+    for segment in segments:
+        if isinstance(segment, int):
+            if not isinstance(value, list) or segment >= len(value):
+                return MISSING
+            value = value[segment]
+        else:
+            if not isinstance(value, dict) or segment not in value:
+                return MISSING
+            value = value[segment]
+    return value
+
+
+def assign_path(item, segments, value):
+    parent = resolve_path(item, segments[:-1])
+    if parent is MISSING:
+        raise client_error(
+            'ValidationException',
+            'The document path provided in the update expression is invalid for update',
+            'UpdateItem')
+    if value is MISSING:
+        if isinstance(parent, dict):
+            parent.pop(segments[-1], None)
+        elif isinstance(parent, list) and segments[-1] < len(parent):
+            parent.pop(segments[-1])
+    elif isinstance(parent, list) and segments[-1] >= len(parent):
+        parent.append(value)
+    else:
+        parent[segments[-1]] = value
+
+
+def evaluate(node, item):
+    kind = node[0]
+    if kind == 'value':
+        return node[1]
+    if kind == 'path':
+        return resolve_path(item, node[1])
+    if kind == 'arithmetic':
+        left = evaluate(node[2], item)
+        right = evaluate(node[3], item)
+        if not isinstance(left, Decimal) or not isinstance(right, Decimal):
+            raise client_error(
+                'ValidationException',
+                'An operand in the update expression has an incorrect data type',
+                'UpdateItem')
+        return left + right if node[1] == '+' else left - right
+    if kind == 'function':
+        return call(node[1], node[2], item)
+    if kind == 'and':
+        return evaluate(node[1], item) and evaluate(node[2], item)
+    if kind == 'or':
+        return evaluate(node[1], item) or evaluate(node[2], item)
+    if kind == 'not':
+        return not evaluate(node[1], item)
+    if kind == 'between':
+        value, low, high = [evaluate(n, item) for n in node[1:]]
+        return compare('>=', value, low) and compare('<=', value, high)
+    if kind == 'in':
+        value = evaluate(node[1], item)
+        return any(compare('=', value, evaluate(option, item)) for option in node[2])
+    if kind == 'compare':
+        return compare(node[1], evaluate(node[2], item), evaluate(node[3], item))
+    raise client_error('ValidationException', f'Unsupported expression {kind}', 'Expression')
+
+
+def compare(operator, left, right):
+    if left is MISSING or right is MISSING:
+        return operator == '<>'
+    if dynamo_type(left) != dynamo_type(right):
+        return operator == '<>'
+    if operator == '=':
+        return left == right
+    if operator == '<>':
+        return left != right
+    if dynamo_type(left) not in ['N', 'S', 'B']:
+        return False
+    if operator == '<':
+        return left < right
+    if operator == '<=':
+        return left <= right
+    if operator == '>':
+        return left > right
+    return left >= right
+
+
+def call(function, arguments, item):
+    values = [evaluate(argument, item) for argument in arguments]
+    if function == 'attribute_exists':
+        return values[0] is not MISSING
+    if function == 'attribute_not_exists':
+        return values[0] is MISSING
+    if function == 'attribute_type':
+        return values[0] is not MISSING and dynamo_type(values[0]) == values[1]
+    if function == 'begins_with':
+        return isinstance(values[0], (str, bytes)) and values[0].startswith(values[1])
+    if function == 'contains':
+        if isinstance(values[0], str):
+            return isinstance(values[1], str) and values[1] in values[0]
+        return isinstance(values[0], (set, list)) and values[1] in values[0]
+    if function == 'size':
+        return Decimal(len(values[0])) if values[0] is not MISSING else MISSING
+    if function == 'if_not_exists':
+        return values[1] if values[0] is MISSING else values[0]
+    if function == 'list_append':
+        return list(values[0]) + list(values[1])
+    raise client_error('ValidationException', f'Unsupported function {function}', 'Expression')
+
+
+class TableState:
+    def __init__(self, name, hash_key, range_key=None, indexes=None) -> None:
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.indexes = indexes or {}
+        self.partitions = {}
+        self.ttl_attribute = None
+
+
+class BatchWriter:
+    def __init__(self, table) -> None:
+        self.table = table
+        self.operations = []
+
+    def put_item(self, Item):
+        self.operations.append(('put', Item))
+
+    def delete_item(self, Key):
+        self.operations.append(('delete', Key))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.table.resource.batch_write(self.table.name, self.operations)
+        self.operations = []
+
+
+class MemoryTable:
+    """
+    A handle to a table held in a MemoryDynamoDB, mirroring the subset
+    of the boto3 Table resource used by the repositories.
+    """
+    def __init__(self, resource, name) -> None:
+        self.resource = resource
+        self.name = name
+        self.table_name = name
+
+    def wait_until_exists(self):
+        self.resource.state(self.name)
+
+    def delete(self):
+        self.resource.delete_table(self.name)
+
+    def update_time_to_live(self, TimeToLiveSpecification):
+        state = self.resource.state(self.name)
+        enabled = TimeToLiveSpecification.get('Enabled', False)
+        state.ttl_attribute = TimeToLiveSpecification['AttributeName'] if enabled else None
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return BatchWriter(self)
+
+    def get_item(self, Key, **kwargs):
+        return self.resource.get_item(self.name, Key, **kwargs)
+
+    def put_item(self, Item, **kwargs):
+        return self.resource.put_item(self.name, Item, **kwargs)
+
+    def update_item(self, Key, **kwargs):
+        return self.resource.update_item(self.name, Key, **kwargs)
+
+    def delete_item(self, Key, **kwargs):
+        return self.resource.delete_item(self.name, Key, **kwargs)
+
+    def query(self, **kwargs):
+        return self.resource.query(self.name, **kwargs)
+
+
+class MemoryClient:
+    def __init__(self, resource) -> None:
+        self.resource = resource
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        return self.resource.transact_write_items(TransactItems, **kwargs)
+
+
+class Meta:
+    def __init__(self, client) -> None:
+        self.client = client
+
+
+class MemoryDynamoDB:
+    """
+    An in-memory stand-in for the boto3 DynamoDB resource. It supports
+    get, put, update, delete, query with pagination, batch read and write,
+    transactions, and TTL, which is everything the repositories rely on.
+    Inject it through app_context to run handlers without a database:
+
+    ddb = MemoryDynamoDB()
+    app_context.inject('dynamodb', ddb)
+    app_context.inject('table', ddb.Table('Pits'))
+
+    Besides counting "operations", item reads and writes are counted per
+    (table, partition key) in "partition_reads" and "partition_writes",
+    to spot hot partitions.
+
+    Every call estimates its consumed capacity from the item sizes, as if
+    ReturnConsumedCapacity were always requested, and records it on the
+    current frame's metrics. The units are totalled per (table, "read" or
+    "write") in "consumed", and returned as "ConsumedCapacity" when asked.
+    Only the base table is billed, not its indexes.
+    """
+    def __init__(self) -> None:
+        self.tables = {}
+        self.lock = threading.RLock()
+        self.operations = Counter()
+        self.partition_reads = Counter()
+        self.partition_writes = Counter()
+        self.consumed = Counter()
+        self.meta = Meta(MemoryClient(self))
+        self.builder = ConditionExpressionBuilder()
+
+    def create_table(self, TableName, KeySchema, GlobalSecondaryIndexes=[], **kwargs):
+        with self.lock:
+            if TableName in self.tables:
+                raise client_error(
+                    'ResourceInUseException',
+                    f'Table already exists: {TableName}',
+                    'CreateTable')
+            schema = {key['KeyType']: key['AttributeName'] for key in KeySchema}
+            indexes = {}
+            for index in GlobalSecondaryIndexes:
+                index_schema = {key['KeyType']: key['AttributeName'] for key in index['KeySchema']}
+                indexes[index['IndexName']] = (index_schema['HASH'], index_schema.get('RANGE'))
+            self.tables[TableName] = TableState(
+                TableName,
+                schema['HASH'],
+                schema.get('RANGE'),
+                indexes)
+        return MemoryTable(self, TableName)
+
+    def Table(self, name):
+        """
+        Returns a handle for the table, creating it with the PK, SK and GS1
+        index layout when it does not exist yet.
+        """
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = TableState(name, 'PK', 'SK', {
+                    'GS1': ('GS1-PK', 'createTime'),
+                })
+                self.tables[name].ttl_attribute = 'expiresIn'
+        return MemoryTable(self, name)
+
+    def delete_table(self, name):
+        with self.lock:
+            self.state(name)
+            del self.tables[name]
+
+    def state(self, name):
+        if name not in self.tables:
+            raise client_error(
+                'ResourceNotFoundException',
+                f'Requested resource not found: {name}',
+                'DescribeTable')
+        return self.tables[name]
+
+    def key_of(self, state, key):
+        if state.hash_key not in key or (state.range_key is not None and state.range_key not in key):
+            raise client_error(
+                'ValidationException',
+                'The provided key element does not match the schema',
+                'GetItem')
+        return key[state.hash_key], key.get(state.range_key)
+
+    def expired(self, state, item):
+        if state.ttl_attribute is None:
+            return False
+        value = item.get(state.ttl_attribute)
+        return isinstance(value, Decimal) and value < Decimal(time.time())
+
+    def lookup(self, state, hash_value, range_value):
+        partition = state.partitions.get(hash_value, {})
+        item = partition.get(range_value)
+        if item is not None and self.expired(state, item):
+            del partition[range_value]
+            item = None
+        return item
+
+    def store(self, state, item):
+        """
+        Stores the item, returning the write units billed for the larger of
+        the old and new item.
+        """
+        hash_value, range_value = self.key_of(state, item)
+        self.partition_writes[(state.name, hash_value)] += 1
+        partition = state.partitions.setdefault(hash_value, {})
+        existing = partition.get(range_value)
+        partition[range_value] = item
+        return write_units(max(item_size(item), item_size(existing) if existing is not None else 0))
+
+    def remove(self, state, hash_value, range_value):
+        self.partition_writes[(state.name, hash_value)] += 1
+        partition = state.partitions.get(hash_value, {})
+        existing = partition.pop(range_value, None)
+        if len(partition) == 0:
+            state.partitions.pop(hash_value, None)
+        return write_units(item_size(existing) if existing is not None else 0)
+
+    def consume(self, operation, units, request):
+        """
+        Records the units consumed per table, given as {table: (read, write)},
+        and returns the "ConsumedCapacity" response fields when the request
+        asked for them.
+        """
+        read_total = 0.0
+        write_total = 0.0
+        entries = []
+        for name, (read, write) in units.items():
+            self.consumed[(name, 'read')] += read
+            self.consumed[(name, 'write')] += write
+            read_total += read
+            write_total += write
+            entries.append({
+                'TableName': name,
+                'CapacityUnits': read + write,
+                'ReadCapacityUnits': read,
+                'WriteCapacityUnits': write,
+            })
+        record_capacity(read_total, write_total)
+        if request.get('ReturnConsumedCapacity', 'NONE') == 'NONE':
+            return {}
+        if operation in ['BatchGetItem', 'BatchWriteItem', 'TransactWriteItems']:
+            return {'ConsumedCapacity': entries}
+        return {'ConsumedCapacity': entries[0]}
+
+    def expression(self, condition, names, values, is_key_condition=False):
+        if isinstance(condition, ConditionBase):
+            built = self.builder.build_expression(condition, is_key_condition=is_key_condition)
+            return Expression(
+                built.condition_expression,
+                {**(names or {}), **built.attribute_name_placeholders},
+                {**(values or {}), **built.attribute_value_placeholders})
+        return Expression(condition, names, values)
+
+    def check(self, item, condition, names, values, operation):
+        if condition is None:
+            return
+        node = self.expression(condition, names, values).condition()
+        if not evaluate(node, item if item is not None else {}):
+            raise client_error(
+                'ConditionalCheckFailedException',
+                'The conditional request failed',
+                operation)
+
+    def get_item(self, name, Key, **kwargs):
+        with self.lock:
+            self.operations['GetItem'] += 1
+            state = self.state(name)
+            hash_value, range_value = self.key_of(state, Key)
+            self.partition_reads[(state.name, hash_value)] += 1
+            item = self.lookup(state, hash_value, range_value)
+            response = {'Item': copy.deepcopy(item)} if item is not None else {}
+            size = item_size(item) if item is not None else 0
+            response.update(self.consume('GetItem', {
+                state.name: (read_units(size, kwargs.get('ConsistentRead', False)), 0.0),
+            }, kwargs))
+            return response
+
+    def put_item(self, name, Item,
+                 ConditionExpression=None,
+                 ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None,
+                 ReturnValues='NONE', **kwargs):
+        with self.lock:
+            self.operations['PutItem'] += 1
+            state = self.state(name)
+            existing = self.lookup(state, *self.key_of(state, Item))
+            self.check(
+                existing,
+                ConditionExpression,
+                ExpressionAttributeNames,
+                ExpressionAttributeValues,
+                'PutItem')
+            units = self.store(state, to_dynamo(copy.deepcopy(Item)))
+            response = {}
+            if ReturnValues == 'ALL_OLD' and existing is not None:
+                response['Attributes'] = existing
+            response.update(self.consume('PutItem', {state.name: (0.0, units)}, kwargs))
+            return response
+
+    def update_item(self, name, Key,
+                    UpdateExpression,
+                    ConditionExpression=None,
+                    ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None,
+                    ReturnValues='NONE', **kwargs):
+        with self.lock:
+            self.operations['UpdateItem'] += 1
+            response, units = self.apply_update(
+                self.state(name),
+                Key,
+                UpdateExpression,
+                ConditionExpression,
+                ExpressionAttributeNames,
+                ExpressionAttributeValues,
+                ReturnValues)
+            response.update(self.consume('UpdateItem', {name: (0.0, units)}, kwargs))
+            return response
+
+    def apply_update(self, state, key, update, condition, names, values, return_values, check_only=False):
+        """
+        Returns the response and the write units consumed.
+        """
+        hash_value, range_value = self.key_of(state, key)
+        existing = self.lookup(state, hash_value, range_value)
+        self.check(existing, condition, names, values, 'UpdateItem')
+        if check_only:
+            return {}, 0.0
+        item = copy.deepcopy(existing) if existing is not None else to_dynamo(dict(key))
+        updated = set()
+        for action in Expression(update, names, values).updates():
+            segments = action[1][1]
+            updated.add(segments[0])
+            if action[0] == 'set':
+                assign_path(item, segments, copy.deepcopy(evaluate(action[2], item)))
+            elif action[0] == 'remove':
+                assign_path(item, segments, MISSING)
+            else:
+                current = resolve_path(item, segments)
+                value = evaluate(action[2], item)
+                if action[0] == 'add' and isinstance(value, Decimal):
+                    current = (current if current is not MISSING else Decimal(0)) + value
+                elif action[0] == 'add':
+                    current = (current if current is not MISSING else set()) | value
+                else:
+                    current = (current if current is not MISSING else set()) - value
+                is_empty_set = isinstance(current, set) and len(current) == 0
+                assign_path(item, segments, MISSING if is_empty_set else current)
+        if state.hash_key in updated or state.range_key in updated:
+            raise client_error(
+                'ValidationException',
+                'Cannot update attribute. This attribute is part of the key',
+                'UpdateItem')
+        units = self.store(state, item)
+        if return_values == 'ALL_NEW':
+            return {'Attributes': copy.deepcopy(item)}, units
+        if return_values == 'ALL_OLD' and existing is not None:
+            return {'Attributes': existing}, units
+        if return_values in ['UPDATED_NEW', 'UPDATED_OLD']:
+            source = item if return_values == 'UPDATED_NEW' else (existing or {})
+            return {'Attributes': {
+                field: copy.deepcopy(source[field]) for field in updated if field in source
+            }}, units
+        return {}, units
+
+    def delete_item(self, name, Key,
+                    ConditionExpression=None,
+                    ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None,
+                    ReturnValues='NONE', **kwargs):
+        with self.lock:
+            self.operations['DeleteItem'] += 1
+            state = self.state(name)
+            hash_value, range_value = self.key_of(state, Key)
+            existing = self.lookup(state, hash_value, range_value)
+            self.check(
+                existing,
+                ConditionExpression,
+                ExpressionAttributeNames,
+                ExpressionAttributeValues,
+                'DeleteItem')
+            units = self.remove(state, hash_value, range_value)
+            response = {}
+            if ReturnValues == 'ALL_OLD' and existing is not None:
+                response['Attributes'] = existing
+            response.update(self.consume('DeleteItem', {state.name: (0.0, units)}, kwargs))
+            return response
+
+    def query(self, name,
+              KeyConditionExpression,
+              IndexName=None,
+              FilterExpression=None,
+              ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None,
+              ScanIndexForward=True,
+              Limit=None,
+              ExclusiveStartKey=None, **kwargs):
+        with self.lock:
+            self.operations['Query'] += 1
+            state = self.state(name)
+            hash_key, range_key = state.hash_key, state.range_key
+            if IndexName is not None:
+                hash_key, range_key = state.indexes[IndexName]
+            key_condition = self.expression(
+                KeyConditionExpression,
+                ExpressionAttributeNames,
+                ExpressionAttributeValues,
+                is_key_condition=True).condition()
+            hash_value = self.partition_value(key_condition, hash_key)
+            self.partition_reads[(state.name, hash_value)] += 1
+            if IndexName is None:
+                candidates = list(state.partitions.get(hash_value, {}).items())
+            else:
+                candidates = [
+                    (item.get(range_key), item)
+                    for partition in state.partitions.values()
+                    for item in partition.values()
+                    if item.get(hash_key) == hash_value and range_key in item
+                ]
+            candidates = [
+                (self.order_of(state, item, range_key, IndexName), item)
+                for _, item in candidates
+                if not self.expired(state, item) and evaluate(key_condition, item)
+            ]
+            candidates.sort(key=lambda pair: pair[0], reverse=not ScanIndexForward)
+            if ExclusiveStartKey is not None:
+                start = self.order_of(state, to_dynamo(ExclusiveStartKey), range_key, IndexName)
+                candidates = [
+                    pair for pair in candidates
+                    if (pair[0] > start if ScanIndexForward else pair[0] < start)
+                ]
+            page = candidates if Limit is None else candidates[:Limit]
+            items = [item for _, item in page]
+            units = read_units(
+                sum(item_size(item) for item in items),
+                IndexName is None and kwargs.get('ConsistentRead', False))
+            if FilterExpression is not None:
+                node = self.expression(
+                    FilterExpression,
+                    ExpressionAttributeNames,
+                    ExpressionAttributeValues).condition()
+                items = [item for item in items if evaluate(node, item)]
+            response = {
+                'Items': copy.deepcopy(items),
+                'Count': len(items),
+                'ScannedCount': len(page),
+            }
+            if Limit is not None and len(candidates) > Limit:
+                last = page[-1][1]
+                keys = [state.hash_key, state.range_key, hash_key, range_key]
+                response['LastEvaluatedKey'] = {
+                    key: copy.deepcopy(last[key]) for key in keys if key is not None
+                }
+            response.update(self.consume('Query', {state.name: (units, 0.0)}, kwargs))
+            return response
+
+    def partition_value(self, node, hash_key):
+        if node[0] == 'compare' and node[1] == '=':
+            for side, other in [(node[2], node[3]), (node[3], node[2])]:
+                if side[0] == 'path' and side[1] == [hash_key] and other[0] == 'value':
+                    return other[1]
+        if node[0] == 'and':
+            for child in node[1:]:
+                value = self.partition_value(child, hash_key)
+                if value is not None:
+                    return value
+        if node[0] == 'and' or node[0] == 'compare':
+            return None
+        raise client_error(
+            'ValidationException',
+            'Query condition missed key schema element',
+            'Query')
+
+    def order_of(self, state, item, range_key, index_name):
+        keys = (item.get(state.range_key, ''), item.get(state.hash_key, ''))
+        if index_name is None:
+            return keys
+        return (item.get(range_key),) + keys
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        with self.lock:
+            self.operations['BatchGetItem'] += 1
+            responses = {}
+            units = {}
+            for name, request in RequestItems.items():
+                state = self.state(name)
+                responses[name] = []
+                consumed = 0.0
+                for key in request['Keys']:
+                    hash_value, range_value = self.key_of(state, key)
+                    self.partition_reads[(state.name, hash_value)] += 1
+                    item = self.lookup(state, hash_value, range_value)
+                    size = item_size(item) if item is not None else 0
+                    consumed += read_units(size, request.get('ConsistentRead', False))
+                    if item is not None:
+                        responses[name].append(copy.deepcopy(item))
+                units[name] = (consumed, 0.0)
+            response = {'Responses': responses, 'UnprocessedKeys': {}}
+            response.update(self.consume('BatchGetItem', units, kwargs))
+            return response
+
+    def batch_write(self, name, operations):
+        with self.lock:
+            self.operations['BatchWriteItem'] += 1
+            state = self.state(name)
+            units = 0.0
+            for operation, value in operations:
+                if operation == 'put':
+                    units += self.store(state, to_dynamo(copy.deepcopy(value)))
+                else:
+                    units += self.remove(state, *self.key_of(state, value))
+            self.consume('BatchWriteItem', {name: (0.0, units)}, {})
+
+    def transact_write_items(self, transact_items, **kwargs):
+        """
+        Transactional writes are billed twice, once to prepare and once to
+        commit each item.
+        """
+        with self.lock:
+            self.operations['TransactWriteItems'] += 1
+            seen = set()
+            reasons = []
+            for transact_item in transact_items:
+                operation, request = next(iter(transact_item.items()))
+                state = self.state(request['TableName'])
+                key = request['Item'] if operation == 'Put' else request['Key']
+                identity = (state.name,) + self.key_of(state, key)
+                if identity in seen:
+                    raise client_error(
+                        'ValidationException',
+                        'Transaction request cannot include multiple operations on one item',
+                        'TransactWriteItems')
+                seen.add(identity)
+                try:
+                    self.check(
+                        self.lookup(state, *identity[1:]),
+                        request.get('ConditionExpression'),
+                        request.get('ExpressionAttributeNames'),
+                        request.get('ExpressionAttributeValues'),
+                        'TransactWriteItems')
+                    reasons.append({'Code': 'None'})
+                except ClientError as e:
+                    reasons.append({
+                        'Code': 'ConditionalCheckFailed',
+                        'Message': e.response['Error']['Message'],
+                    })
+            if any(reason['Code'] != 'None' for reason in reasons):
+                raise client_error(
+                    'TransactionCanceledException',
+                    'Transaction cancelled, please refer cancellation reasons for specific reasons',
+                    'TransactWriteItems',
+                    CancellationReasons=reasons)
+            units = {}
+            for transact_item in transact_items:
+                operation, request = next(iter(transact_item.items()))
+                state = self.state(request['TableName'])
+                consumed = 0.0
+                if operation == 'Put':
+                    consumed = self.store(state, to_dynamo(copy.deepcopy(request['Item'])))
+                elif operation == 'Delete':
+                    consumed = self.remove(state, *self.key_of(state, request['Key']))
+                elif operation == 'Update':
+                    _, consumed = self.apply_update(
+                        state,
+                        request['Key'],
+                        request['UpdateExpression'],
+                        None,
+                        request.get('ExpressionAttributeNames'),
+                        request.get('ExpressionAttributeValues'),
+                        'NONE')
+                read, write = units.get(state.name, (0.0, 0.0))
+                units[state.name] = (read, write + consumed * 2)
+            return self.consume('TransactWriteItems', units, kwargs)
+
+
+def use_memory_tables(table_name=None, force=True):
+    """
+    Injects an in-memory "dynamodb" and "table" into the app_context so
+    that repositories constructed afterwards are backed by memory.
+    """
+    ddb = MemoryDynamoDB()
+    table = ddb.Table(table_name if table_name is not None else os.getenv('TABLE_NAME', 'Pits'))
+    app_context.inject('dynamodb', ddb, force=force)
+    app_context.inject('table', table, force=force)
+    return ddb
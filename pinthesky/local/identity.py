@@ -0,0 +1,52 @@
+"""
+A local stand-in for the Cognito user pool: signs RS256 tokens with a
+generated key, and seeds the JWKS cache so that login and the authorizer
+verify them without fetching keys.
+"""
+import os
+import rsa
+import time
+from jose import jwk, jwt
+from pinthesky import auth
+
+
+class LocalIdentity:
+    def __init__(self, pool_id='local-pool', client_id='local-client', region='us-east-1', kid='local', bits=2048) -> None:
+        self.pool_id = pool_id
+        self.client_id = client_id
+        self.region = region
+        self.kid = kid
+        _, private_key = rsa.newkeys(bits)
+        self.private_key = private_key.save_pkcs1().decode('utf-8')
+        public_key = jwk.construct(self.private_key, 'RS256').public_key()
+        self.public_jwk = {
+            **public_key.to_dict(),
+            'kid': kid,
+            'use': 'sig',
+        }
+
+    def install(self, environ=os.environ):
+        """
+        Points the login configuration at this identity and seeds its keys.
+        """
+        environ['AWS_REGION'] = self.region
+        environ['USER_POOL_ID'] = self.pool_id
+        environ['USER_CLIENT_ID'] = self.client_id
+        auth.known_keys[(self.region, self.pool_id)] = (time.monotonic(), [self.public_jwk])
+        return self
+
+    def token(self, sub, expires_in=3600, **claims):
+        now = int(time.time())
+        return jwt.encode(
+            {
+                'sub': sub,
+                'aud': self.client_id,
+                'iss': f'https://cognito-idp.{self.region}.amazonaws.com/{self.pool_id}',
+                'token_use': 'id',
+                'iat': now,
+                'exp': now + expires_in,
+                **claims,
+            },
+            self.private_key,
+            algorithm='RS256',
+            headers={'kid': self.kid})
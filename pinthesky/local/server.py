@@ -0,0 +1,462 @@
+"""
+A local websocket server hosting the api router, in place of API Gateway.
+It speaks enough of RFC 6455 for browsers and load generators: the upgrade
+handshake with the "manager" and "session" subprotocols, masked client
+frames, fragmentation, ping and close. Connects, messages and disconnects
+are translated into the API Gateway event shape and dispatched through the
+router, and the "apigatewaymanagementapi" stand-in delivers posted frames
+to the open sockets. Binary messages are passed base64 encoded, and posted
+frames in a binary encoding are sent as binary messages.
+
+python -m pinthesky.local.server --port 8080 --identity
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+from botocore.exceptions import ClientError
+from collections import namedtuple
+from contextvars import copy_context
+from pinthesky import codec
+from pinthesky.local.services import LocalManagementApi
+from urllib.parse import parse_qsl, urlsplit
+
+
+logger = logging.getLogger(__name__)
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+PROTOCOLS = ['manager', 'session']
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+LambdaContext = namedtuple('LambdaContext', field_names=['invoked_function_arn'])
+
+
+class ProtocolError(Exception):
+    def __init__(self, code, *args: object) -> None:
+        super().__init__(*args)
+        self.code = code
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + GUID).encode('utf-8')).digest()).decode('utf-8')
+
+
+def unmask(data, mask):
+    length = len(data)
+    if length == 0:
+        return data
+    repeated = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+
+
+def encode_frame(opcode, data=b'', mask=None):
+    """
+    Frames sent by the server are never masked. The mask is only there
+    for clients, like the tests, that speak to the server.
+    """
+    length = len(data)
+    header = bytearray([0x80 | opcode])
+    mask_bit = 0x80 if mask is not None else 0
+    if length < 126:
+        header.append(mask_bit | length)
+    elif length < 1 << 16:
+        header.append(mask_bit | 126)
+        header.extend(struct.pack('!H', length))
+    else:
+        header.append(mask_bit | 127)
+        header.extend(struct.pack('!Q', length))
+    if mask is not None:
+        return bytes(header) + mask + unmask(data, mask)
+    return bytes(header) + data
+
+
+async def read_frame(reader, max_size, require_mask=True):
+    """
+    Returns (fin, opcode, payload) for the next frame on the stream.
+    """
+    head = await reader.readexactly(2)
+    fin = head[0] & 0x80 != 0
+    opcode = head[0] & 0x0F
+    masked = head[1] & 0x80 != 0
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', await reader.readexactly(8))[0]
+    if require_mask and not masked:
+        raise ProtocolError(1002, 'Client frames must be masked')
+    if length > max_size:
+        raise ProtocolError(1009, f'Frame of {length} bytes is over {max_size}')
+    mask = await reader.readexactly(4) if masked else None
+    data = await reader.readexactly(length)
+    return fin, opcode, unmask(data, mask) if mask is not None else data
+
+
+async def read_handshake(reader):
+    """
+    Reads the HTTP upgrade request, returning the target and its headers.
+    """
+    lines = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    method, target, _ = lines[0].split(' ', 2)
+    if method != 'GET':
+        raise ProtocolError(405, f'Method {method} is not allowed')
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip()] = value.strip()
+    return target, headers
+
+
+def header(headers, name, default=None):
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return default
+
+
+class LocalConnection:
+    def __init__(self, connection_id, reader, writer, protocol) -> None:
+        self.connection_id = connection_id
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        self.connected_at = time.time()
+        self.closed = False
+
+    async def send(self, opcode, data):
+        if self.closed:
+            return
+        self.writer.write(encode_frame(opcode, data))
+        await self.writer.drain()
+
+    async def close(self, code=1000):
+        if not self.closed:
+            await self.send(OP_CLOSE, struct.pack('!H', code))
+            self.closed = True
+        self.writer.close()
+
+
+class LocalGateway(LocalManagementApi):
+    """
+    Serves the router over websockets, and stands in for the management
+    API of the connections it serves, so it must be placed in the
+    management client pool for the service domain:
+
+    gateway = LocalGateway(port=8080)
+    management.clients[f'https://{gateway.domain}'] = gateway
+    asyncio.run(gateway.serve_forever())
+
+    Frames are dispatched on a thread pool in a copy of the context the
+    gateway was created in, one at a time per connection.
+    """
+    def __init__(self, router=None, host='127.0.0.1', port=8080, stage='local',
+                 account_id='123456789012', max_size=128 * 1024, max_frames=100) -> None:
+        super().__init__(max_frames=max_frames)
+        if router is None:
+            from pinthesky import api as router
+        self.router = router
+        self.host = host
+        self.port = port
+        self.stage = stage
+        self.account_id = account_id
+        self.max_size = max_size
+        self.context = copy_context()
+        self.connections = {}
+        self.tasks = set()
+        self.loop = None
+        self.server = None
+        self.counter = 0
+        self.counter_lock = threading.Lock()
+
+    @property
+    def domain(self):
+        return os.getenv('SERVICE_DOMAIN') or f'{self.host}:{self.port}/{self.stage}'
+
+    def make_event(self, route_key, connection_id, body=None, headers={}, query_params={}, authorizer={},
+                   is_base64=False):
+        """
+        Builds an event in the shape of events/resources/request.template.json.
+        """
+        with self.counter_lock:
+            self.counter += 1
+            request_id = f'local-{self.counter}'
+        now = time.time()
+        domain_name = f'{self.host}:{self.port}'
+        return {
+            'version': '2.0',
+            'routeKey': route_key,
+            'rawPath': f'/{self.stage}',
+            'rawQueryString': '&'.join(f'{key}={value}' for key, value in query_params.items()),
+            'cookies': [],
+            'headers': headers,
+            'queryStringParameters': query_params,
+            'requestContext': {
+                'accountId': self.account_id,
+                'connectionId': connection_id,
+                'authorizer': authorizer,
+                'domainName': domain_name,
+                'domainPrefix': self.host,
+                'http': {
+                    'method': 'GET',
+                    'path': f'/{self.stage}',
+                    'protocol': 'HTTP/1.1',
+                    'sourceIp': '127.0.0.1',
+                    'userAgent': header(headers, 'User-Agent', 'local'),
+                },
+                'requestId': request_id,
+                'routeKey': route_key,
+                'stage': self.stage,
+                'time': time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(now)),
+                'timeEpoch': int(now * 1000),
+            },
+            'pathParameters': {},
+            'body': body if body is not None else '',
+            'isBase64Encoded': is_base64,
+            'stageVariables': {},
+        }
+
+    def route_key(self, body):
+        """
+        Selects the route with "$request.body.action", like the deployed API.
+        """
+        from pinthesky.resource import ROUTES
+
+        try:
+            action = codec.loads(body).get('action', None)
+        except Exception:
+            return '$default'
+        return action if action in ROUTES and '$' not in action else '$default'
+
+    async def dispatch(self, event):
+        context = LambdaContext(invoked_function_arn=f'arn:aws:lambda:local:{self.account_id}:function:LocalGateway')
+        return await self.loop.run_in_executor(None, self.context.copy().run, self.router, event, context)
+
+    def authorize(self, connection_id, headers, query_params):
+        """
+        Runs the JWT authorizer when a token is offered, and returns its
+        claims, an empty context for anonymous connections, or None when
+        the token was denied.
+        """
+        token = header(headers, 'Authorization', query_params.get('Authorization', None))
+        if token is None:
+            return {}
+        from pinthesky.auth import user_jwt
+
+        event = self.make_event('$connect', connection_id, headers={'Authorization': token}, query_params=query_params)
+        event['methodArn'] = f'arn:aws:execute-api:local:{self.account_id}:{self.stage}/$connect'
+        policy = user_jwt(event, None)
+        if policy['policyDocument']['Statement'][0]['Effect'] != 'Allow':
+            return None
+        return policy['context']
+
+    def next_connection_id(self):
+        return base64.b64encode(os.urandom(10)).decode('utf-8')
+
+    async def reject(self, writer, status, reason, message=''):
+        body = message.encode('utf-8')
+        writer.write(
+            f'HTTP/1.1 {status} {reason}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1')
+            + body)
+        await writer.drain()
+        writer.close()
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            await self.upgrade(reader, writer)
+        finally:
+            self.tasks.discard(task)
+
+    async def upgrade(self, reader, writer):
+        try:
+            target, headers = await read_handshake(reader)
+        except (ProtocolError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return await self.reject(writer, 400, 'Bad Request')
+        key = header(headers, 'Sec-WebSocket-Key', None)
+        if key is None or header(headers, 'Upgrade', '').lower() != 'websocket':
+            return await self.reject(writer, 426, 'Upgrade Required')
+        negotiated = codec.negotiate(header(headers, 'Sec-WebSocket-Protocol', ''), PROTOCOLS)
+        protocol = negotiated[0] if negotiated is not None else None
+        query_params = dict(parse_qsl(urlsplit(target).query))
+        connection_id = self.next_connection_id()
+        authorizer = self.authorize(connection_id, headers, query_params)
+        if authorizer is None:
+            return await self.reject(writer, 403, 'Forbidden')
+        event_headers = {
+            name: value for name, value in headers.items()
+            if name.lower() != 'sec-websocket-protocol'
+        }
+        if protocol is not None:
+            event_headers['Sec-WebSocket-Protocol'] = protocol
+        output = await self.dispatch(self.make_event(
+            '$connect',
+            connection_id,
+            headers=event_headers,
+            query_params=query_params,
+            authorizer=authorizer))
+        if output['statusCode'] >= 400:
+            return await self.reject(writer, output['statusCode'], 'Rejected', output.get('body') or '')
+        response = [
+            'HTTP/1.1 101 Switching Protocols',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            f'Sec-WebSocket-Accept: {accept_key(key)}',
+        ]
+        if protocol is not None:
+            response.append(f'Sec-WebSocket-Protocol: {protocol}')
+        writer.write(('\r\n'.join(response) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        connection = LocalConnection(connection_id, reader, writer, protocol)
+        self.connections[connection_id] = connection
+        logger.info(f'Connected {connection_id} with {protocol}')
+        try:
+            await self.receive(connection)
+        finally:
+            self.connections.pop(connection_id, None)
+            await self.dispatch(self.make_event('$disconnect', connection_id, headers=event_headers))
+            await connection.close()
+            logger.info(f'Disconnected {connection_id}')
+
+    async def receive(self, connection):
+        """
+        Reads messages until the client closes, dispatching each to its route.
+        """
+        message = []
+        binary = False
+        while not connection.closed:
+            try:
+                fin, opcode, data = await read_frame(connection.reader, self.max_size)
+            except ProtocolError as e:
+                await connection.close(e.code)
+                return
+            except (asyncio.IncompleteReadError, ConnectionError):
+                connection.closed = True
+                return
+            if opcode == OP_CLOSE:
+                await connection.close()
+                return
+            if opcode == OP_PING:
+                await connection.send(OP_PONG, data)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode not in [OP_CONTINUATION, OP_TEXT, OP_BINARY]:
+                await connection.close(1002)
+                return
+            if opcode != OP_CONTINUATION:
+                binary = opcode == OP_BINARY
+            message.append(data)
+            if sum(len(part) for part in message) > self.max_size:
+                await connection.close(1009)
+                return
+            if fin:
+                data = b''.join(message)
+                message = []
+                if binary:
+                    body = base64.b64encode(data).decode('utf-8')
+                else:
+                    body = data.decode('utf-8', errors='replace')
+                await self.dispatch(self.make_event(
+                    self.route_key(data),
+                    connection.connection_id,
+                    body=body,
+                    is_base64=binary))
+
+    def post_to_connection(self, ConnectionId, Data):
+        connection = self.connections.get(ConnectionId, None)
+        if connection is None or connection.closed:
+            raise ClientError({
+                'Error': {'Code': 'GoneException', 'Message': f'Connection {ConnectionId} is gone'},
+                'ResponseMetadata': {'HTTPStatusCode': 410},
+            }, 'PostToConnection')
+        super().post_to_connection(ConnectionId=ConnectionId, Data=Data)
+        data = Data.encode('utf-8') if isinstance(Data, str) else Data
+        opcode = OP_TEXT if codec.sniff(data) == 'json' else OP_BINARY
+        asyncio.run_coroutine_threadsafe(connection.send(opcode, data), self.loop).result()
+        return {}
+
+    def delete_connection(self, ConnectionId):
+        super().delete_connection(ConnectionId=ConnectionId)
+        connection = self.connections.get(ConnectionId, None)
+        if connection is not None:
+            asyncio.run_coroutine_threadsafe(connection.close(), self.loop)
+        return {}
+
+    def get_connection(self, ConnectionId):
+        connection = self.connections.get(ConnectionId, None)
+        if connection is None:
+            raise ClientError({
+                'Error': {'Code': 'GoneException', 'Message': f'Connection {ConnectionId} is gone'},
+                'ResponseMetadata': {'HTTPStatusCode': 410},
+            }, 'GetConnection')
+        return {'ConnectedAt': connection.connected_at, 'Identity': {'SourceIp': '127.0.0.1'}}
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def close(self):
+        """
+        Stops accepting connections, closes the open ones, and waits for
+        their "$disconnect" frames to be handled.
+        """
+        self.server.close()
+        for connection in list(self.connections.values()):
+            await connection.close(1001)
+        if len(self.tasks) > 0:
+            await asyncio.wait(list(self.tasks))
+        await self.server.wait_closed()
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local websocket server for pinthesky')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--stage', default='local')
+    parser.add_argument('--dynamodb', action='store_true', help='Use DynamoDB rather than in-memory tables')
+    parser.add_argument('--identity', action='store_true', help='Sign in with a local identity and print a token')
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+
+    from pinthesky import management
+    from pinthesky.local.database import use_memory_tables
+    from pinthesky.local.services import use_local_services
+    from pinthesky.resource import load_all_routes
+
+    if not args.dynamodb:
+        use_memory_tables()
+    gateway = LocalGateway(host=args.host, port=args.port, stage=args.stage)
+    os.environ.setdefault('SERVICE_DOMAIN', gateway.domain)
+    use_local_services(service_domain=gateway.domain)
+    management.clients[f'https://{gateway.domain}'] = gateway
+    load_all_routes()
+    if args.identity:
+        from pinthesky.local.identity import LocalIdentity
+
+        token = LocalIdentity().install().token('local-user')
+        print(f'ws://{args.host}:{args.port}/?Authorization={token}')
+    gateway.context = copy_context()
+    logger.info(f'Serving on ws://{args.host}:{args.port}')
+    asyncio.run(gateway.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+In-process stand-ins for the "apigatewaymanagementapi" and "iot-data"
+clients, for running the handlers without AWS. They keep what was sent
+so callers can inspect it.
+"""
+import os
+import threading
+from collections import defaultdict, deque
+from ophis.globals import app_context
+
+
+class LocalManagementApi:
+    def __init__(self, max_frames=100) -> None:
+        self.frames = defaultdict(lambda: deque(maxlen=max_frames))
+        self.deleted = set()
+        self.lock = threading.Lock()
+
+    def post_to_connection(self, ConnectionId, Data):
+        with self.lock:
+            self.frames[ConnectionId].append(Data)
+        return {}
+
+    def delete_connection(self, ConnectionId):
+        with self.lock:
+            self.deleted.add(ConnectionId)
+        return {}
+
+    def get_connection(self, ConnectionId):
+        return {'ConnectedAt': None, 'Identity': {}}
+
+
+class LocalIotData:
+    def __init__(self, max_messages=1000) -> None:
+        self.messages = deque(maxlen=max_messages)
+
+    def publish(self, topic, payload=b'', qos=0, **kwargs):
+        self.messages.append((topic, payload))
+        return {}
+
+
+def use_local_services(service_domain=None, force=True):
+    """
+    Injects a LocalIotData as "iot_data" and places a LocalManagementApi
+    in the management client pool for the service domain.
+    """
+    from pinthesky import management
+
+    domain = service_domain if service_domain is not None else os.getenv('SERVICE_DOMAIN')
+    management_api = LocalManagementApi()
+    iot_data = LocalIotData()
+    management.clients[f'https://{domain}'] = management_api
+    app_context.inject('iot_data', iot_data, force=force)
+    return management_api, iot_data
@@ -0,0 +1,301 @@
+"""
+Per invocation latency metrics, written to stdout as CloudWatch Embedded
+Metric Format so they are extracted from the logs without any API calls.
+
+Every frame records its total latency, the time spent in each phase
+("parse", "db", "publish" and "post"), and the statusCode it replied
+with. Phases that run more than once per frame, like several DynamoDB
+calls, are aggregated into a histogram of values and counts. Set
+METRICS_NAMESPACE to an empty string to turn the log lines off.
+
+DynamoDB calls made through an instrumented client ask for their consumed
+capacity, which is emitted with the frame as read and write units and
+accumulated per routeKey for the life of the container, to rank routes
+by the capacity each frame costs.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from ophis.router import Router
+
+
+PHASE_METRICS = {
+    'parse': 'ParseLatency',
+    'db': 'DBLatency',
+    'publish': 'PublishLatency',
+    'post': 'PostLatency',
+}
+CAPACITY_OPERATIONS = {
+    'GetItem': 'read',
+    'Query': 'read',
+    'Scan': 'read',
+    'BatchGetItem': 'read',
+    'TransactGetItems': 'read',
+    'PutItem': 'write',
+    'UpdateItem': 'write',
+    'DeleteItem': 'write',
+    'BatchWriteItem': 'write',
+    'TransactWriteItems': 'write',
+}
+current = ContextVar('pinthesky_metrics', default=None)
+directives = {}
+lock = threading.Lock()
+capacity = {}
+
+
+class Histogram:
+    """
+    Values are bucketed to two significant digits, which keeps the EMF
+    "Values" and "Counts" arrays small.
+    """
+    __slots__ = ('buckets',)
+
+    def __init__(self) -> None:
+        self.buckets = {}
+
+    def add(self, value):
+        bucket = float(f'{value:.2g}')
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def to_emf(self):
+        return {
+            'Values': list(self.buckets.keys()),
+            'Counts': list(self.buckets.values()),
+        }
+
+
+class Invocation:
+    def __init__(self, route_key) -> None:
+        self.route_key = route_key
+        self.status_code = None
+        self.phases = {}
+        self.read_units = 0.0
+        self.write_units = 0.0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, phase, millis):
+        with self.lock:
+            histogram = self.phases.get(phase, None)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram()
+            histogram.add(millis)
+
+    def to_emf(self, namespace, latency):
+        """
+        Renders the EMF log line. The metric directive only depends on the
+        namespace, the phases seen and whether any capacity was consumed, so
+        it is serialized once per shape.
+        """
+        phases = tuple(self.phases)
+        consumed = self.read_units > 0 or self.write_units > 0
+        directive = directives.get((namespace, phases, consumed), None)
+        if directive is None:
+            metrics = [{'Name': 'Latency', 'Unit': 'Milliseconds'}]
+            for phase in phases:
+                metrics.append({'Name': PHASE_METRICS.get(phase, f'{phase.title()}Latency'), 'Unit': 'Milliseconds'})
+            if consumed:
+                metrics.append({'Name': 'ConsumedReadCapacityUnits', 'Unit': 'Count'})
+                metrics.append({'Name': 'ConsumedWriteCapacityUnits', 'Unit': 'Count'})
+            directive = json.dumps([
+                {
+                    'Namespace': namespace,
+                    'Dimensions': [['routeKey'], ['routeKey', 'statusCode']],
+                    'Metrics': metrics,
+                }
+            ])
+            directives[(namespace, phases, consumed)] = directive
+        document = {
+            'routeKey': str(self.route_key),
+            'statusCode': str(self.status_code),
+            'Latency': latency,
+        }
+        for phase, histogram in self.phases.items():
+            document[PHASE_METRICS.get(phase, f'{phase.title()}Latency')] = histogram.to_emf()
+        if consumed:
+            document['ConsumedReadCapacityUnits'] = self.read_units
+            document['ConsumedWriteCapacityUnits'] = self.write_units
+        timestamp = int(time.time() * 1000)
+        return f'{{"_aws": {{"Timestamp": {timestamp}, "CloudWatchMetrics": {directive}}}, {json.dumps(document)[1:]}'
+
+
+class phase:
+    """
+    Times the enclosed block as a phase of the current frame, and does
+    nothing outside of one:
+
+    with phase('publish'):
+        iot_data.publish(...)
+    """
+    __slots__ = ('name', 'invocation', 'start')
+
+    def __init__(self, name) -> None:
+        self.name = name
+
+    def __enter__(self):
+        self.invocation = current.get()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.invocation is not None:
+            self.invocation.record(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+def record_status(status_code):
+    invocation = current.get()
+    if invocation is not None:
+        invocation.status_code = status_code
+
+
+def record_capacity(read_units=0, write_units=0):
+    invocation = current.get()
+    if invocation is not None:
+        with invocation.lock:
+            invocation.read_units += read_units
+            invocation.write_units += write_units
+
+
+def consumed_units(operation, consumed):
+    """
+    Sums a "ConsumedCapacity" response, which is a dict for single item
+    calls and a list with one entry per table for batches and
+    transactions, into (read units, write units).
+    """
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    read_units = 0.0
+    write_units = 0.0
+    for entry in consumed:
+        read = entry.get('ReadCapacityUnits', None)
+        write = entry.get('WriteCapacityUnits', None)
+        if read is None and write is None:
+            if CAPACITY_OPERATIONS.get(operation, 'read') == 'read':
+                read = entry.get('CapacityUnits', 0)
+            else:
+                write = entry.get('CapacityUnits', 0)
+        read_units += read or 0
+        write_units += write or 0
+    return read_units, write_units
+
+
+def request_capacity(params, model, **kwargs):
+    if model.name in CAPACITY_OPERATIONS:
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+
+def account_capacity(parsed, model, **kwargs):
+    consumed = parsed.get('ConsumedCapacity', None)
+    if consumed is not None:
+        record_capacity(*consumed_units(model.name, consumed))
+
+
+def instrument(client, name='db'):
+    """
+    Registers botocore hooks on a client, or a resource's client, so
+    every API call is timed as the named phase. DynamoDB calls also
+    request and record their consumed capacity. Returns the client.
+    """
+    meta = client.meta.client.meta if hasattr(client.meta, 'client') else client.meta
+
+    def before_call(context, **kwargs):
+        context['metrics_start'] = time.perf_counter()
+
+    def after_call(context, **kwargs):
+        invocation = current.get()
+        start = context.pop('metrics_start', None)
+        if invocation is not None and start is not None:
+            invocation.record(name, (time.perf_counter() - start) * 1000)
+
+    meta.events.register_first('before-call.*.*', before_call)
+    meta.events.register('after-call.*.*', after_call)
+    if meta.service_model.service_name == 'dynamodb':
+        meta.events.register('provide-client-params.dynamodb.*', request_capacity)
+        meta.events.register('after-call.dynamodb.*', account_capacity)
+    return client
+
+
+class RouteCapacity:
+    __slots__ = ('frames', 'read_units', 'write_units')
+
+    def __init__(self) -> None:
+        self.frames = 0
+        self.read_units = 0.0
+        self.write_units = 0.0
+
+
+def account(invocation):
+    with lock:
+        route = capacity.get(invocation.route_key, None)
+        if route is None:
+            route = capacity[invocation.route_key] = RouteCapacity()
+        route.frames += 1
+        route.read_units += invocation.read_units
+        route.write_units += invocation.write_units
+
+
+def capacity_summary():
+    """
+    The capacity consumed by each routeKey, most expensive per frame first.
+    """
+    with lock:
+        rows = [
+            {
+                'routeKey': route_key,
+                'frames': route.frames,
+                'readUnits': route.read_units,
+                'writeUnits': route.write_units,
+                'unitsPerFrame': (route.read_units + route.write_units) / route.frames,
+            }
+            for route_key, route in capacity.items()
+        ]
+    rows.sort(key=lambda row: row['unitsPerFrame'], reverse=True)
+    return rows
+
+
+def capacity_report():
+    lines = [f'{"routeKey":>13} {"frames":>8} {"RCU":>10} {"WCU":>10} {"units/frame":>12}']
+    for row in capacity_summary():
+        lines.append(
+            f'{str(row["routeKey"]):>13} {row["frames"]:8} {row["readUnits"]:10.1f} '
+            f'{row["writeUnits"]:10.1f} {row["unitsPerFrame"]:12.2f}')
+    return '\n'.join(lines)
+
+
+def reset_capacity():
+    with lock:
+        capacity.clear()
+
+
+def emit(invocation):
+    namespace = os.getenv('METRICS_NAMESPACE', 'PitsData')
+    if namespace == '':
+        return
+    latency = (time.perf_counter() - invocation.start) * 1000
+    sys.stdout.write(invocation.to_emf(namespace, latency) + '\n')
+
+
+class MetricsRouter(Router):
+    """
+    A Router that collects the metrics for each frame it handles and
+    emits them once the frame is done.
+    """
+    def __call__(self, event, context):
+        invocation = Invocation(event.get('requestContext', {}).get('routeKey', None))
+        token = current.set(invocation)
+        try:
+            output = super().__call__(event, context)
+            if invocation.status_code is None:
+                invocation.status_code = output['statusCode']
+            return output
+        except Exception:
+            invocation.status_code = 500
+            raise
+        finally:
+            current.reset(token)
+            account(invocation)
+            emit(invocation)
@@ -0,0 +1,155 @@
+"""
+Opt-in profiling of frames, configured through the environment:
+
+- PROFILE_RATE: the fraction of frames to profile, off when 0 (default)
+- PROFILE_ROUTES: comma separated routeKeys to profile, or all if empty
+- PROFILE_MODE: "cprofile" (default), or "sample" for a stack sampler
+  that only looks at the frame every PROFILE_INTERVAL seconds
+- PROFILE_TOP: how many functions to log (default 20)
+- PROFILE_DIR: where profiles are written (default /tmp)
+
+cProfile output is written as a .prof file for pstats or snakeviz, and
+sampled output as collapsed stacks for flame graph tools. The profilers
+are imported on first use so frames that aren't profiled don't pay
+for them. Only one frame is profiled at a time: frames nested inside
+it, or running alongside it on other threads, are not profiled, as
+Python 3.12 allows a single active profiler per interpreter.
+"""
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from ophis.router import Router
+
+
+logger = logging.getLogger(__name__)
+profiling = threading.Lock()
+
+
+class Sampler:
+    """
+    Samples the stack of the thread that created it from a background
+    thread, counting how often each stack was seen.
+    """
+    def __init__(self, interval=0.005) -> None:
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id, None)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.items():
+                f.write(f'{";".join(stack)} {count}\n')
+
+    def top(self, limit):
+        cumulative = Counter()
+        own = Counter()
+        for stack, count in self.stacks.items():
+            for function in set(stack):
+                cumulative[function] += count
+            own[stack[-1]] += count
+        total = sum(self.stacks.values())
+        lines = [f'{total} samples, {"self":>6} {"total":>6}']
+        ranked = sorted(cumulative, key=lambda function: (-own[function], -cumulative[function]))
+        for function in ranked[:limit]:
+            lines.append(f'{own[function]:>6} {cumulative[function]:>6}  {function}')
+        return '\n'.join(lines)
+
+
+def profiler_active():
+    """
+    Whether another profiling tool, like an outside cProfile, is running.
+    """
+    if sys.getprofile() is not None:
+        return True
+    monitoring = getattr(sys, 'monitoring', None)
+    return monitoring is not None and monitoring.get_tool(monitoring.PROFILER_ID) is not None
+
+
+def should_profile(route_key):
+    rate = float(os.getenv('PROFILE_RATE', '0'))
+    if rate <= 0:
+        return False
+    routes = [route for route in os.getenv('PROFILE_ROUTES', '').split(',') if route != '']
+    if len(routes) > 0 and route_key not in routes:
+        return False
+    if rate >= 1:
+        return True
+    import random
+
+    return random.random() < rate
+
+
+def profile_path(route_key, extension):
+    name = re.sub(r'[^A-Za-z0-9_-]', '_', str(route_key)).strip('_')
+    return os.path.join(
+        os.getenv('PROFILE_DIR', '/tmp'),
+        f'pinthesky-{name}-{time.time_ns()}.{extension}')
+
+
+class ProfilingRouter(Router):
+    """
+    A Router that profiles a sample of frames when PROFILE_RATE is set.
+    """
+    def __call__(self, event, context):
+        route_key = event.get('requestContext', {}).get('routeKey', None)
+        if not should_profile(route_key) or profiler_active():
+            return super().__call__(event, context)
+        if not profiling.acquire(blocking=False):
+            return super().__call__(event, context)
+        try:
+            return self.profile(route_key, event, context)
+        finally:
+            profiling.release()
+
+    def profile(self, route_key, event, context):
+        limit = int(os.getenv('PROFILE_TOP', '20'))
+        if os.getenv('PROFILE_MODE', 'cprofile') == 'sample':
+            with Sampler(float(os.getenv('PROFILE_INTERVAL', '0.005'))) as sampler:
+                output = super().__call__(event, context)
+            path = profile_path(route_key, 'collapsed')
+            sampler.dump(path)
+            top = sampler.top(limit)
+        else:
+            import cProfile
+            import io
+            import pstats
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                output = super().__call__(event, context)
+            finally:
+                profiler.disable()
+            path = profile_path(route_key, 'prof')
+            profiler.dump_stats(path)
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+            top = stream.getvalue()
+        logger.info(f'Profiled {route_key} to {path}:\n{top}')
+        return output
@@ -1,32 +1,107 @@
+"""
+Route modules are imported on the first frame that needs them, so that
+a cold start only pays for the dependencies of the route being invoked.
+Each routeKey lists every module providing the handler and its injected
+values, in import order.
+
+The "$default" reply is serialized once from the route table. With
+DEFAULT_ROUTE_BURST set, each connection gets that many of these replies,
+refilled at DEFAULT_ROUTE_RATE per second (0.1 by default), and the rest
+are dropped.
+"""
+import json
+import logging
+import os
+from importlib import import_module
 from ophis import set_stream_logger
-from pinthesky import api, management
-from pinthesky.resource import inject, connection, iot, auth
+from ophis.globals import request
+from pinthesky import api, codec, management
+from pinthesky.metrics import phase, record_status
+from pinthesky.util import RateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+
+ROUTES = {
+    '$connect': ['inject', 'connection'],
+    '$disconnect': ['inject', 'connection', 'iot'],
+    'status': ['inject', 'connection'],
+    'invoke': ['inject', 'connection', 'iot'],
+    'listSessions': ['inject', 'connection', 'iot'],
+    'login': ['inject', 'connection', 'auth'],
+    'keepalive': ['inject', 'connection', 'iot'],
+    'batch': ['inject', 'connection', 'iot', 'auth', 'batch'],
+}
+loaded_modules = set()
+
+
+def load_route(route_key):
+    for name in ROUTES.get(route_key, []):
+        module_name = f'{__name__}.{name}'
+        if module_name not in loaded_modules:
+            set_stream_logger(import_module(module_name).__name__)
+            loaded_modules.add(module_name)
+
+
+def load_all_routes():
+    for route_key in ROUTES:
+        load_route(route_key)
+
+
+@api.filter()
+def lazy_routes():
+    load_route(request.request_context('routeKey'))
+
+
+def route_catalogue():
+    """
+    Serializes the "$default" reply around a requestId placeholder, which
+    is split out so the reply is only a concatenation per frame.
+    """
+    placeholder = '__requestId__'
+    response = json.dumps({
+        'response': {
+            'action': '$default',
+            'statusCode': 404,
+            'error': {
+                'code': 'ResourceNotFound',
+                'message': 'Resource not found',
+            },
+            'body': {
+                'availableActions': [
+                    route_key for route_key in ROUTES if "$" not in route_key
+                ],
+            },
+            'requestId': placeholder,
+        }
+    })
+    prefix, suffix = response.split(json.dumps(placeholder))
+    return prefix, suffix
 
 
-for module in [inject, connection, iot, auth]:
-    set_stream_logger(module.__name__)
+catalogue = route_catalogue()
+unknown_actions = RateLimiter(
+    capacity=int(os.getenv('DEFAULT_ROUTE_BURST')),
+    rate=float(os.getenv('DEFAULT_ROUTE_RATE', '0.1')),
+) if os.getenv('DEFAULT_ROUTE_BURST', '') != '' else None
 
 
 @api.routeKey('$default')
-@management.post()
 def default():
     """
     This fallback handler is used for connections to discover
     available actions surfaced by the websocket server.
     """
-    routeKeys = []
-    for filter in api.filters:
-        if hasattr(filter, 'routeKey'):
-            route_key = getattr(filter, 'routeKey')
-            if "$" not in route_key:
-                routeKeys.append(route_key)
-    return {
-        'statusCode': 404,
-        'error': {
-            'code': 'ResourceNotFound',
-            'message': 'Resource not found',
-        },
-        'body': {
-            'availableActions': routeKeys,
-        },
-    }
+    connection_id = request.request_context('connectionId')
+    if unknown_actions is not None and not unknown_actions.admit(connection_id):
+        logger.debug(f'Dropping unknown action reply for {connection_id}')
+        return
+    prefix, suffix = catalogue
+    data = f'{prefix}{json.dumps(management.request_id())}{suffix}'.encode('utf-8')
+    encoding = management.connection_encoding(connection_id)
+    if encoding != 'json':
+        data = codec.dumps(json.loads(data), encoding)
+    record_status(404)
+    with phase('post'):
+        management.client().post_to_connection(ConnectionId=connection_id, Data=data)
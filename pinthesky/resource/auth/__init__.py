@@ -1,19 +1,21 @@
-import json
 import logging
 import os
-from ophis.database import Repository
 from ophis.globals import app_context, request
 from pinthesky.auth import JWTAuthorizer
-from pinthesky.database import DataTokens
+from pinthesky.database import DataClaims, DataTokens, TransactionConflictException, transact_write
 from pinthesky.resource import api, management
+from pinthesky.util import executor, parse_body
 
 
 app_context.inject('data_tokens', DataTokens())
 logger = logging.getLogger(__name__)
+CONDITION_FAILED = 'ConditionalCheckFailed'
+TRANSACTION_CONFLICT = 'TransactionConflict'
+LOGIN_ATTEMPTS = 3
 
 
 @api.routeKey('login')
-def login(connections, data_tokens):
+def login(connections, data_tokens, data_claims):
     """
     The "login" action will authorize the connection based an exchange token
     created in the control plane. The token is single use, and tied to a
@@ -29,28 +31,40 @@ def login(connections, data_tokens):
     }
 
     It is possible for a "session" connection to link to a "manager"
-    connection by providing the "managerId" in the payload.
+    connection by providing the "managerId" in the payload. The two
+    connections are read concurrently, and the manager's "activeChildren"
+    is counted in the same transaction that activates the token. A
+    connection linked to a manager in "$connect" stays linked to it. A login
+    that keeps conflicting with other writes is answered with a 409, and
+    can be sent again.
     """
 
-    input = json.loads(request.body).get('payload', {})
+    input = parse_body().get('payload', {})
     connection_id = input.get('managerId', request.request_context('connectionId'))
-    connection = connections.get(
-        request.account_id(),
-        item_id=request.request_context('connectionId'),
-    )
-    payload = {'statusCode': 200}
-
+    reads = [
+        lambda: connections.get(
+            request.account_id(),
+            item_id=request.request_context('connectionId'),
+        ),
+    ]
     if input.get('managerId', None) is not None:
-        manager = connections.get(
+        reads.append(lambda: connections.get(
             request.account_id(),
             item_id=input['managerId'],
-        )
-        if manager is None:
+        ))
+    connection, *managers = executor.gather(*reads)
+    payload = {'statusCode': 200}
+    encoding = None
+
+    if input.get('managerId', None) is not None:
+        if managers[0] is None:
             logger.warning(f'The specified manager {input["managerId"]} does not exist')
             del input['managerId']
             connection_id = request.request_context('connectionId')
+        else:
+            encoding = managers[0].get('encoding', 'json')
 
-    @management.post(connectionId=connection_id)
+    @management.post(connectionId=connection_id, encoding=encoding)
     def post_to_connection():
         return payload
 
@@ -78,11 +92,36 @@ def login(connections, data_tokens):
             }
             return post_to_connection()
 
+    # Both the connection and its manager child row would be written
+    # in one transaction, which cannot touch the same item twice.
+    if input.get('managerId', None) == connection['connectionId']:
+        payload['statusCode'] = 400
+        payload['error'] = {
+            'code': 'InvalidInput',
+            'message': 'Input payload managerId is invalid'
+        }
+        return post_to_connection()
+
+    # The manager child row and counters were set up in "$connect", and
+    # are only undone for that manager in "$disconnect".
+    manager_id = input.get('managerId', connection.get('managerId', None))
+    if connection.get('managerId', None) not in [None, manager_id]:
+        @management.post()
+        def post_to_caller():
+            return payload
+
+        payload['statusCode'] = 400
+        payload['error'] = {
+            'code': 'InvalidInput',
+            'message': f'Connection is linked to manager {connection["managerId"]}'
+        }
+        return post_to_caller()
+
     claims = None
     try:
         jwt = JWTAuthorizer(
             os.getenv('USER_CLIENT_ID'),
-            JWTAuthorizer.pull_known_keys(
+            JWTAuthorizer.cached_keys(
                 os.getenv('USER_POOL_ID'),
             )
         )
@@ -93,21 +132,23 @@ def login(connections, data_tokens):
     if claims is None:
         return post_access_denied('JWT token is not valid')
 
-    token = data_tokens.get(
-        request.account_id(),
-        item_id=input['tokenId'],
-    )
-
-    if token is None or token['authorization']['activated']:
-        return post_access_denied('Token is not valid')
-
+    claims_id = DataClaims.claims_id(claims)
     updates = [
         {
             'repository': data_tokens,
+            'update': True,
+            'condition': {
+                'expression': 'attribute_exists(PK) AND NOT #authorization.#activated = :activated',
+                'names': {
+                    '#authorization': 'authorization',
+                    '#activated': 'activated',
+                },
+                'values': {
+                    ':activated': True,
+                },
+            },
             'item': {
                 'id': input['tokenId'],
-                'createTime': token['createTime'],
-                'expiresIn': token['expiresIn'],
                 'authorization': {
                     'connectionId': request.request_context('connectionId'),
                     'activated': True,
@@ -116,31 +157,68 @@ def login(connections, data_tokens):
         },
         {
             'repository': connections,
+            'update': True,
             'item': {
                 'connectionId': connection['connectionId'],
-                'createTime': connection['createTime'],
-                'managerId': input.get('managerId', None),
-                'manager': input.get('managerId', None) is None,
+                'managerId': manager_id,
+                'manager': manager_id is None,
                 'authorized': True,
-                'claims': claims,
+                'claimsId': claims_id,
                 'expiresIn': claims['exp'],
             }
         }
     ]
 
-    if input.get('managerId', None) is not None:
+    if manager_id is not None:
         updates.append({
             'repository': connections,
-            'parent_ids': ['Manager', input['managerId']],
+            'parent_ids': ['Manager', manager_id],
             'item': {
                 'connectionId': request.request_context('connectionId'),
                 'authorized': True,
-                'claims': claims,
+                'claimsId': claims_id,
                 'expiresIn': claims['exp'],
             }
         })
 
-    Repository.batch_write(request.account_id(), updates=updates)
+    if manager_id is not None and connection.get('managerId') != manager_id:
+        updates.append({
+            'repository': connections,
+            'update': True,
+            'add': {'activeChildren': 1},
+            'condition': {'expression': 'attribute_exists(PK)'},
+            'item': {'connectionId': manager_id},
+        })
+
+    if not data_claims.is_cached(request.account_id(), claims_id):
+        updates.append({
+            'repository': data_claims,
+            'item': data_claims.make_item(claims),
+        })
+
+    # Contention is retried, and reported as a conflict the client can
+    # retry once the attempts run out. Any other cancellation on the token
+    # or the manager row means the login cannot go through.
+    for attempt in range(LOGIN_ATTEMPTS):
+        try:
+            transact_write(request.account_id(), updates=updates)
+            break
+        except TransactionConflictException as e:
+            if TRANSACTION_CONFLICT in e.reasons and set(e.reasons) <= {TRANSACTION_CONFLICT, 'None'}:
+                if attempt < LOGIN_ATTEMPTS - 1:
+                    continue
+                payload['statusCode'] = 409
+                payload['error'] = {
+                    'code': 'Conflict',
+                    'message': 'The login conflicted with another request, try again',
+                }
+                return post_to_connection()
+            if e.reasons[0] != 'None':
+                return post_access_denied('Token is not valid')
+            if CONDITION_FAILED in e.reasons:
+                return post_access_denied('Manager connection is not valid')
+            raise e
+    data_claims.remember(request.account_id(), claims)
     payload['body'] = {
         'authorized': True,
         'connectionId': request.request_context('connectionId')
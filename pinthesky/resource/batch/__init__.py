@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+from ophis.globals import request
+from ophis.router import Router
+from pinthesky import api, codec, management
+from pinthesky.resource import ROUTES
+from pinthesky.util import executor, parse_body
+
+
+logger = logging.getLogger(__name__)
+MAX_ACTIONS = int(os.getenv('BATCH_MAX_ACTIONS', '25'))
+BARRIERS = ['login']
+
+
+def lane_key(index, action):
+    """
+    Invocations of the same camera share a lane so that a session is
+    started before it is stopped. Every other action has a lane of its own.
+    """
+    if action.get('action') == 'invoke':
+        camera = action.get('payload', {}).get('camera', None)
+        if camera is not None:
+            return f'invoke:{camera}'
+    return index
+
+
+def plan(actions):
+    """
+    Splits the actions into stages run one after the other, and each stage
+    into lanes run concurrently. A barrier action like "login" changes what
+    the connection may do, so it gets a stage of its own.
+    """
+    stages = []
+    lanes = {}
+    for index, action in enumerate(actions):
+        if action.get('action') in BARRIERS:
+            if len(lanes) > 0:
+                stages.append(list(lanes.values()))
+                lanes = {}
+            stages.append([[(index, action)]])
+            continue
+        lanes.setdefault(lane_key(index, action), []).append((index, action))
+    if len(lanes) > 0:
+        stages.append(list(lanes.values()))
+    return stages
+
+
+def route_key_for(action):
+    route_key = action.get('action', None)
+    if route_key not in ROUTES or '$' in route_key or route_key == 'batch':
+        return '$default'
+    return route_key
+
+
+def fallback(route_key, request_id, status_code, error=None):
+    return json.dumps({
+        'response': {
+            'action': route_key,
+            'statusCode': status_code,
+            **({'error': error} if error is not None else {}),
+            'requestId': request_id,
+        }
+    }).encode('utf-8')
+
+
+def dispatch(index, action):
+    """
+    Replays the action as its own frame through the api router's filters
+    and routes, but not the warmup, metrics and profiling wrappers around
+    them: the batch is measured as one frame. The replies to this
+    connection are held back and returned, and an action that replied
+    with nothing, like a rate limited "$default", gets a 204 in its place.
+    """
+    event = request.event
+    route_key = route_key_for(action)
+    request_id = f'{request.request_context("requestId")}-{index}'
+    frame = {
+        **event,
+        'routeKey': route_key,
+        'body': json.dumps(action),
+        'isBase64Encoded': False,
+        'requestContext': {
+            **event['requestContext'],
+            'routeKey': route_key,
+            'requestId': request_id,
+        },
+    }
+    with management.capture(request.request_context('connectionId')) as frames:
+        try:
+            output = Router.__call__(api, frame, request.context)
+        except Exception as e:
+            logger.error(f'Failed to dispatch {route_key} in batch:', exc_info=e)
+            frames.append(fallback(route_key, action.get('requestId', request_id), 500, {
+                'code': 'InternalServerError',
+                'message': str(e),
+            }))
+            return frames
+    if len(frames) == 0:
+        status_code = output.get('statusCode', 200) if isinstance(output, dict) else 200
+        frames.append(fallback(route_key, action.get('requestId', request_id), status_code if status_code >= 400 else 204))
+    return frames
+
+
+def run_lane(lane):
+    return [(index, dispatch(index, action)) for index, action in lane]
+
+
+@api.routeKey('batch')
+def batch():
+    """
+    The "batch" action carries several actions in one frame, so that a
+    console loading a page pays for a single invocation:
+
+    {
+        "action": "batch",
+        "payload": {
+            "actions": [
+                {"action": "status", "requestId": "1"},
+                {"action": "listSessions", "requestId": "2"},
+                {
+                    "action": "invoke",
+                    "requestId": "3",
+                    "payload": {"camera": "PitsCamera1", "event": {"name": "health"}}
+                }
+            ]
+        }
+    }
+
+    Each action is handled as if it were sent on its own, and independent
+    actions run concurrently, see plan. The replies are sent back in one
+    frame as "responses", in the order of the actions, each tagged with
+    its own "requestId", with exactly one reply per action. Up to
+    BATCH_MAX_ACTIONS actions are accepted, and a "batch" cannot be nested.
+    """
+    payload = {'statusCode': 200}
+
+    @management.post()
+    def post_to_connection():
+        return payload
+
+    actions = parse_body().get('payload', {}).get('actions', None)
+    if not isinstance(actions, list) or len(actions) > MAX_ACTIONS or not all(
+            isinstance(action, dict) for action in actions):
+        payload['statusCode'] = 400
+        payload['error'] = {
+            'code': 'InvalidInput',
+            'message': f'Input payload actions must be a list of up to {MAX_ACTIONS} actions',
+        }
+        return post_to_connection()
+
+    replies = {}
+    for stage in plan(actions):
+        for lane in executor.gather(*(lambda lane=lane: run_lane(lane) for lane in stage)):
+            replies.update(lane)
+    payload['body'] = {
+        'responses': [
+            codec.loads(frame)['response']
+            for index in range(len(actions))
+            for frame in replies[index]
+        ],
+    }
+    return post_to_connection()
@@ -1,17 +1,17 @@
 import logging
-import json
 from ophis.globals import app_context, request, response
-from pinthesky.database import DataConnections
-from pinthesky.util import iterate_all_items
-from pinthesky import api, management
+from pinthesky.database import DataClaims, DataConnections
+from pinthesky.util import executor, iterate_all_items, parse_body
+from pinthesky import api, codec, management
 
 
 logger = logging.getLogger(__name__)
 app_context.inject('connections', DataConnections())
+app_context.inject('data_claims', DataClaims())
 
 
 @api.routeKey('$connect')
-def connect(connections):
+def connect(connections, data_claims):
     """
     Invoked when a connection is established. The purpose of this
     handler is to track persistent connections, their sessions, and
@@ -19,15 +19,22 @@ def connect(connections):
     information exists, it'll initate the connection as an authorized
     one. For "session" connections, it's possible to include the
     "ManagerId" as a query parameter to link to a "manager" connection.
+
+    The protocol may ask for binary frames with an encoding suffix, like
+    "manager+msgpack", see pinthesky.codec. The first protocol offered
+    with an installed encoding is accepted, and its encoding is kept on
+    the connection.
     """
-    protocol = request.headers.get('Sec-WebSocket-Protocol', None)
-    if protocol is None or protocol not in ['manager', 'session']:
+    offered = request.headers.get('Sec-WebSocket-Protocol', None)
+    negotiated = codec.negotiate(offered, ['manager', 'session'])
+    if negotiated is None:
         response.status_code = 400
         return {
             'body': {
-                'message': f'Invalid protocol: {protocol}'
+                'message': f'Invalid protocol: {offered}'
             }
         }
+    accepted, protocol, encoding = negotiated
 
     manager_id = request.headers.get(
         'ManagerId',
@@ -37,21 +44,26 @@ def connect(connections):
     expiresIn = {}
     if 'exp' in request.authorizer():
         expiresIn['expiresIn'] = request.authorizer()['exp']
+    claims_id = data_claims.store(request.account_id(), request.authorizer())
     connections.create(
         request.account_id(),
         item={
             'connectionId': connection_id,
             'managerId': manager_id,
             'manager': manager_id is None,
-            'authorized': 'sub' in request.authorizer(),
-            'claims': request.authorizer(),
+            'authorized': claims_id is not None,
+            'claimsId': claims_id,
             'managementEndpoint': f'https://{management.connection_url()}',
+            'activeSessions': 0,
+            **({'activeChildren': 0} if manager_id is None else {}),
+            **({'encoding': encoding} if encoding != 'json' else {}),
             **expiresIn,
         })
+    management.remember_encoding(connection_id, encoding)
 
     if protocol == 'manager':
         logger.info("Started a manager connection")
-        response.headers['Sec-WebSocket-Protocol'] = 'manager'
+        response.headers['Sec-WebSocket-Protocol'] = accepted
         return {'body': {'connectionId': connection_id}}
     elif protocol == 'session' and manager_id is not None:
         logger.info(f'Started a child connection on manager {manager_id}')
@@ -63,43 +75,52 @@ def connect(connections):
                 'connectionId': connection_id,
                 **expiresIn,
             })
+        connections.increment(
+            request.account_id(),
+            item_id=manager_id,
+            counters={'activeChildren': 1})
 
         @management.post(connectionId=manager_id)
         def post_child_to_manager():
             return {'body': {'connectionId': connection_id}}
 
-        response.headers['Sec-WebSocket-Protocol'] = 'session'
+        response.headers['Sec-WebSocket-Protocol'] = accepted
         post_child_to_manager()
 
 
 @api.routeKey('$disconnect')
-def disconnect(iot_data, connections, sessions):
+def disconnect(iot_data, connections, sessions, device_sessions):
     """
     Invoked when a connection is disconnected from the server,
     either forcibly or by timeout. The purpose of the handler
     is to cleanup any associated sessions or active invocations
-    established by the connection directly or indirectly.
+    established by the connection directly or indirectly. Shared
+    device sessions are only stopped when this was the last viewer.
+    Each session is stopped concurrently on the shared executor.
     """
     connection = connections.get(
         request.account_id(),
         item_id=request.request_context('connectionId'),
     )
-    if connection is not None and connection.get('managerId') is not None:
-        logger.info(f'Removing session tied to {connection["managerId"]}')
-        connections.delete(
-            request.account_id(),
-            'Manager',
-            connection['managerId'],
-            item_id=request.request_context('connectionId'),
-        )
     management.close_manager(connections)
     args = [
         request.account_id(),
         'Connections',
         request.request_context('connectionId'),
     ]
-    for session in iterate_all_items(sessions, *args):
-        sessions.delete(*args, item_id=session['invokeId'])
+
+    def stop_session(session):
+        removed = sessions.remove(*args, item_id=session['invokeId'])
+        invoke_id = session['invokeId']
+        if session.get('deviceInvokeId', None) is not None:
+            if removed is None or device_sessions.detach(
+                    request.account_id(),
+                    'Cameras',
+                    session['camera'],
+                    item_id=session['event']['name'],
+                    viewer=invoke_id) is None:
+                return removed is not None
+            invoke_id = session['deviceInvokeId']
         invoke_session = session['event'].get('session', {
             'start': False,
             'stop': True,
@@ -115,14 +136,34 @@ def disconnect(iot_data, connections, sessions):
                     'stop': True,
                 }
             },
-            invoke_id=session['invokeId'],
+            invoke_id=invoke_id,
             manager_id=connection.get('managerId', None),
             connection_id=session['connectionId'],
         )
+        return removed is not None
+
+    removed_sessions = sum(executor.map(stop_session, iterate_all_items(sessions, *args)))
+    if connection is not None and connection.get('managerId') is not None:
+        logger.info(f'Removing session tied to {connection["managerId"]}')
+        executor.gather(
+            lambda: connections.delete(
+                request.account_id(),
+                'Manager',
+                connection['managerId'],
+                item_id=request.request_context('connectionId'),
+            ),
+            lambda: connections.increment(
+                request.account_id(),
+                item_id=connection['managerId'],
+                counters={
+                    'activeChildren': -1,
+                    'childSessions': -removed_sessions,
+                }),
+        )
 
 
 @api.routeKey('status')
-def status(connections):
+def status(connections, data_claims):
     """
     The "status" action allows a connection to retreive metadata
     associated to the connection. Invoke with:
@@ -135,9 +176,13 @@ def status(connections):
     connection details. If the connectionId does not exist or is
     not in any way associated to the calling connection, a 404
     response is returned.
+
+    The connection carries "activeSessions" for its own invocations,
+    and a "manager" connection also carries "activeChildren" and
+    "childSessions" for its "session" connections.
     """
     connectionId = request.request_context('connectionId')
-    input = json.loads(request.body).get('payload', {'connectionId': connectionId})
+    input = parse_body().get('payload', {'connectionId': connectionId})
     connection = connections.get(
         request.account_id(),
         item_id=input.get('connectionId', connectionId),
@@ -156,6 +201,9 @@ def status(connections):
             'message': f'The connection {input.get("connectionId", connectionId)} is not authorized'
         }
     else:
+        claims = data_claims.resolve(request.account_id(), connection.get('claimsId'))
+        if claims is not None:
+            connection['claims'] = claims
         payload['body'] = connection
 
     @management.post()
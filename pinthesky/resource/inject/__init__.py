@@ -1,8 +1,10 @@
 import boto3
 import os
 from ophis.globals import app_context
+from pinthesky import metrics, tracing
+from pinthesky.util import LazyClient
 
-ddb = boto3.resource('dynamodb')
+ddb = LazyClient('dynamodb', lambda: tracing.instrument(metrics.instrument(boto3.resource('dynamodb'))))
 
 app_context.inject('dynamodb', ddb)
-app_context.inject('table', ddb.Table(os.getenv('TABLE_NAME', 'Pits')))
+app_context.inject('table', LazyClient('table', lambda: ddb.Table(os.getenv('TABLE_NAME', 'Pits'))))
@@ -1,26 +1,92 @@
+import base64
+import binascii
 import boto3
 import json
 import logging
 import os
-from ophis.database import Repository, QueryParams, MAX_ITEMS
+import time
+from ophis.database import ConflictException, Repository, QueryParams, MAX_ITEMS
 from ophis.globals import app_context, request
-from pinthesky import api, management
-from pinthesky.database import DataSessions
+from pinthesky import api, management, tracing
+from pinthesky.database import DataBuckets, DataDeviceSessions, DataRequests, DataSessions
+from pinthesky.util import LazyClient, RateLimiter, executor, iterate_all_items, parse_body
 from uuid import uuid4
 
 
 logger = logging.getLogger(__name__)
 DATA_ENDPOINT = f'https://{os.getenv("DATA_ENDPOINT")}'
+DEDUPE_TTL = int(os.getenv('INVOKE_DEDUPE_TTL', '60'))
+KEEPALIVE_SECONDS = int(os.getenv('KEEPALIVE_SECONDS', '3600'))
+INVOKE_RATE_LIMITS = json.loads(os.getenv('INVOKE_RATE_LIMITS', '{}'))
+SHARED_RATE_LIMITS = os.getenv('INVOKE_RATE_LIMITS_SHARED', 'false').lower() == 'true'
+limiters = {}
 
 
 app_context.inject('sessions', DataSessions())
-app_context.inject(
+app_context.inject('device_sessions', DataDeviceSessions())
+app_context.inject('data_requests', DataRequests())
+app_context.inject('data_buckets', DataBuckets())
+app_context.inject('iot_data', LazyClient(
     'iot_data',
-    boto3.client('iot-data', endpoint_url=DATA_ENDPOINT))
+    lambda: tracing.instrument(boto3.client('iot-data', endpoint_url=DATA_ENDPOINT))))
+
+
+def count_session(connections, connection, amount):
+    updates = [
+        lambda: connections.increment(
+            request.account_id(),
+            item_id=connection['connectionId'],
+            counters={'activeSessions': amount}),
+    ]
+    if connection.get('managerId') is not None:
+        updates.append(lambda: connections.increment(
+            request.account_id(),
+            item_id=connection['managerId'],
+            counters={'childSessions': amount}))
+    executor.gather(*updates)
+
+
+def is_shared(event):
+    """
+    Events listed in SHARED_SESSIONS, or all of them with "*", share one
+    device session per camera between their viewers.
+    """
+    shared = [name.strip() for name in os.getenv('SHARED_SESSIONS', '').split(',')]
+    return '*' in shared or event['name'] in shared
+
+
+def admit_invoke(data_buckets, connection_id, camera, event_name):
+    """
+    Invocations are not limited unless INVOKE_RATE_LIMITS is set, as JSON
+    mapping event names to their token bucket per connection and camera:
+
+    INVOKE_RATE_LIMITS='{"*": {"capacity": 20, "rate": 5}, "health": null}'
+
+    where "*" covers the unlisted names and null lifts the limit. Set
+    INVOKE_RATE_LIMITS_SHARED=true to also take from a bucket in the
+    table, shared by every container.
+    """
+    limit = INVOKE_RATE_LIMITS.get(event_name, INVOKE_RATE_LIMITS.get('*', None))
+    if limit is None:
+        return True
+    limiter = limiters.get(event_name, None)
+    if limiter is None:
+        limiter = limiters.setdefault(event_name, RateLimiter(limit['capacity'], limit['rate']))
+    if not limiter.admit((connection_id, camera)):
+        return False
+    if SHARED_RATE_LIMITS:
+        return data_buckets.take(
+            request.account_id(),
+            'Connections',
+            connection_id,
+            item_id=f'{camera}:{event_name}',
+            capacity=limit['capacity'],
+            rate=limit['rate'])
+    return True
 
 
 @api.routeKey('invoke')
-def invoke(iot_data, connections, sessions):
+def invoke(iot_data, connections, sessions, device_sessions, data_requests, data_buckets):
     """
     The "invoke" action is the main entrypoint for directly
     interacting with a pits-device. There are two types of
@@ -59,8 +125,27 @@ def invoke(iot_data, connections, sessions):
 
     Sessions can be closed by supplying the returned "invokeId" and "stop" flag
     on a subsequent command.
+
+    Session events listed in SHARED_SESSIONS are multiplexed: the first
+    viewer of a camera starts the device session, later viewers attach to
+    it and get its "deviceInvokeId", and the device is only told to stop
+    once the last viewer stops or disconnects.
+
+    With INVOKE_RATE_LIMITS set, starting sessions and plain events are
+    rate limited per connection and camera, see admit_invoke, and replied
+    to with a 429. Stopping a session is always admitted.
+
+    A "requestId" next to the payload makes the frame idempotent for
+    INVOKE_DEDUPE_TTL seconds: a retry with the same "requestId" gets the
+    first frame's reply body back, and nothing is created or published. A
+    retry sent while the first frame is still handled only gets its
+    "invokeId".
+    Retries are replayed before the rate limit, so they spend no tokens.
+
+    The session counters are updated while the event is published.
     """
-    input = json.loads(request.body).get('payload', {})
+    body = parse_body()
+    input = body.get('payload', {})
     connection_id = input.get('connectionId', request.request_context('connectionId'))
     payload = {'statusCode': 200}
 
@@ -125,40 +210,182 @@ def invoke(iot_data, connections, sessions):
         return post_to_connection()
 
     invoke_id = input.get('invokeId', str(uuid4()))
-    if session.get('start', False):
-        sessions.create(
-            request.account_id(),
-            'Connections',
-            connection['connectionId'],
-            item={
+    device_invoke_id = invoke_id
+    publish = True
+    counted = 0
+    payload['body'] = {'invokeId': invoke_id}
+    request_id = body.get('requestId', None)
+    dedupe_args = [request.account_id(), 'Connections', request.request_context('connectionId')]
+    claimed = False
+    if request_id is not None and DEDUPE_TTL > 0:
+        held = data_requests.claim(
+            *dedupe_args,
+            item_id=str(request_id),
+            item={'invokeId': invoke_id},
+            ttl=DEDUPE_TTL)
+        if held is not None:
+            logger.info(f'Replaying invoke for requestId {request_id}')
+            payload['body'] = held.get('body', {'invokeId': held.get('invokeId', None)})
+            return post_to_connection()
+        claimed = True
+
+    if not session.get('stop', False) and not admit_invoke(
+            data_buckets,
+            request.request_context('connectionId'),
+            input['camera'],
+            input['event']['name']):
+        if claimed:
+            data_requests.delete(*dedupe_args, item_id=str(request_id))
+        payload['statusCode'] = 429
+        payload['error'] = {
+            'code': 'TooManyRequests',
+            'message': f'Too many {input["event"]["name"]} invocations for {input["camera"]}',
+        }
+        payload.pop('body', None)
+        return post_to_connection()
+
+    try:
+        if session.get('start', False):
+            item = {
                 'invokeId': invoke_id,
                 'connectionId': connection['connectionId'],
                 'expiresIn': connection['expiresIn'],
                 'camera': input['camera'],
                 'event': input['event'],
             }
-        )
+            device_args = [request.account_id(), 'Cameras', input['camera']]
+            shared = is_shared(input['event'])
+            if shared:
+                device = device_sessions.attach(
+                    *device_args,
+                    item_id=input['event']['name'],
+                    viewer=invoke_id,
+                    invoke_id=invoke_id,
+                    expires_in=connection['expiresIn'])
+                device_invoke_id = device['invokeId']
+                publish = device_invoke_id == invoke_id
+                item['deviceInvokeId'] = device_invoke_id
+                payload['body']['deviceInvokeId'] = device_invoke_id
+                payload['body']['viewers'] = len(device['viewers'])
+            try:
+                sessions.create(
+                    request.account_id(),
+                    'Connections',
+                    connection['connectionId'],
+                    item=item
+                )
+            except ConflictException as e:
+                if shared:
+                    device_sessions.detach(*device_args, item_id=input['event']['name'], viewer=invoke_id)
+                raise e
+            counted = 1
+
+        if session.get('stop', False):
+            removed = sessions.remove(
+                request.account_id(),
+                'Connections',
+                connection['connectionId'],
+                item_id=invoke_id
+            )
+            if removed is not None:
+                counted = -1
+            if removed is not None and removed.get('deviceInvokeId', None) is not None:
+                device_invoke_id = removed['deviceInvokeId']
+                publish = device_sessions.detach(
+                    request.account_id(),
+                    'Cameras',
+                    removed['camera'],
+                    item_id=removed['event']['name'],
+                    viewer=invoke_id) is not None
+
+        calls = []
+        if counted != 0:
+            calls.append(lambda: count_session(connections, connection, counted))
+        if publish:
+            calls.append(lambda: management.publish(
+                iot_data=iot_data,
+                thing_name=input['camera'],
+                event=input['event'],
+                invoke_id=device_invoke_id,
+                manager_id=connection.get('managerId', None),
+                connection_id=connection['connectionId'],
+            ))
+        if claimed:
+            calls.append(lambda: data_requests.answer(*dedupe_args, item_id=str(request_id), body=payload['body']))
+        executor.gather(*calls)
+    except Exception as e:
+        if claimed:
+            data_requests.delete(*dedupe_args, item_id=str(request_id))
+        raise e
 
-    management.publish(
-        iot_data=iot_data,
-        thing_name=input['camera'],
-        event=input['event'],
-        invoke_id=invoke_id,
-        manager_id=connection.get('managerId', None),
-        connection_id=connection['connectionId'],
-    )
-
-    if session.get('stop', False):
-        sessions.delete(
-            request.account_id(),
-            'Connections',
-            connection['connectionId'],
-            item_id=invoke_id
-        )
+    return post_to_connection()
 
-    payload['body'] = {'invokeId': invoke_id}
 
-    return post_to_connection()
+def encode_next_token(manager_id, next_tokens):
+    if len(next_tokens) == 0:
+        return None
+    token = {'managerId': manager_id, 'tokens': next_tokens}
+    return base64.urlsafe_b64encode(json.dumps(token).encode('utf-8')).decode('utf-8')
+
+
+def decode_next_token(manager_id, next_token):
+    """
+    The composite token is bound to the manager it was issued to, and maps
+    each connection with more sessions to its own token. Returns None if
+    the token is malformed or was issued to another manager.
+    """
+    try:
+        token = json.loads(base64.urlsafe_b64decode(next_token.encode('utf-8')))
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    if not isinstance(token, dict) or token.get('managerId', None) != manager_id:
+        return None
+    next_tokens = token.get('tokens', None)
+    if not isinstance(next_tokens, dict) or not all(isinstance(token, str) for token in next_tokens.values()):
+        return None
+    return next_tokens
+
+
+def list_manager_sessions(connections, sessions, manager_id, limit, next_tokens=None):
+    """
+    Queries the session partitions of the manager and each of its "session"
+    connections on the shared executor, up to "limit" sessions per
+    connection. The first page enumerates the children, later pages only
+    query the connections left in the composite token that are still the
+    manager or one of its children.
+    """
+    account_id = request.account_id()
+    children = iterate_all_items(connections, account_id, 'Manager', manager_id)
+    owned = [manager_id, *(child['connectionId'] for child in children)]
+    if next_tokens is None:
+        next_tokens = {connection_id: None for connection_id in owned}
+    else:
+        next_tokens = {
+            connection_id: next_token
+            for connection_id, next_token in next_tokens.items()
+            if connection_id in owned
+        }
+
+    def page(connection_id, next_token):
+        return sessions.items(
+            account_id,
+            'Connections',
+            connection_id,
+            params=QueryParams(limit=limit, next_token=next_token))
+
+    pages = executor.map(page, next_tokens.keys(), next_tokens.values())
+    items = []
+    remaining = {}
+    for connection_id, resp in zip(next_tokens, pages):
+        items.extend(resp.items)
+        if resp.next_token is not None:
+            remaining[connection_id] = resp.next_token
+    return {
+        'items': items,
+        'nextToken': encode_next_token(manager_id, remaining),
+        'connectionId': manager_id,
+        'connectionIds': list(next_tokens),
+    }
 
 
 @api.routeKey("listSessions")
@@ -175,7 +402,10 @@ def list_sessions(connections, sessions):
 
     Control the number of items returned with "limit" and paginate
     with "nextToken". A "manager" connection can list its "session"
-    invokcations with "connectionId". 
+    invokcations with "connectionId", or its own and every "session"
+    connection's invocations at once with "scope": "manager". That scope
+    applies "limit" to each connection, and pages with a composite
+    "nextToken".
     """
     payload = {'statusCode': 200}
 
@@ -184,7 +414,7 @@ def list_sessions(connections, sessions):
         return payload
 
     connection_id = request.request_context('connectionId')
-    input = json.loads(request.body).get('payload', {'connectionId': connection_id})
+    input = parse_body().get('payload', {'connectionId': connection_id})
     reads = [
         {
             'repository': connections,
@@ -217,6 +447,38 @@ def list_sessions(connections, sessions):
         }
         return post_to_connection()
 
+    def invalid_input(field):
+        payload['statusCode'] = 400
+        payload['error'] = {
+            'code': 'InvalidInput',
+            'message': f'Input payload {field} is invalid'
+        }
+        return post_to_connection()
+
+    if input.get('scope', None) == 'manager':
+        if not batches[0]['manager']:
+            return invalid_input('scope')
+        next_tokens = None
+        if input.get('nextToken', None) is not None:
+            next_tokens = decode_next_token(connection_id, input['nextToken'])
+            if next_tokens is None:
+                return invalid_input('nextToken')
+        try:
+            payload['body'] = list_manager_sessions(
+                connections,
+                sessions,
+                connection_id,
+                limit=input.get('limit', MAX_ITEMS),
+                next_tokens=next_tokens)
+        except Exception as e:
+            logger.error(f'Failed to listSessions for manager {connection_id}:', exc_info=e)
+            payload['statusCode'] = 500
+            payload['error'] = {
+                'code': 'InternalServerError',
+                'message': str(e)
+            }
+        return post_to_connection()
+
     try:
         resp = sessions.items(
             request.account_id(),
@@ -244,3 +506,155 @@ def list_sessions(connections, sessions):
         }
 
     return post_to_connection()
+
+
+@api.routeKey('keepalive')
+def keepalive(iot_data, connections, sessions, device_sessions):
+    """
+    The "keepalive" action extends the "expiresIn" of a connection and its
+    sessions, which is otherwise fixed to the token's expiry when they are
+    created. They are extended to KEEPALIVE_SECONDS from now, or to an
+    earlier "expiresIn" if one is given, and never moved earlier:
+
+    {
+        "action": "keepalive",
+        "payload": {
+            "invokeIds": ["abc-123"],
+            "publish": true
+        }
+    }
+
+    Leave out "invokeIds" to extend all of the sessions. A "manager"
+    connection can extend its "session" connections' sessions with
+    "connectionId". With "publish", each camera receives one "keepalive"
+    event listing its extended sessions. The shared device sessions the
+    extended sessions are attached to are extended with them.
+    """
+    payload = {'statusCode': 200}
+
+    @management.post()
+    def post_to_connection():
+        return payload
+
+    connection_id = request.request_context('connectionId')
+    input = parse_body().get('payload', {})
+    target_id = input.get('connectionId', connection_id)
+    reads = [
+        {
+            'repository': connections,
+            'id': connection_id,
+        },
+    ]
+    if target_id != connection_id:
+        reads.append({
+            'repository': connections,
+            'id': target_id,
+        })
+    found = {
+        con['connectionId']: con
+        for con in Repository.batch_read(request.account_id(), reads=reads)
+    }
+    if connection_id not in found or target_id not in found or (
+            target_id != connection_id and
+            found[target_id].get('managerId', None) != connection_id
+    ):
+        payload['statusCode'] = 404
+        payload['error'] = {
+            'code': 'ResourceNotFound',
+            'message': f'The connection {target_id} was not found',
+        }
+        return post_to_connection()
+
+    if not found[connection_id]['authorized']:
+        payload['statusCode'] = 401
+        payload['error'] = {
+            'code': 'AccessDenied',
+            'message': f'Connection {connection_id} is not authorized'
+        }
+        return post_to_connection()
+
+    connection = found[target_id]
+    expires_in = int(time.time()) + KEEPALIVE_SECONDS
+    invoke_ids = input.get('invokeIds', None)
+    if invoke_ids is not None and not isinstance(invoke_ids, list):
+        payload['statusCode'] = 400
+        payload['error'] = {
+            'code': 'InvalidInput',
+            'message': 'Input payload invokeIds is invalid',
+        }
+        return post_to_connection()
+    if 'expiresIn' in input:
+        expires_in = min(int(input['expiresIn']), expires_in)
+
+    refreshes = [
+        lambda: connections.extend(request.account_id(), item_id=target_id, expires_in=expires_in),
+    ]
+    if connection.get('managerId', None) is not None:
+        refreshes.append(lambda: connections.extend(
+            request.account_id(),
+            'Manager',
+            connection['managerId'],
+            item_id=target_id,
+            expires_in=expires_in))
+    executor.gather(*refreshes)
+    active = [
+        session for session in iterate_all_items(sessions, request.account_id(), 'Connections', target_id)
+        if invoke_ids is None or session['invokeId'] in invoke_ids
+    ]
+    stale = [
+        session['invokeId'] for session in active
+        if session.get('expiresIn', None) is None or int(session['expiresIn']) < expires_in
+    ]
+    extended = set(sessions.extend(
+        request.account_id(),
+        'Connections',
+        target_id,
+        item_ids=stale,
+        expires_in=expires_in))
+    kept = [
+        session for session in active
+        if session['invokeId'] in extended or session['invokeId'] not in stale
+    ]
+    devices = {
+        (session['camera'], session['event']['name'])
+        for session in kept
+        if session.get('deviceInvokeId', None) is not None
+    }
+    executor.gather(*(
+        lambda camera=camera, name=name: device_sessions.extend(
+            request.account_id(),
+            'Cameras',
+            camera,
+            item_id=name,
+            expires_in=expires_in)
+        for camera, name in devices
+    ))
+
+    if input.get('publish', False):
+        cameras = {}
+        for session in kept:
+            if session.get('camera', None) is not None:
+                cameras.setdefault(session['camera'], []).append(session['invokeId'])
+        for camera, camera_invoke_ids in cameras.items():
+            management.publish(
+                iot_data=iot_data,
+                thing_name=camera,
+                event={
+                    'name': 'keepalive',
+                    'session': {
+                        'invokeIds': camera_invoke_ids,
+                        'expiresIn': expires_in,
+                    },
+                },
+                manager_id=connection.get('managerId', None),
+                connection_id=target_id,
+            )
+
+    kept_ids = [session['invokeId'] for session in kept]
+    payload['body'] = {
+        'connectionId': target_id,
+        'expiresIn': expires_in,
+        'invokeIds': kept_ids,
+        'missing': [invoke_id for invoke_id in (invoke_ids or []) if invoke_id not in kept_ids],
+    }
+    return post_to_connection()
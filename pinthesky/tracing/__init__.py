@@ -0,0 +1,162 @@
+"""
+Attributes AWS SDK latency to the routeKey that made the call. Every
+client pinthesky builds is passed through instrument(), which registers
+botocore hooks recording each operation's latency, retries and payload
+sizes. The totals live for the life of the container, and report()
+renders them as a table:
+
+    print(tracing.report())
+"""
+import json
+import threading
+import time
+from pinthesky.metrics import current
+
+
+lock = threading.Lock()
+operations = {}
+
+
+class OperationStats:
+    __slots__ = ('calls', 'errors', 'retries', 'total_ms', 'max_ms', 'request_bytes', 'response_bytes')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'totalMs': self.total_ms,
+            'meanMs': self.total_ms / self.calls if self.calls > 0 else 0,
+            'maxMs': self.max_ms,
+            'requestBytes': self.request_bytes,
+            'responseBytes': self.response_bytes,
+        }
+
+
+def payload_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return 0
+
+
+def response_size(http_response, parsed):
+    """
+    Stubbed clients never see a real HTTP body, so the size falls back
+    to the parsed response serialized as JSON.
+    """
+    content = getattr(http_response, 'content', None)
+    if isinstance(content, bytes):
+        return len(content)
+    if parsed is None:
+        return 0
+    return len(json.dumps({k: v for k, v in parsed.items() if k != 'ResponseMetadata'}, default=str))
+
+
+def record(context, error=False, retries=0, response_bytes=0):
+    start = context.pop('trace_start', None)
+    model = context.pop('trace_model', None)
+    if start is None or model is None:
+        return
+    millis = (time.perf_counter() - start) * 1000
+    invocation = current.get()
+    key = (
+        invocation.route_key if invocation is not None else None,
+        model.service_model.service_name,
+        model.name,
+    )
+    with lock:
+        stats = operations.get(key, None)
+        if stats is None:
+            stats = operations[key] = OperationStats()
+        stats.calls += 1
+        stats.errors += 1 if error else 0
+        stats.retries += retries
+        stats.total_ms += millis
+        stats.max_ms = max(stats.max_ms, millis)
+        stats.request_bytes += context.pop('trace_request_bytes', 0)
+        stats.response_bytes += response_bytes
+
+
+def before_call(model, params, context, **kwargs):
+    context['trace_start'] = time.perf_counter()
+    context['trace_model'] = model
+    context['trace_attempts'] = 0
+    context['trace_request_bytes'] = payload_size(params.get('body', None))
+
+
+def before_send(request, **kwargs):
+    context = getattr(request, 'context', None)
+    if context is not None and 'trace_attempts' in context:
+        context['trace_attempts'] += 1
+
+
+def after_call(http_response, parsed, context, **kwargs):
+    attempts = context.pop('trace_attempts', 0)
+    metadata = parsed.get('ResponseMetadata', {}) if parsed is not None else {}
+    record(
+        context,
+        error='Error' in parsed if parsed is not None else False,
+        retries=metadata.get('RetryAttempts', max(attempts - 1, 0)),
+        response_bytes=response_size(http_response, parsed))
+
+
+def after_call_error(context, **kwargs):
+    attempts = context.pop('trace_attempts', 0)
+    record(context, error=True, retries=max(attempts - 1, 0))
+
+
+def instrument(client):
+    """
+    Registers the tracing hooks on a client, or a resource's client.
+    Returns the client.
+    """
+    meta = client.meta.client.meta if hasattr(client.meta, 'client') else client.meta
+    meta.events.register_first('before-call.*.*', before_call)
+    meta.events.register('before-send.*.*', before_send)
+    meta.events.register('after-call.*.*', after_call)
+    meta.events.register('after-call-error.*.*', after_call_error)
+    return client
+
+
+def summary():
+    """
+    The recorded operations, slowest in total first.
+    """
+    with lock:
+        rows = [
+            {'routeKey': route_key, 'service': service, 'operation': operation, **stats.to_dict()}
+            for (route_key, service, operation), stats in operations.items()
+        ]
+    return sorted(rows, key=lambda row: -row['totalMs'])
+
+
+def report():
+    columns = ['routeKey', 'service', 'operation', 'calls', 'errors', 'retries',
+               'meanMs', 'maxMs', 'requestBytes', 'responseBytes']
+    lines = [columns]
+    for row in summary():
+        lines.append([
+            f'{row[column]:.2f}' if isinstance(row[column], float) else str(row[column])
+            for column in columns
+        ])
+    widths = [max(len(line[index]) for line in lines) for index in range(len(columns))]
+    return '\n'.join(
+        '  '.join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
+        for line in lines
+    )
+
+
+def reset():
+    with lock:
+        operations.clear()
@@ -1,18 +1,46 @@
-import boto3
+import base64
 import json
 import logging
 import os
-from botocore.client import ClientError
-from ophis.database import QueryParams
-from ophis.globals import request
-from ophis.router import RouterEncoder
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from ophis.globals import app_context, request
+from pinthesky import codec
+from pinthesky.metrics import phase, record_status
 from uuid import uuid4
 
 
 logger = logging.getLogger(__name__)
 
 
+parsed = ContextVar('pinthesky_parsed', default=None)
+
+
+def parse_body():
+    """
+    Parses the frame body, timed as the "parse" phase. Binary frames are
+    passed base64 encoded, and decoded with their own encoding. The result
+    is kept for the rest of the frame, so the reply's requestId lookup
+    doesn't parse and time the body again.
+    """
+    cached = parsed.get()
+    if cached is not None and cached[0] is request.body:
+        return cached[1]
+    with phase('parse'):
+        if request.event.get('isBase64Encoded', False):
+            body = codec.loads(base64.b64decode(request.body))
+        else:
+            body = json.loads(request.body)
+    parsed.set((request.body, body))
+    return body
+
+
 def iterate_all_items(repo, *args):
+    from ophis.database import QueryParams
+
     next_token = None
     truncated = True
     while truncated:
@@ -25,43 +53,313 @@ def iterate_all_items(repo, *args):
         truncated = next_token is not None
 
 
+class LazyClient:
+    """
+    Holds a factory in the app_context in place of an AWS client. The
+    client is built on first access, its construction time is logged
+    once, and it is memoized for the rest of the warm container.
+    Attribute access is forwarded to the built client:
+
+    app_context.inject('iot_data', LazyClient('iot_data', lambda: boto3.client('iot-data')))
+    """
+    def __init__(self, name, factory) -> None:
+        self.__name = name
+        self.__factory = factory
+        self.__instance = None
+        self.__lock = threading.Lock()
+
+    def is_resolved(self):
+        return self.__instance is not None
+
+    def resolve(self):
+        if self.__instance is None:
+            with self.__lock:
+                if self.__instance is None:
+                    start = time.perf_counter()
+                    self.__instance = self.__factory()
+                    elapsed = (time.perf_counter() - start) * 1000
+                    logger.info(f'Constructed {self.__name} in {elapsed:.2f}ms')
+        return self.__instance
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+class TokenBucket:
+    """
+    Holds up to "capacity" tokens, refilled at "rate" tokens per second.
+    """
+    def __init__(self, capacity, rate, clock=time.monotonic) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def take(self, amount=1):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by something like a connection id, kept for the
+    life of the container. The least recently used keys are dropped once
+    there are more than "max_keys" buckets.
+    """
+    def __init__(self, capacity, rate, max_keys=10000, clock=time.monotonic) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def admit(self, key, amount=1):
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.capacity, self.rate, clock=self.clock)
+            self.buckets[key] = bucket
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return bucket.take(amount)
+
+
+class ContextExecutor:
+    """
+    A bounded thread pool shared by the warm container, for overlapping a
+    handler's independent I/O. Each callable runs in a copy of the
+    submitting context, so request and app_context resolve in the worker
+    as they do in the handler:
+
+    connection, manager = executor.gather(
+        lambda: connections.get(account_id, item_id=connection_id),
+        lambda: connections.get(account_id, item_id=manager_id))
+
+    Calls submitted from a worker run inline rather than waiting on the
+    pool they hold a thread of, and with fewer than two workers every
+    call runs inline.
+    """
+    def __init__(self, max_workers) -> None:
+        self.max_workers = max_workers
+        self.pool = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def is_worker(self):
+        return getattr(self.local, 'worker', False)
+
+    def mark_worker(self):
+        self.local.worker = True
+
+    def resolve(self):
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    from concurrent.futures import ThreadPoolExecutor
+
+                    self.pool = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='pinthesky',
+                        initializer=self.mark_worker)
+        return self.pool
+
+    def submit(self, func, *args, **kwargs):
+        if self.max_workers < 2 or self.is_worker():
+            from concurrent.futures import Future
+
+            future = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self.resolve().submit(copy_context().run, func, *args, **kwargs)
+
+    def gather(self, *calls):
+        """
+        Runs the callables concurrently, the first one on the calling
+        thread, and returns their results in order. Every call finishes
+        before the first exception raised is re-raised.
+        """
+        if len(calls) == 0:
+            return []
+        futures = [self.submit(call) for call in calls[1:]]
+        results = []
+        error = None
+        try:
+            results.append(calls[0]())
+        except Exception as e:
+            error = e
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+    def map(self, func, *iterables):
+        return self.gather(*(
+            (lambda values=values: func(*values))
+            for values in zip(*iterables)
+        ))
+
+
+executor = ContextExecutor(max_workers=int(os.getenv('EXECUTOR_MAX_WORKERS', '8')))
+
+
+class CapturedClient:
+    """
+    Stands in for a management client while replies are captured: frames
+    posted to the captured connection are appended to "frames", and every
+    other call goes to the real client.
+    """
+    def __init__(self, client, connection_id, frames) -> None:
+        self.client = client
+        self.connection_id = connection_id
+        self.frames = frames
+
+    def post_to_connection(self, ConnectionId, Data):
+        if ConnectionId != self.connection_id:
+            return self.client.post_to_connection(ConnectionId=ConnectionId, Data=Data)
+        self.frames.append(Data)
+        return {}
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
 class ManagementWrapper:
 
+    def __init__(self, max_encodings=10000) -> None:
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.captured = ContextVar('pinthesky_captured', default=None)
+        self.encodings = OrderedDict()
+        self.max_encodings = max_encodings
+
+    def remember_encoding(self, connection_id, encoding):
+        with self.lock:
+            self.encodings[connection_id] = encoding
+            while len(self.encodings) > self.max_encodings:
+                self.encodings.popitem(last=False)
+
+    def connection_encoding(self, connection_id):
+        """
+        The encoding negotiated in "$connect" and stored on the connection
+        row. It never changes, so it is read once per container. A missing
+        row is sent JSON.
+        """
+        encoding = self.encodings.get(connection_id, None)
+        if encoding is not None:
+            return encoding
+        connections = app_context.resolve().get('connections', None)
+        if connections is None:
+            return 'json'
+        connection = connections.get(request.account_id(), item_id=connection_id)
+        if connection is None:
+            return 'json'
+        encoding = connection.get('encoding', 'json')
+        self.remember_encoding(connection_id, encoding)
+        return encoding
+
+    @contextmanager
+    def capture(self, connection_id):
+        """
+        Holds back the frames posted to connection_id in the current
+        context, yielding the list they are collected in:
+
+        with management.capture(connection_id) as frames:
+            api(event, context)
+        """
+        frames = []
+        token = self.captured.set((connection_id, frames))
+        try:
+            yield frames
+        finally:
+            self.captured.reset(token)
+
     def connection_url(self):
         override = os.getenv('SERVICE_DOMAIN')
         return override if override != '' else f'{request.request_context("domainName")}/{request.request_context("stage")}'
 
-    def client(self):
-        return boto3.client(
-            'apigatewaymanagementapi',
-            endpoint_url=f'https://{self.connection_url()}',
-        )
+    def client(self, endpoint_url=None):
+        """
+        Management clients are pooled by endpoint, so a warm container only
+        builds one per domain and stage.
+        """
+        if endpoint_url is None:
+            endpoint_url = f'https://{self.connection_url()}'
+        client = self.clients.get(endpoint_url, None)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(endpoint_url, None)
+                if client is None:
+                    import boto3
+                    from pinthesky import tracing
+
+                    client = tracing.instrument(boto3.client(
+                        'apigatewaymanagementapi',
+                        endpoint_url=endpoint_url,
+                    ))
+                    self.clients[endpoint_url] = client
+        captured = self.captured.get()
+        if captured is not None:
+            return CapturedClient(client, *captured)
+        return client
+
+    def request_id(self):
+        request_id = request.request_context("requestId")
+        try:
+            request_id = parse_body().get("requestId", request_id)
+        except Exception as e:
+            logger.warning(
+                "Failed to parse input for request ID:",
+                exc_info=e
+            )
+        return request_id
 
     def publish(self, iot_data, thing_name, event, invoke_id=None, manager_id=None, connection_id=None):
         session_id = invoke_id if invoke_id is not None else str(uuid4())
         con_id = connection_id if connection_id is not None else request.request_context('connectionId')
-        iot_data.publish(
-            topic=f'pinthesky/events/{thing_name}/input',
-            payload=json.dumps({
-                'name': event['name'],
-                'context': {
-                    **event.get('context', {}),
-                    'session': event.get('session', {
-                        'start': False,
-                        'stop': False,
-                    }),
-                    'connection': {
-                        'id': con_id,
-                        'manager_id': manager_id,
-                        'management_endpoint': f'https://{self.connection_url()}',
-                        'invoke_id': session_id
-                    }
+        payload = json.dumps({
+            'name': event['name'],
+            'context': {
+                **event.get('context', {}),
+                'session': event.get('session', {
+                    'start': False,
+                    'stop': False,
+                }),
+                'connection': {
+                    'id': con_id,
+                    'manager_id': manager_id,
+                    'management_endpoint': f'https://{self.connection_url()}',
+                    'invoke_id': session_id
                 }
-            }).encode('utf-8')
-        )
+            }
+        }).encode('utf-8')
+        with phase('publish'):
+            iot_data.publish(
+                topic=f'pinthesky/events/{thing_name}/input',
+                payload=payload,
+            )
         return session_id
 
-    def post(self, connectionId=None):
+    def post(self, connectionId=None, encoding=None):
+        """
+        Posts the returned payload as the reply to the frame. Without an
+        encoding, the reply is encoded in the one the receiving connection
+        negotiated, see connection_encoding.
+        """
         def inner(func):
 
             # TODO: fix the wrapper
@@ -73,14 +371,7 @@ class ManagementWrapper:
                     'statusCode': 200,
                 }
                 try:
-                    requestId = request.request_context("requestId")
-                    try:
-                        requestId = json.loads(request.body).get("requestId", requestId)
-                    except Exception as e:
-                        logger.warning(
-                            "Failed to parse input for request ID:",
-                            exc_info=e
-                        )
+                    requestId = self.request_id()
                     payload = func(*args, **kwargs)
                     template = {**template, **payload, 'requestId': requestId}
                 except Exception as e:
@@ -91,23 +382,29 @@ class ManagementWrapper:
                         'message': str(e),
                     }
 
-                management.post_to_connection(
-                    ConnectionId=conId,
-                    Data=json.dumps({'response': template}, cls=RouterEncoder).encode('utf-8'),
-                )
+                reply_encoding = encoding
+                if reply_encoding is None:
+                    reply_encoding = self.connection_encoding(conId)
+                data = codec.dumps({'response': template}, reply_encoding)
+                record_status(template['statusCode'])
+                with phase('post'):
+                    management.post_to_connection(ConnectionId=conId, Data=data)
 
             return wrapper
 
         return inner
 
     def close_manager(self, connections):
+        from botocore.client import ClientError
+
         client = self.client()
         args = [
             request.account_id(),
             'Manager',
             request.request_context('connectionId'),
         ]
-        for connection in iterate_all_items(connections, *args):
+
+        def delete_connection(connection):
             try:
                 client.delete_connection(
                     ConnectionId=connection['connectionId']
@@ -117,6 +414,8 @@ class ManagementWrapper:
                     f'Failed to delete connection {connection["connectionId"]}',
                     exc_info=e
                 )
+
+        executor.map(delete_connection, iterate_all_items(connections, *args))
         connections.delete(
             request.account_id(),
             item_id=request.request_context('connectionId')
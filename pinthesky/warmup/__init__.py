@@ -0,0 +1,105 @@
+"""
+Warmup frames prime a container after a deploy or scale-out, so that
+real frames don't pay for imports, client construction or the JWKS
+fetch. A scheduled event, or an invoke with {"action": "$warmup"}, is
+recognized before any filter or route runs. Extra management domains
+can be listed with {"detail": {"domains": [...]}} alongside SERVICE_DOMAIN.
+"""
+import json
+import logging
+import os
+import time
+from ophis.globals import app_context
+from ophis.router import Router
+
+
+logger = logging.getLogger(__name__)
+WARMUP = '$warmup'
+
+
+def is_warmup(event):
+    if not isinstance(event, dict):
+        return False
+    if event.get('source') == 'aws.events':
+        return True
+    return event.get('action') == WARMUP
+
+
+def load_routes(route_keys):
+    from pinthesky.resource import load_all_routes, load_route
+
+    if route_keys is None:
+        load_all_routes()
+    else:
+        for route_key in route_keys:
+            load_route(route_key)
+
+
+def warm_management(domains):
+    from pinthesky import management
+
+    for domain in domains:
+        management.client(endpoint_url=f'https://{domain}')
+
+
+def warm_keys():
+    from pinthesky.auth import JWTAuthorizer
+
+    for key in JWTAuthorizer.cached_keys(os.getenv('USER_POOL_ID')):
+        JWTAuthorizer.public_key(key)
+
+
+def warmup(event, route_keys=None):
+    """
+    Runs each step in order, timing them individually. A failed step is
+    logged and reported without stopping the steps after it. Every route
+    is loaded unless route_keys limits them.
+    """
+    from pinthesky.util import LazyClient
+
+    steps = {}
+
+    def run_step(name, func, *args):
+        start = time.perf_counter()
+        try:
+            func(*args)
+            steps[name] = {'status': 'ok'}
+        except Exception as e:
+            logger.error(f'Failed to warm {name}:', exc_info=e)
+            steps[name] = {'status': 'failed', 'error': str(e)}
+        steps[name]['ms'] = (time.perf_counter() - start) * 1000
+
+    run_step('routes', load_routes, route_keys)
+    for name, value in app_context.resolve('GLOBAL').items():
+        if isinstance(value, LazyClient):
+            run_step(name, value.resolve)
+    domains = list(event.get('detail', {}).get('domains', []))
+    if os.getenv('SERVICE_DOMAIN', '') not in ['', *domains]:
+        domains.append(os.getenv('SERVICE_DOMAIN'))
+    if len(domains) > 0:
+        run_step('management', warm_management, domains)
+    if os.getenv('USER_POOL_ID', '') != '':
+        run_step('jwks', warm_keys)
+    timings = [f'{name} in {step["ms"]:.2f}ms' for name, step in steps.items()]
+    logger.info(f'Warmed {", ".join(timings)}')
+    return steps
+
+
+class WarmupRouter(Router):
+    """
+    A Router that answers warmup frames itself, as they do not carry a
+    requestContext for the filters and routes to match on. Slim entry
+    points set "route_keys" so a warmup only loads their own routes.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.route_keys = None
+
+    def __call__(self, event, context):
+        if is_warmup(event):
+            return {
+                'statusCode': 200,
+                'headers': {'content-type': 'application/json'},
+                'body': json.dumps({'steps': warmup(event, route_keys=self.route_keys)}),
+            }
+        return super().__call__(event, context)
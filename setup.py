@@ -34,10 +34,16 @@ setup(
         "python-jose",
         "requests",
     ],
-    extra_require={
+    extras_require={
         'test': [
             'pytest',
             'requests-mock'
+        ],
+        'msgpack': [
+            'msgpack'
+        ],
+        'cbor': [
+            'cbor2'
         ]
     }
 )
@@ -1,5 +1,7 @@
 from collections import namedtuple
 from ophis.globals import app_context
+from pinthesky.local.database import MemoryDynamoDB
+import os
 import pytest
 import boto3
 import subprocess
@@ -25,8 +27,31 @@ def dynamodb_local():
     proc.kill()
 
 
+@pytest.fixture(autouse=True)
+def jwks_cache():
+    from pinthesky import auth
+
+    auth.known_keys.clear()
+    auth.public_keys.clear()
+    yield
+    auth.known_keys.clear()
+    auth.public_keys.clear()
+
+
+@pytest.fixture(scope="session")
+def dynamodb_memory():
+    return MemoryDynamoDB()
+
+
 @pytest.fixture(scope="module")
-def dynamodb(dynamodb_local):
+def dynamodb(request):
+    """
+    Runs against the in-memory tables, unless DYNAMODB_BACKEND=local
+    boots DynamoDB Local, which needs Java and ./dev.pull-dynamodb.sh.
+    """
+    if os.getenv('DYNAMODB_BACKEND', 'memory') == 'memory':
+        return request.getfixturevalue('dynamodb_memory')
+    dynamodb_local = request.getfixturevalue('dynamodb_local')
     return boto3.resource(
         'dynamodb',
         region_name="us-east-1",
@@ -100,3 +125,4 @@ def table(dynamodb):
     yield table
     app_context.remove('dynamodb')
     app_context.remove('table')
+    table.delete()
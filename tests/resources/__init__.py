@@ -1,5 +1,6 @@
 from pinthesky import api
 from collections import namedtuple
+from functools import lru_cache
 from string import Template
 import json
 
@@ -7,6 +8,44 @@ Response = namedtuple('Response', field_names=['code', 'body', 'headers'])
 Context = namedtuple('Context', field_names=['invoked_function_arn'])
 
 
+@lru_cache
+def read_template(path='events/resources/request.template.json'):
+    with open(path) as f:
+        return json.loads(Template(f.read()).safe_substitute(body='""'))
+
+
+def make_event(path,
+               method="GET",
+               query_params={},
+               body=None,
+               routeKey="$default",
+               connectionId="$connectionId",
+               headers={},
+               authoizer={}):
+    """
+    Builds a request event from the template, which is only read and
+    parsed once, so that callers measuring handlers aren't measuring disk.
+    """
+    template = read_template()
+    request_context = template['requestContext']
+    return {
+        **template,
+        'routeKey': routeKey,
+        'rawPath': path,
+        'headers': headers,
+        'queryStringParameters': query_params,
+        'requestContext': {
+            **request_context,
+            'connectionId': connectionId,
+            'authorizer': authoizer,
+            'http': {**request_context['http'], 'method': method, 'path': path},
+            'routeKey': routeKey,
+            'stage': routeKey,
+        },
+        'body': json.dumps(body) if body is not None else "",
+    }
+
+
 class Resources():
     def __init__(self, module) -> None:
         self.module = module
@@ -15,29 +54,8 @@ class Resources():
     def __call__(self, *args, **kwds):
         return self.request('/'.join(args), **kwds)
 
-    def __read_event(self,
-                     path,
-                     method="GET",
-                     query_params={},
-                     body=None,
-                     routeKey="$default",
-                     connectionId="$connectionId",
-                     headers={},
-                     authoizer={}):
-        with open('events/resources/request.template.json') as f:
-            content = f.read()
-            template = Template(content)
-            event = json.loads(template.safe_substitute(
-                connectionId=connectionId,
-                routeKey=routeKey,
-                path=path,
-                method=method,
-                body=json.dumps(json.dumps(body)) if body is not None else '""'
-            ))
-            event['headers'] = headers
-            event['queryStringParameters'] = query_params
-            event['requestContext']['authorizer'] = authoizer
-        return event
+    def __read_event(self, path, **kwargs):
+        return make_event(path, **kwargs)
 
     def account_id(self):
         event = self.__read_event("/")
@@ -1,9 +1,19 @@
 import pytest
 from ophis.globals import app_context
+from pinthesky import management
 from resources import Resources
 from unittest.mock import MagicMock
 
 
+@pytest.fixture(autouse=True)
+def management_clients():
+    management.clients.clear()
+    management.encodings.clear()
+    yield
+    management.clients.clear()
+    management.encodings.clear()
+
+
 @pytest.fixture(scope="module")
 def connections(table):
     iot_data = MagicMock()
@@ -32,3 +42,14 @@ def auth(table):
     from pinthesky.resource import auth
 
     return Resources(auth)
+
+
+@pytest.fixture(scope="module")
+def batch(table):
+    iot_data = MagicMock()
+    app_context.inject('iot_data', iot_data, force=True)
+
+    assert table.name == 'Pits'
+    from pinthesky.resource import batch
+
+    return Resources(batch)
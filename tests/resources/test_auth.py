@@ -1,6 +1,8 @@
 import boto3
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from ophis.globals import app_context
 from requests import exceptions
 from unittest.mock import patch, MagicMock
@@ -320,3 +322,195 @@ def test_login_token_through_manager(requests_mock, auth):
     updated_connection = connections.get('123456789012', item_id=connectionId)
     assert updated_connection['managerId'] == managerId
     assert not updated_connection['manager']
+    assert 'claims' not in updated_connection
+    child = connections.get('123456789012', 'Manager', managerId, item_id=connectionId)
+    assert child['claimsId'] == updated_connection['claimsId']
+    claims = app_context.resolve()['data_claims']
+    assert claims.resolve('123456789012', child['claimsId'])['sub'] == '98498077-4c1d-4ffb-ab3d-8532dce5db4d'
+    assert connections.get('123456789012', item_id=managerId)['activeChildren'] == 1
+
+
+@patch('time.time', MagicMock(return_value=1711747711))
+def test_login_token_concurrent_activation(requests_mock, auth):
+    requests_mock.get(ENDPOINT, json=FAKE_KEYS)
+    os.environ['AWS_REGION'] = 'us-east-2'
+    os.environ['USER_POOL_ID'] = 'efg-456'
+    os.environ['USER_CLIENT_ID'] = '27pk3aoia2l347oq7si0v8j3mb'
+
+    connections = app_context.resolve()['connections']
+    connectionIds = [str(uuid4()) for _ in range(10)]
+    for connectionId in connectionIds:
+        connections.create(
+            '123456789012',
+            item={
+                'connectionId': connectionId,
+                'authorized': False,
+            }
+        )
+
+    tokenId = str(uuid4())
+    tokens = app_context.resolve()['data_tokens']
+    tokens.create(
+        '123456789012',
+        item={
+            'id': tokenId,
+            'expiresIn': False,
+            'authorization': {
+                'activated': False,
+            }
+        }
+    )
+
+    responses = {}
+
+    def post_to_connection(ConnectionId, Data):
+        responses[ConnectionId] = json.loads(Data.decode('utf-8'))['response']
+
+    def login(connectionId):
+        auth(routeKey="login", connectionId=connectionId, body={
+            'payload': {
+                'tokenId': tokenId,
+                'jwtId': FAKE_TOKEN,
+            }
+        })
+
+    management = MagicMock()
+    management.post_to_connection = post_to_connection
+    with patch.object(boto3, 'client', return_value=management):
+        with ThreadPoolExecutor(max_workers=len(connectionIds)) as executor:
+            futures = [
+                executor.submit(copy_context().run, login, connectionId)
+                for connectionId in connectionIds
+            ]
+            for future in futures:
+                future.result()
+
+    assert len(responses) == len(connectionIds)
+    winners = [
+        connectionId for connectionId, response in responses.items()
+        if response['statusCode'] == 200
+    ]
+    assert len(winners) == 1
+    for connectionId, response in responses.items():
+        if connectionId not in winners:
+            assert response['error']['message'] == 'Token is not valid'
+            assert not connections.get('123456789012', item_id=connectionId)['authorized']
+    updated_token = tokens.get('123456789012', item_id=tokenId)
+    assert updated_token['authorization'] == {
+        'connectionId': winners[0],
+        'activated': True
+    }
+    assert connections.get('123456789012', item_id=winners[0])['authorized']
+
+
+@patch('time.time', MagicMock(return_value=1711747711))
+def test_login_token_transaction_conflict(requests_mock, auth, monkeypatch):
+    from pinthesky.database import TransactionConflictException
+    from pinthesky.resource import auth as auth_module
+
+    requests_mock.get(ENDPOINT, json=FAKE_KEYS)
+    os.environ['AWS_REGION'] = 'us-east-2'
+    os.environ['USER_POOL_ID'] = 'efg-456'
+    os.environ['USER_CLIENT_ID'] = '27pk3aoia2l347oq7si0v8j3mb'
+
+    connections = app_context.resolve()['connections']
+    tokens = app_context.resolve()['data_tokens']
+    transact_write = auth_module.transact_write
+    conflicts = []
+
+    def contended(*args, updates, **kwargs):
+        if len(conflicts) > 0:
+            raise TransactionConflictException([conflicts.pop()] + ['None'] * (len(updates) - 1))
+        return transact_write(*args, updates=updates, **kwargs)
+
+    def login(attempts_conflicted, reason='TransactionConflict'):
+        connectionId = str(uuid4())
+        connections.create('123456789012', item={'connectionId': connectionId, 'authorized': False})
+        tokenId = str(uuid4())
+        tokens.create('123456789012', item={
+            'id': tokenId,
+            'expiresIn': False,
+            'authorization': {'activated': False},
+        })
+        conflicts.extend([reason] * attempts_conflicted)
+        auth(routeKey="login", connectionId=connectionId, body={
+            'payload': {'tokenId': tokenId, 'jwtId': FAKE_TOKEN},
+        })
+        conflicts.clear()
+        return replies[-1]
+
+    replies = []
+    monkeypatch.setattr(auth_module, 'transact_write', contended)
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data)['response'])
+    with patch.object(boto3, 'client', return_value=management):
+        assert login(2)['statusCode'] == 200
+        conflicted = login(3)
+        denied = login(1, reason='ConditionalCheckFailed')
+
+    assert conflicted['statusCode'] == 409
+    assert conflicted['error']['code'] == 'Conflict'
+    assert denied['statusCode'] == 401
+    assert denied['error']['message'] == 'Token is not valid'
+
+
+def test_login_token_own_manager(auth):
+    connectionId = str(uuid4())
+    connections = app_context.resolve()['connections']
+    connections.create('123456789012', item={'connectionId': connectionId, 'authorized': False})
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append((ConnectionId, json.loads(Data)))
+    with patch.object(boto3, 'client', return_value=management):
+        auth(routeKey="login", connectionId=connectionId, body={
+            'payload': {'tokenId': 'abc-123', 'jwtId': FAKE_TOKEN, 'managerId': connectionId},
+        })
+
+    assert replies[0][0] == connectionId
+    assert replies[0][1]['response']['statusCode'] == 400
+    assert replies[0][1]['response']['error']['message'] == 'Input payload managerId is invalid'
+
+
+@patch('time.time', MagicMock(return_value=1711747711))
+def test_login_token_other_manager(requests_mock, auth, connections):
+    requests_mock.get(ENDPOINT, json=FAKE_KEYS)
+    os.environ['AWS_REGION'] = 'us-east-2'
+    os.environ['USER_POOL_ID'] = 'efg-456'
+    os.environ['USER_CLIENT_ID'] = '27pk3aoia2l347oq7si0v8j3mb'
+
+    rows = app_context.resolve()['connections']
+    managers = [str(uuid4()), str(uuid4())]
+    for managerId in managers:
+        rows.create('123456789012', item={
+            'connectionId': managerId,
+            'authorized': True,
+            'manager': True,
+            'activeChildren': 0,
+        })
+    connectionId = str(uuid4())
+    tokenId = str(uuid4())
+    app_context.resolve()['data_tokens'].create('123456789012', item={
+        'id': tokenId,
+        'expiresIn': False,
+        'authorization': {'activated': False},
+    })
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append((ConnectionId, json.loads(Data)))
+    with patch.object(boto3, 'client', return_value=management):
+        connections(routeKey="$connect", connectionId=connectionId, headers={
+            'ManagerId': managers[0],
+            'Sec-WebSocket-Protocol': 'session',
+        })
+        auth(routeKey="login", connectionId=connectionId, body={
+            'payload': {'managerId': managers[1], 'tokenId': tokenId, 'jwtId': FAKE_TOKEN},
+        })
+        assert [rows.get('123456789012', item_id=managerId)['activeChildren'] for managerId in managers] == [1, 0]
+        connections(routeKey="$disconnect", connectionId=connectionId)
+
+    assert replies[-1][0] == connectionId
+    assert replies[-1][1]['response']['statusCode'] == 400
+    assert [rows.get('123456789012', item_id=managerId)['activeChildren'] for managerId in managers] == [0, 0]
+    assert rows.get('123456789012', 'Manager', managers[1], item_id=connectionId) is None
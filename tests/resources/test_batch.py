@@ -0,0 +1,130 @@
+import boto3
+import json
+import time
+from math import floor
+from ophis.globals import app_context
+from pinthesky.resource.batch import plan
+from unittest.mock import MagicMock, patch
+from uuid import uuid4
+
+
+def test_plan_lanes():
+    actions = [
+        {'action': 'status'},
+        {'action': 'invoke', 'payload': {'camera': 'PitsCamera1'}},
+        {'action': 'invoke', 'payload': {'camera': 'PitsCamera2'}},
+        {'action': 'invoke', 'payload': {'camera': 'PitsCamera1'}},
+        {'action': 'login'},
+        {'action': 'listSessions'},
+    ]
+    stages = [
+        [[index for index, _ in lane] for lane in stage]
+        for stage in plan(actions)
+    ]
+    assert stages == [[[0], [1, 3], [2]], [[4]], [[5]]]
+
+
+def test_batch(batch):
+    connectionId = str(uuid4())
+    connections = app_context.resolve()['connections']
+    connections.create('123456789012', item={
+        'connectionId': connectionId,
+        'expiresIn': floor(time.time()) + 60 * 1000,
+        'authorized': True,
+        'manager': True,
+    })
+
+    replies = []
+    iot_data = app_context.resolve()['iot_data']
+    iot_data.reset_mock()
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append((ConnectionId, json.loads(Data)))
+    record = {'name': 'record', 'session': {'start': True}}
+    with patch.object(boto3, 'client', return_value=management):
+        batch(routeKey="batch", connectionId=connectionId, body={
+            'requestId': 'page',
+            'payload': {
+                'actions': [
+                    {'action': 'status', 'requestId': 'a'},
+                    {
+                        'action': 'invoke',
+                        'requestId': 'b',
+                        'payload': {'camera': 'PitsCamera1', 'invokeId': 'session-1', 'event': record},
+                    },
+                    {
+                        'action': 'invoke',
+                        'requestId': 'c',
+                        'payload': {'camera': 'PitsCamera2', 'event': {'name': 'health'}},
+                    },
+                    {
+                        'action': 'invoke',
+                        'requestId': 'd',
+                        'payload': {
+                            'camera': 'PitsCamera1',
+                            'invokeId': 'session-1',
+                            'event': {'name': 'record', 'session': {'stop': True}},
+                        },
+                    },
+                    {'action': 'whoops', 'requestId': 'e'},
+                    {'action': 'batch', 'requestId': 'f'},
+                ]
+            }
+        })
+        assert len(replies) == 1
+        batch(routeKey="batch", connectionId=connectionId, body={'payload': {'actions': 'status'}})
+
+    reply_to, reply = replies[0]
+    assert reply_to == connectionId
+    assert reply['response']['action'] == 'batch'
+    assert reply['response']['requestId'] == 'page'
+    responses = reply['response']['body']['responses']
+    assert [response['requestId'] for response in responses] == ['a', 'b', 'c', 'd', 'e', 'f']
+    assert [response['action'] for response in responses] == [
+        'status', 'invoke', 'invoke', 'invoke', '$default', '$default',
+    ]
+    assert [response['statusCode'] for response in responses] == [200, 200, 200, 200, 404, 404]
+    assert responses[0]['body']['connectionId'] == connectionId
+    assert responses[1]['body'] == {'invokeId': 'session-1'}
+    sessions = app_context.resolve()['sessions']
+    assert sessions.get('123456789012', 'Connections', connectionId, item_id='session-1') is None
+    assert connections.get('123456789012', item_id=connectionId)['activeSessions'] == 0
+    assert iot_data.publish.call_count == 3
+    assert replies[1][1]['response']['statusCode'] == 400
+
+
+def test_batch_replies_once_per_action(batch, monkeypatch):
+    import pinthesky.resource
+    from pinthesky import metrics
+    from pinthesky.util import RateLimiter
+
+    connectionId = str(uuid4())
+    app_context.resolve()['connections'].create('123456789012', item={
+        'connectionId': connectionId,
+        'authorized': True,
+        'manager': True,
+    })
+    monkeypatch.setattr(pinthesky.resource, 'unknown_actions', RateLimiter(capacity=5, rate=0.1))
+    emitted = []
+    monkeypatch.setattr(metrics, 'emit', lambda invocation: emitted.append(invocation.route_key))
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data))
+    with patch.object(boto3, 'client', return_value=management):
+        batch(routeKey="batch", connectionId=connectionId, body={
+            'payload': {
+                'actions': [
+                    *({'action': 'whoops', 'requestId': f'unknown-{index}'} for index in range(8)),
+                    {'action': 'status', 'requestId': 'status'},
+                ],
+            }
+        })
+
+    assert emitted == ['batch']
+    assert len(replies) == 1
+    responses = replies[0]['response']['body']['responses']
+    assert [response['requestId'] for response in responses] == [
+        *(f'unknown-{index}' for index in range(8)), 'status',
+    ]
+    assert sorted(response['statusCode'] for response in responses[:8]) == [204] * 3 + [404] * 5
+    assert responses[8]['statusCode'] == 200
@@ -42,6 +42,8 @@ def test_default(connections):
                         'invoke',
                         'listSessions',
                         'login',
+                        'keepalive',
+                        'batch',
                     ]
                 },
                 'requestId': 'id',
@@ -56,6 +58,25 @@ def test_default(connections):
     mock_client.assert_called_once()
 
 
+def test_default_is_rate_limited(connections, monkeypatch):
+    import pinthesky.resource
+    from pinthesky.util import RateLimiter
+
+    unknown_actions = RateLimiter(capacity=5, rate=0.1)
+    monkeypatch.setattr(pinthesky.resource, 'unknown_actions', unknown_actions)
+    posted = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: posted.append(ConnectionId)
+    with patch.object(boto3, 'client', return_value=management) as mock_client:
+        for _ in range(unknown_actions.capacity + 3):
+            connections(routeKey="$default", connectionId='spammy-id')
+        connections(routeKey="$default", connectionId='polite-id')
+
+    mock_client.assert_called_once()
+    assert posted.count('spammy-id') == unknown_actions.capacity
+    assert posted.count('polite-id') == 1
+
+
 def test_connect_invalid(connections):
     resp = connections(routeKey="$connect")
     assert resp.code == 400
@@ -83,6 +104,13 @@ def test_connect(connections):
     )
     assert connect['authorized']
     assert connect['expiresIn'] == exp
+    assert 'claims' not in connect
+    assert connect['claimsId'] == f'98498077-4c1d-4ffb-ab3d-8532dce5db4d:{exp}'
+
+    claimsDb = app_context.resolve()['data_claims']
+    stored = claimsDb.get('123456789012', item_id=connect['claimsId'])
+    assert stored['claims']['sub'] == '98498077-4c1d-4ffb-ab3d-8532dce5db4d'
+    assert stored['expiresIn'] == exp
 
 
 def test_connect_session(connections):
@@ -109,6 +137,10 @@ def test_connect_session(connections):
         })
 
     mock_client.assert_called_once()
+    connectDb = app_context.resolve()['connections']
+    manager = connectDb.get('123456789012', item_id='$connectionId')
+    assert manager['activeChildren'] == 1
+    assert connectDb.get('123456789012', item_id='abc-123')['activeSessions'] == 0
 
 
 def test_disconnect_session(connections):
@@ -118,6 +150,10 @@ def test_disconnect_session(connections):
         connections(routeKey="$disconnect", connectionId="abc-123")
 
     mock_client.assert_called_once()
+    connectDb = app_context.resolve()['connections']
+    manager = connectDb.get('123456789012', item_id='$connectionId')
+    assert manager['activeChildren'] == 0
+    assert manager['childSessions'] == 0
 
 
 def test_status_not_found(connections):
@@ -207,3 +243,108 @@ def test_status_happy_path(connections):
         })
 
     mock_client.assert_called_once()
+
+
+def test_status_resolves_claims(connections):
+    exp = floor(time.time()) + 60 * 1000
+    claims = {
+        'sub': 'cached-subject',
+        'exp': exp,
+    }
+    claimsDb = app_context.resolve()['data_claims']
+    claimsId = claimsDb.store(connections.account_id(), claims)
+    assert claimsDb.store(connections.account_id(), claims) == claimsId
+
+    connectionDb = app_context.resolve()['connections']
+    connection = connectionDb.create(
+        connections.account_id(),
+        item={
+            'connectionId': 'with-claims',
+            'authorized': True,
+            'claimsId': claimsId,
+        }
+    )
+
+    def post_to_connection(ConnectionId, Data):
+        assert ConnectionId == "with-claims"
+        assert json.loads(Data.decode('utf-8')) == {
+            'response': {
+                'action': 'status',
+                'statusCode': 200,
+                'body': {
+                    **connection,
+                    'claims': claims,
+                },
+                'requestId': 'id',
+            }
+        }
+
+    claimsDb.cache.clear()
+    management = MagicMock()
+    management.post_to_connection = post_to_connection
+    with patch.object(boto3, 'client', return_value=management) as mock_client:
+        connections(routeKey="status", connectionId="with-claims", body={
+        })
+
+    mock_client.assert_called_once()
+    assert claimsDb.is_cached(connections.account_id(), claimsId)
+
+
+def test_connect_binary_encoding(connections):
+    import base64
+    import pytest
+    from pinthesky import api
+    from resources import Context, make_event
+
+    msgpack = pytest.importorskip('msgpack')
+    connectDb = app_context.resolve()['connections']
+    resp = connections(
+        routeKey="$connect",
+        connectionId='binary-manager',
+        headers={'Sec-WebSocket-Protocol': 'manager+unknown, manager+msgpack, manager'},
+        authorizer={'sub': 'binary', 'token_use': 'id', 'exp': floor(time.time()) + 60})
+    assert resp.code == 200
+    assert resp.headers['Sec-WebSocket-Protocol'] == 'manager+msgpack'
+    assert connectDb.get('123456789012', item_id='binary-manager')['encoding'] == 'msgpack'
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(Data)
+    event = make_event('/connection', routeKey='status', connectionId='binary-manager')
+    event['body'] = base64.b64encode(msgpack.packb({'action': 'status', 'requestId': 'binary'})).decode('utf-8')
+    event['isBase64Encoded'] = True
+    with patch.object(boto3, 'client', return_value=management):
+        api(event, Context(invoked_function_arn='arn:aws:lambda:us-east-1:123456789012:function:TestFunction'))
+
+    reply = msgpack.unpackb(replies[0])['response']
+    assert reply['statusCode'] == 200
+    assert reply['requestId'] == 'binary'
+    assert reply['body']['encoding'] == 'msgpack'
+    assert reply['body']['claims']['sub'] == 'binary'
+
+
+def test_replies_use_the_negotiated_encoding(connections):
+    import pytest
+    from pinthesky import management as wrapper
+
+    msgpack = pytest.importorskip('msgpack')
+    connections(
+        routeKey="$connect",
+        connectionId='negotiated-manager',
+        headers={'Sec-WebSocket-Protocol': 'manager+msgpack'},
+        authorizer={'sub': 'negotiated', 'token_use': 'id', 'exp': floor(time.time()) + 60})
+    wrapper.encodings.clear()
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append((ConnectionId, Data))
+    with patch.object(boto3, 'client', return_value=management):
+        connections(routeKey="status", connectionId='negotiated-manager', body={'requestId': 'text'})
+        connections(routeKey="$connect", connectionId='negotiated-child', headers={
+            'ManagerId': 'negotiated-manager',
+            'Sec-WebSocket-Protocol': 'session',
+        })
+
+    assert [connection_id for connection_id, _ in replies] == ['negotiated-manager'] * 2
+    assert msgpack.unpackb(replies[0][1])['response']['requestId'] == 'text'
+    assert msgpack.unpackb(replies[1][1])['response']['body'] == {'connectionId': 'negotiated-child'}
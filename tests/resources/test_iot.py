@@ -1,6 +1,9 @@
+import base64
 import boto3
 import json
+import threading
 import time
+from contextvars import copy_context
 from math import floor
 from ophis.globals import app_context
 from unittest.mock import MagicMock, patch
@@ -323,6 +326,64 @@ def test_invoke_stop_session(iot):
     ) is None
 
 
+def test_invoke_session_counters(iot):
+    managerId = str(uuid4())
+    childId = str(uuid4())
+    connections = app_context.resolve()['connections']
+    connections.create(
+        '123456789012',
+        item={
+            'connectionId': managerId,
+            'expiresIn': floor(time.time()) + 60 * 1000,
+            'authorized': True,
+            'manager': True,
+            'activeSessions': 0,
+            'activeChildren': 1,
+        }
+    )
+    connections.create(
+        '123456789012',
+        item={
+            'connectionId': childId,
+            'managerId': managerId,
+            'expiresIn': floor(time.time()) + 60 * 1000,
+            'authorized': True,
+            'manager': False,
+            'activeSessions': 0,
+        }
+    )
+
+    def invoke(start):
+        iot(routeKey="invoke", connectionId=managerId, body={
+            'payload': {
+                'connectionId': childId,
+                'invokeId': 'counted',
+                'camera': 'PitsCamera1',
+                'event': {
+                    'name': 'record',
+                    'session': {
+                        'start': start,
+                        'stop': not start,
+                    }
+                }
+            }
+        })
+
+    management = MagicMock()
+    with patch.object(boto3, 'client', return_value=management):
+        invoke(True)
+        assert connections.get('123456789012', item_id=childId)['activeSessions'] == 1
+        assert connections.get('123456789012', item_id=managerId)['childSessions'] == 1
+        invoke(False)
+        invoke(False)
+
+    assert connections.get('123456789012', item_id=childId)['activeSessions'] == 0
+    manager = connections.get('123456789012', item_id=managerId)
+    assert manager['childSessions'] == 0
+    assert manager['activeSessions'] == 0
+    assert manager['activeChildren'] == 1
+
+
 def test_list_sessions_self(iot):
     sessions = app_context.resolve()['sessions']
 
@@ -538,3 +599,398 @@ def test_list_sessions_not_found_other_session(iot):
         })
 
     mock_client.assert_called_once()
+
+
+@patch('time.time', MagicMock(return_value=1711747711))
+def test_keepalive_extends_sessions(iot):
+    managerId = str(uuid4())
+    childId = str(uuid4())
+    tokenExpiresIn = 1711747711 + 60
+    expiresIn = 1711747711 + 3600
+    connections = app_context.resolve()['connections']
+    connections.create('123456789012', item={
+        'connectionId': managerId,
+        'expiresIn': tokenExpiresIn,
+        'authorized': True,
+        'manager': True,
+        'activeChildren': 1,
+    })
+    connections.create('123456789012', item={
+        'connectionId': childId,
+        'managerId': managerId,
+        'expiresIn': tokenExpiresIn,
+        'authorized': True,
+        'manager': False,
+        'activeSessions': 0,
+    })
+    connections.create('123456789012', 'Manager', managerId, item={
+        'connectionId': childId,
+        'expiresIn': tokenExpiresIn,
+    })
+    replies = []
+    iot_data = app_context.resolve()['iot_data']
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data))
+    sessions = app_context.resolve()['sessions']
+    with patch.object(boto3, 'client', return_value=management):
+        for invokeId, camera in [('a', 'PitsCamera1'), ('b', 'PitsCamera1'), ('c', 'PitsCamera2')]:
+            iot(routeKey="invoke", connectionId=childId, body={
+                'payload': {
+                    'invokeId': invokeId,
+                    'camera': camera,
+                    'event': {'name': 'record', 'session': {'start': True, 'stop': False}},
+                }
+            })
+        for invokeId in ['a', 'b', 'c']:
+            session = sessions.get('123456789012', 'Connections', childId, item_id=invokeId)
+            assert session['expiresIn'] == tokenExpiresIn
+
+        replies.clear()
+        iot_data.reset_mock()
+        iot(routeKey="keepalive", connectionId=managerId, body={
+            'payload': {
+                'connectionId': childId,
+                'invokeIds': ['a', 'b', 'c', 'gone'],
+                'publish': True,
+            }
+        })
+
+    assert replies[0]['response']['statusCode'] == 200
+    assert replies[0]['response']['body'] == {
+        'connectionId': childId,
+        'expiresIn': expiresIn,
+        'invokeIds': ['a', 'b', 'c'],
+        'missing': ['gone'],
+    }
+    for invokeId in ['a', 'b', 'c']:
+        session = sessions.get('123456789012', 'Connections', childId, item_id=invokeId)
+        assert session['expiresIn'] == expiresIn
+    assert connections.get('123456789012', item_id=childId)['expiresIn'] == expiresIn
+    assert connections.get('123456789012', 'Manager', managerId, item_id=childId)['expiresIn'] == expiresIn
+    published = {
+        call.kwargs['topic']: json.loads(call.kwargs['payload'])
+        for call in iot_data.publish.call_args_list
+    }
+    assert len(published) == 2
+    event = published['pinthesky/events/PitsCamera1/input']
+    assert event['name'] == 'keepalive'
+    assert event['context']['session']['invokeIds'] == ['a', 'b']
+
+
+def test_keepalive_not_found_other(iot):
+    connectionId = str(uuid4())
+    connections = app_context.resolve()['connections']
+    connections.create('123456789012', item={
+        'connectionId': connectionId,
+        'authorized': True,
+        'manager': True,
+    })
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data))
+    with patch.object(boto3, 'client', return_value=management):
+        iot(routeKey="keepalive", connectionId=connectionId, body={
+            'payload': {'connectionId': 'not-managed'},
+        })
+
+    assert replies[0]['response']['statusCode'] == 404
+
+
+def test_shared_sessions(iot, monkeypatch):
+    monkeypatch.setenv('SHARED_SESSIONS', 'record')
+    viewers = [str(uuid4()) for _ in range(3)]
+    connections = app_context.resolve()['connections']
+    for viewer in viewers:
+        connections.create('123456789012', item={
+            'connectionId': viewer,
+            'expiresIn': floor(time.time()) + 60 * 1000,
+            'authorized': True,
+            'manager': True,
+            'activeSessions': 0,
+        })
+
+    def invoke(viewer, start):
+        iot(routeKey="invoke", connectionId=viewer, body={
+            'payload': {
+                'invokeId': f'shared-{viewer}',
+                'camera': 'SharedCamera',
+                'event': {
+                    'name': 'record',
+                    'session': {
+                        'start': start,
+                        'stop': not start,
+                    }
+                }
+            }
+        })
+
+    def published():
+        return [
+            json.loads(call.kwargs['payload'])['context']
+            for call in iot_data.publish.call_args_list
+        ]
+
+    replies = []
+    iot_data = app_context.resolve()['iot_data']
+    iot_data.reset_mock()
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data)['response'])
+    with patch.object(boto3, 'client', return_value=management):
+        for viewer in viewers:
+            invoke(viewer, True)
+        assert len(published()) == 1
+        assert [reply['body']['viewers'] for reply in replies] == [1, 2, 3]
+        assert all(reply['body']['deviceInvokeId'] == f'shared-{viewers[0]}' for reply in replies)
+
+        invoke(viewers[0], False)
+        invoke(viewers[1], False)
+        assert len(published()) == 1
+        iot(routeKey="$disconnect", connectionId=viewers[2])
+
+    stop = published()[-1]
+    assert len(published()) == 2
+    assert stop['session']['stop']
+    assert stop['connection']['invoke_id'] == f'shared-{viewers[0]}'
+    devices = app_context.resolve()['device_sessions']
+    assert devices.get('123456789012', 'Cameras', 'SharedCamera', item_id='record') is None
+
+
+def test_shared_session_expiry(iot, monkeypatch):
+    monkeypatch.setenv('SHARED_SESSIONS', 'record')
+    now = floor(time.time())
+    viewers = {str(uuid4()): now + 2000, str(uuid4()): now + 1000}
+    connections = app_context.resolve()['connections']
+    devices = app_context.resolve()['device_sessions']
+    for viewer, expiresIn in viewers.items():
+        connections.create('123456789012', item={
+            'connectionId': viewer,
+            'expiresIn': expiresIn,
+            'authorized': True,
+            'manager': True,
+            'activeSessions': 0,
+        })
+
+    def device():
+        return devices.get('123456789012', 'Cameras', 'ExpiringCamera', item_id='record')
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data)['response'])
+    with patch.object(boto3, 'client', return_value=management):
+        for viewer in viewers:
+            iot(routeKey="invoke", connectionId=viewer, body={
+                'payload': {
+                    'invokeId': f'expiring-{viewer}',
+                    'camera': 'ExpiringCamera',
+                    'event': {'name': 'record', 'session': {'start': True}},
+                }
+            })
+        assert device()['expiresIn'] == now + 2000
+
+        second = list(viewers)[1]
+        iot(routeKey="keepalive", connectionId=second, body={'payload': {'expiresIn': now + 3000}})
+
+    assert replies[-1]['statusCode'] == 200
+    assert replies[-1]['body']['invokeIds'] == [f'expiring-{second}']
+    assert device()['expiresIn'] == now + 3000
+
+
+def test_list_sessions_manager_scope(iot):
+    from ophis.database import QueryParams
+
+    def encode(token):
+        return base64.urlsafe_b64encode(json.dumps(token).encode('utf-8')).decode('utf-8')
+
+    managerId = str(uuid4())
+    childIds = [str(uuid4()), str(uuid4())]
+    connections = app_context.resolve()['connections']
+    sessions = app_context.resolve()['sessions']
+    connections.create('123456789012', item={
+        'connectionId': managerId,
+        'authorized': True,
+        'manager': True,
+    })
+    for childId in childIds:
+        connections.create('123456789012', item={
+            'connectionId': childId,
+            'managerId': managerId,
+            'authorized': True,
+            'manager': False,
+        })
+        connections.create('123456789012', 'Manager', managerId, item={'connectionId': childId})
+    for connectionId, count in [(managerId, 1), (childIds[0], 3), (childIds[1], 1)]:
+        for index in range(count):
+            sessions.create('123456789012', 'Connections', connectionId, item={
+                'invokeId': f'{connectionId}-{index}',
+                'connectionId': connectionId,
+                'camera': 'PitsCamera1',
+            })
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data)['response'])
+    with patch.object(boto3, 'client', return_value=management):
+        iot(routeKey="listSessions", connectionId=managerId, body={
+            'payload': {'scope': 'manager', 'limit': 2},
+        })
+        first = replies[-1]['body']
+        iot(routeKey="listSessions", connectionId=managerId, body={
+            'payload': {'scope': 'manager', 'limit': 2, 'nextToken': first['nextToken']},
+        })
+        second = replies[-1]['body']
+        iot(routeKey="listSessions", connectionId=managerId, body={
+            'payload': {'scope': 'manager', 'nextToken': 'not-a-token'},
+        })
+        invalid = replies[-1]
+        outside = sessions.items('123456789012', 'Connections', childIds[0], params=QueryParams(limit=1)).next_token
+        forged = {'managerId': managerId, 'tokens': {childIds[0]: outside, 'victim': outside}}
+        iot(routeKey="listSessions", connectionId=managerId, body={
+            'payload': {'scope': 'manager', 'nextToken': encode(forged)},
+        })
+        filtered = replies[-1]
+        other_manager = {'managerId': str(uuid4()), 'tokens': {childIds[0]: outside}}
+        iot(routeKey="listSessions", connectionId=managerId, body={
+            'payload': {'scope': 'manager', 'nextToken': encode(other_manager)},
+        })
+        rebound = replies[-1]
+
+    assert sorted(first['connectionIds']) == sorted([managerId, *childIds])
+    assert len(first['items']) == 4
+    assert second['connectionIds'] == [childIds[0]]
+    assert second['nextToken'] is None
+    invokeIds = [item['invokeId'] for item in first['items'] + second['items']]
+    assert sorted(invokeIds) == sorted([
+        f'{managerId}-0', *(f'{childIds[0]}-{index}' for index in range(3)), f'{childIds[1]}-0'])
+    assert invalid['statusCode'] == 400
+    assert filtered['statusCode'] == 200
+    assert filtered['body']['connectionIds'] == [childIds[0]]
+    assert all(item['connectionId'] == childIds[0] for item in filtered['body']['items'])
+    assert rebound['statusCode'] == 400
+
+
+def test_invoke_duplicate_frames(iot, monkeypatch):
+    connectionId = str(uuid4())
+    connections = app_context.resolve()['connections']
+    connections.create('123456789012', item={
+        'connectionId': connectionId,
+        'expiresIn': floor(time.time()) + 60 * 1000,
+        'authorized': True,
+        'manager': True,
+        'activeSessions': 0,
+    })
+
+    replies = []
+    barrier = threading.Barrier(8)
+    iot_data = app_context.resolve()['iot_data']
+    iot_data.reset_mock()
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data)['response'])
+
+    def retry():
+        barrier.wait()
+        iot(routeKey="invoke", connectionId=connectionId, body={
+            'requestId': 'retried-request',
+            'payload': {
+                'camera': 'PitsCamera1',
+                'event': {
+                    'name': 'record',
+                    'session': {
+                        'start': True,
+                    }
+                }
+            }
+        })
+
+    with patch.object(boto3, 'client', return_value=management):
+        threads = [threading.Thread(target=copy_context().run, args=(retry,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(replies) == 8
+    assert all(reply['statusCode'] == 200 for reply in replies)
+    assert len(set(reply['body']['invokeId'] for reply in replies)) == 1
+    assert all(reply['requestId'] == 'retried-request' for reply in replies)
+    iot_data.publish.assert_called_once()
+    sessions = app_context.resolve()['sessions']
+    assert len(sessions.items('123456789012', 'Connections', connectionId).items) == 1
+    assert connections.get('123456789012', item_id=connectionId)['activeSessions'] == 1
+
+    monkeypatch.setenv('SHARED_SESSIONS', 'record')
+    replies.clear()
+    with patch.object(boto3, 'client', return_value=management):
+        for requestId in ['first-viewer', 'shared-request', 'shared-request']:
+            iot(routeKey="invoke", connectionId=connectionId, body={
+                'requestId': requestId,
+                'payload': {
+                    'camera': 'DedupedCamera',
+                    'event': {'name': 'record', 'session': {'start': True}},
+                }
+            })
+
+    assert 'deviceInvokeId' in replies[1]['body']
+    assert replies[1]['body']['viewers'] == 2
+    assert replies[2] == replies[1]
+
+
+def test_invoke_rate_limited(iot, monkeypatch):
+    from pinthesky.resource import iot as iot_module
+
+    monkeypatch.setitem(iot_module.INVOKE_RATE_LIMITS, 'flood', {'capacity': 2, 'rate': 0})
+    monkeypatch.setitem(iot_module.INVOKE_RATE_LIMITS, 'unlimited', None)
+    monkeypatch.setattr(iot_module, 'limiters', {})
+    connectionId = str(uuid4())
+    connections = app_context.resolve()['connections']
+    connections.create('123456789012', item={
+        'connectionId': connectionId,
+        'authorized': True,
+        'manager': True,
+    })
+
+    def invoke(name, camera='PitsCamera1'):
+        iot(routeKey="invoke", connectionId=connectionId, body={
+            'payload': {'camera': camera, 'event': {'name': name}},
+        })
+        return replies[-1]['statusCode']
+
+    replies = []
+    iot_data = app_context.resolve()['iot_data']
+    iot_data.reset_mock()
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data)['response'])
+    with patch.object(boto3, 'client', return_value=management):
+        assert [invoke('flood') for _ in range(3)] == [200, 200, 429]
+        assert invoke('flood', camera='PitsCamera2') == 200
+        assert all(invoke('unlimited') == 200 for _ in range(30))
+
+    assert replies[2]['error']['code'] == 'TooManyRequests'
+    assert iot_data.publish.call_count == 33
+
+
+def test_invoke_duplicates_are_not_rate_limited(iot, monkeypatch):
+    from pinthesky.resource import iot as iot_module
+
+    monkeypatch.setitem(iot_module.INVOKE_RATE_LIMITS, 'flood', {'capacity': 2, 'rate': 0})
+    monkeypatch.setattr(iot_module, 'limiters', {})
+    connectionId = str(uuid4())
+    connections = app_context.resolve()['connections']
+    connections.create('123456789012', item={
+        'connectionId': connectionId,
+        'authorized': True,
+        'manager': True,
+    })
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data)['response'])
+    with patch.object(boto3, 'client', return_value=management):
+        for _ in range(5):
+            iot(routeKey="invoke", connectionId=connectionId, body={
+                'requestId': 'flooded-request',
+                'payload': {'camera': 'PitsCamera1', 'event': {'name': 'flood'}},
+            })
+
+    assert [reply['statusCode'] for reply in replies] == [200] * 5
+    assert len({reply['body']['invokeId'] for reply in replies}) == 1
@@ -0,0 +1,44 @@
+import json
+from ophis.globals import app_context
+from pinthesky import management
+from pinthesky.auth import JWTAuthorizer, known_keys
+from pinthesky.local.identity import LocalIdentity
+from pinthesky.local.services import use_local_services
+from resources import make_event, read_template
+
+
+def test_local_identity_tokens_verify():
+    environ = {}
+    identity = LocalIdentity(bits=1024).install(environ=environ)
+
+    assert environ['USER_POOL_ID'] == identity.pool_id
+    assert known_keys[(identity.region, identity.pool_id)][1] == [identity.public_jwk]
+    authorizer = JWTAuthorizer(identity.client_id, [identity.public_jwk])
+    assert authorizer.authorize(identity.token('local-user'))['sub'] == 'local-user'
+    assert authorizer.authorize(identity.token('local-user', expires_in=-10)) is None
+
+
+def test_local_services_capture_frames(connections, monkeypatch):
+    monkeypatch.setenv('SERVICE_DOMAIN', 'local')
+    original = app_context.resolve()['iot_data']
+    try:
+        management_api, iot_data = use_local_services()
+        connections(routeKey="status", connectionId="local-missing", body={})
+    finally:
+        app_context.inject('iot_data', original, force=True)
+
+    assert management.clients['https://local'] is management_api
+    reply = json.loads(management_api.frames['local-missing'][-1])['response']
+    assert reply['statusCode'] == 404
+    assert len(iot_data.messages) == 0
+
+
+def test_event_factory_matches_template():
+    event = make_event('/connection', routeKey='status', connectionId='abc', body={'payload': {}})
+    assert event['routeKey'] == 'status'
+    assert event['requestContext']['routeKey'] == 'status'
+    assert event['requestContext']['connectionId'] == 'abc'
+    assert event['requestContext']['http']['path'] == '/connection'
+    assert json.loads(event['body']) == {'payload': {}}
+    assert make_event('/')['body'] == ''
+    assert read_template()['requestContext']['routeKey'] == '$routeKey'
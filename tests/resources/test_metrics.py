@@ -0,0 +1,131 @@
+import boto3
+import json
+from botocore.stub import Stubber
+from pinthesky import metrics
+from pinthesky.metrics import Histogram, Invocation, current, instrument
+from unittest.mock import MagicMock, patch
+
+
+def emitted(capsys):
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+    assert len(lines) == 1
+    return json.loads(lines[0])
+
+
+def test_frame_emits_embedded_metrics(connections, capsys):
+    capsys.readouterr()
+    with patch.object(boto3, 'client', return_value=MagicMock()):
+        connections(routeKey="status", connectionId="metrics-missing", body={})
+
+    document = emitted(capsys)
+    directive = document['_aws']['CloudWatchMetrics'][0]
+    assert directive['Namespace'] == 'PitsData'
+    assert directive['Dimensions'] == [['routeKey'], ['routeKey', 'statusCode']]
+    assert [metric['Name'] for metric in directive['Metrics'] if 'Latency' in metric['Name']] == [
+        'Latency', 'ParseLatency', 'PostLatency']
+    assert document['routeKey'] == 'status'
+    assert document['statusCode'] == '404'
+    assert document['Latency'] > 0
+    assert sum(document['ParseLatency']['Counts']) == 1
+    assert sum(document['PostLatency']['Counts']) == 1
+
+
+def test_metrics_can_be_disabled(connections, capsys, monkeypatch):
+    monkeypatch.setenv('METRICS_NAMESPACE', '')
+    capsys.readouterr()
+    connections(routeKey="$connect")
+
+    assert '_aws' not in capsys.readouterr().out
+
+
+def test_instrument_times_api_calls():
+    client = instrument(boto3.client(
+        'dynamodb',
+        region_name='us-east-1',
+        aws_access_key_id='fake',
+        aws_secret_access_key='fake'))
+    invocation = Invocation('status')
+    token = current.set(invocation)
+    try:
+        with Stubber(client) as stubber:
+            for sort_key in ['b', 'c']:
+                stubber.add_response('get_item', {}, {
+                    'TableName': 'Pits',
+                    'Key': {'PK': {'S': 'a'}, 'SK': {'S': sort_key}},
+                    'ReturnConsumedCapacity': 'TOTAL',
+                })
+            client.get_item(TableName='Pits', Key={'PK': {'S': 'a'}, 'SK': {'S': 'b'}})
+            client.get_item(TableName='Pits', Key={'PK': {'S': 'a'}, 'SK': {'S': 'c'}})
+    finally:
+        current.reset(token)
+
+    assert sum(invocation.phases['db'].buckets.values()) == 2
+
+
+def test_histogram_buckets():
+    histogram = Histogram()
+    for value in [1.01, 1.04, 1.2, 130.0, 134.0]:
+        histogram.add(value)
+    assert histogram.to_emf() == {'Values': [1.0, 1.2, 130.0], 'Counts': [2, 1, 2]}
+
+
+def test_instrument_records_consumed_capacity():
+    client = instrument(boto3.client(
+        'dynamodb',
+        region_name='us-east-1',
+        aws_access_key_id='fake',
+        aws_secret_access_key='fake'))
+    invocation = Invocation('invoke')
+    token = current.set(invocation)
+    try:
+        with Stubber(client) as stubber:
+            stubber.add_response(
+                'get_item',
+                {'ConsumedCapacity': {'TableName': 'Pits', 'CapacityUnits': 0.5}},
+                {'TableName': 'Pits', 'Key': {'PK': {'S': 'a'}, 'SK': {'S': 'b'}}, 'ReturnConsumedCapacity': 'TOTAL'})
+            stubber.add_response(
+                'batch_write_item',
+                {'ConsumedCapacity': [{'TableName': 'Pits', 'CapacityUnits': 3.0}]},
+                {
+                    'RequestItems': {'Pits': [{'PutRequest': {'Item': {'PK': {'S': 'a'}, 'SK': {'S': 'c'}}}}]},
+                    'ReturnConsumedCapacity': 'TOTAL',
+                })
+            client.get_item(TableName='Pits', Key={'PK': {'S': 'a'}, 'SK': {'S': 'b'}})
+            client.batch_write_item(RequestItems={
+                'Pits': [{'PutRequest': {'Item': {'PK': {'S': 'a'}, 'SK': {'S': 'c'}}}}],
+            })
+    finally:
+        current.reset(token)
+
+    assert invocation.read_units == 0.5
+    assert invocation.write_units == 3.0
+    document = json.loads(invocation.to_emf('PitsData', 1.0))
+    names = [metric['Name'] for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']]
+    assert names[-2:] == ['ConsumedReadCapacityUnits', 'ConsumedWriteCapacityUnits']
+    assert document['ConsumedWriteCapacityUnits'] == 3.0
+
+
+def test_capacity_is_ranked_per_frame(monkeypatch):
+    monkeypatch.setenv('METRICS_NAMESPACE', '')
+    metrics.reset_capacity()
+    router = metrics.MetricsRouter()
+
+    @router.routeKey('cheap')
+    def cheap():
+        metrics.record_capacity(read_units=0.5)
+
+    @router.routeKey('costly')
+    def costly():
+        metrics.record_capacity(read_units=1.0, write_units=2.0)
+
+    try:
+        for route_key in ['cheap', 'cheap', 'costly']:
+            router({'requestContext': {'routeKey': route_key}}, None)
+        summary = metrics.capacity_summary()
+        assert [row['routeKey'] for row in summary] == ['costly', 'cheap']
+        assert summary[0]['unitsPerFrame'] == 3.0
+        assert summary[1]['frames'] == 2
+        assert summary[1]['unitsPerFrame'] == 0.5
+        assert 'costly' in metrics.capacity_report().splitlines()[1]
+    finally:
+        metrics.reset_capacity()
@@ -0,0 +1,75 @@
+import boto3
+import json
+import logging
+import os
+import time
+from pinthesky.profiling import Sampler, should_profile
+from unittest.mock import MagicMock, patch
+
+
+def test_profiling_is_off_by_default(monkeypatch):
+    monkeypatch.delenv('PROFILE_RATE', raising=False)
+    assert not should_profile('invoke')
+
+
+def test_profiles_selected_routes(connections, monkeypatch, tmp_path, caplog):
+    monkeypatch.setenv('PROFILE_RATE', '1')
+    monkeypatch.setenv('PROFILE_ROUTES', 'status')
+    monkeypatch.setenv('PROFILE_TOP', '5')
+    monkeypatch.setenv('PROFILE_DIR', str(tmp_path))
+
+    with caplog.at_level(logging.INFO, logger='pinthesky.profiling'), patch.object(boto3, 'client', return_value=MagicMock()):
+        connections(routeKey="$connect")
+        connections(routeKey="status", connectionId="profiled-missing", body={})
+
+    profiles = os.listdir(tmp_path)
+    assert len(profiles) == 1
+    assert profiles[0].startswith('pinthesky-status-')
+    assert profiles[0].endswith('.prof')
+    messages = [record.message for record in caplog.records if record.message.startswith('Profiled status')]
+    assert len(messages) == 1
+    assert 'cumulative' in messages[0]
+
+
+def test_profiles_only_the_outermost_frame(batch, monkeypatch, tmp_path):
+    from ophis.globals import app_context
+
+    monkeypatch.setenv('PROFILE_RATE', '1')
+    monkeypatch.delenv('PROFILE_ROUTES', raising=False)
+    monkeypatch.setenv('PROFILE_DIR', str(tmp_path))
+    app_context.resolve()['connections'].create('123456789012', item={
+        'connectionId': 'profiled-batch',
+        'authorized': True,
+        'manager': True,
+    })
+
+    replies = []
+    management = MagicMock()
+    management.post_to_connection = lambda ConnectionId, Data: replies.append(json.loads(Data)['response'])
+    with patch.object(boto3, 'client', return_value=management):
+        batch(routeKey="batch", connectionId="profiled-batch", body={
+            'payload': {'actions': [{'action': 'status'}, {'action': 'listSessions'}, {'action': 'status'}]},
+        })
+
+    assert [response['statusCode'] for response in replies[0]['body']['responses']] == [200, 200, 200]
+    profiles = os.listdir(tmp_path)
+    assert len(profiles) == 1
+    assert profiles[0].startswith('pinthesky-batch-')
+
+
+def test_sampler_collects_stacks(tmp_path):
+    def busy():
+        end = time.perf_counter() + 0.05
+        while time.perf_counter() < end:
+            pass
+
+    with Sampler(interval=0.001) as sampler:
+        busy()
+
+    assert sum(sampler.stacks.values()) > 0
+    assert 'busy' in sampler.top(5)
+    path = tmp_path / 'profile.collapsed'
+    sampler.dump(path)
+    line = path.read_text().splitlines()[0]
+    assert ';' in line
+    assert line.rsplit(' ', 1)[1].isdigit()
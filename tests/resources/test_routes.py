@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+from pinthesky.resource import ROUTES
+
+
+def test_import_is_lazy():
+    script = ';'.join([
+        'import sys',
+        'import pinthesky.resource',
+        'loaded = [m for m in ["boto3", "jose", "requests"] if m in sys.modules]',
+        'assert loaded == [], loaded',
+        'assert "pinthesky.resource.connection" not in sys.modules',
+    ])
+    subprocess.run([sys.executable, '-c', script], check=True)
+
+
+def test_routes_are_registered(connections):
+    from pinthesky import api
+    from pinthesky.resource import load_all_routes
+
+    load_all_routes()
+    registered = [
+        getattr(filter, 'routeKey') for filter in api.filters
+        if hasattr(filter, 'routeKey')
+    ]
+    for route_key in ROUTES:
+        assert route_key in registered
+
+
+def test_every_route_has_an_entry_point():
+    from pinthesky.entry import ENTRY_POINTS
+
+    assert sorted(ENTRY_POINTS) == sorted(['$default', *ROUTES])
+    for module in ENTRY_POINTS.values():
+        assert os.path.exists(os.path.join('pinthesky', 'entry', f'{module}.py'))
+
+
+def test_entry_point_imports_only_its_route():
+    script = ';'.join([
+        'import sys',
+        'import pinthesky.entry.status',
+        'assert "pinthesky.resource.connection" in sys.modules',
+        'loaded = [m for m in ["jose", "requests", "pinthesky.resource.iot", "pinthesky.resource.auth"] if m in sys.modules]',
+        'assert loaded == [], loaded',
+    ])
+    subprocess.run([sys.executable, '-c', script], check=True)
@@ -0,0 +1,143 @@
+import asyncio
+import base64
+import json
+import os
+import pytest
+from ophis.globals import app_context
+from pinthesky import management
+from pinthesky.local.identity import LocalIdentity
+from pinthesky.local.server import (
+    OP_BINARY, OP_CLOSE, OP_PING, OP_PONG, OP_TEXT, LocalGateway, accept_key, encode_frame, read_frame
+)
+from pinthesky.local.services import LocalIotData
+
+
+async def connect(port, protocol, headers={}, query=''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    key = base64.b64encode(os.urandom(16)).decode('utf-8')
+    lines = [
+        f'GET /{query} HTTP/1.1',
+        f'Host: 127.0.0.1:{port}',
+        'Upgrade: websocket',
+        'Connection: Upgrade',
+        f'Sec-WebSocket-Key: {key}',
+        'Sec-WebSocket-Version: 13',
+        f'Sec-WebSocket-Protocol: {protocol}',
+        *(f'{name}: {value}' for name, value in headers.items()),
+    ]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    status, *response = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    if ' 101 ' in status:
+        assert f'Sec-WebSocket-Accept: {accept_key(key)}' in response
+    return status, reader, writer
+
+
+async def send(writer, opcode, data):
+    writer.write(encode_frame(opcode, data, mask=os.urandom(4)))
+    await writer.drain()
+
+
+async def receive(reader):
+    _, opcode, data = await asyncio.wait_for(read_frame(reader, 1 << 20, require_mask=False), 5)
+    return opcode, json.loads(data)['response'] if opcode == OP_TEXT else data
+
+
+def test_local_gateway(table, monkeypatch):
+    from pinthesky.resource import load_all_routes
+
+    for name in ['AWS_REGION', 'USER_POOL_ID', 'USER_CLIENT_ID']:
+        monkeypatch.setenv(name, os.getenv(name, ''))
+    monkeypatch.setenv('SERVICE_DOMAIN', 'gateway.local')
+    token = LocalIdentity(bits=1024).install().token('gateway-user')
+    load_all_routes()
+    original = app_context.resolve()['iot_data']
+    app_context.inject('iot_data', LocalIotData(), force=True)
+
+    async def scenario():
+        gateway = LocalGateway(port=0)
+        await gateway.start()
+        management.clients['https://gateway.local'] = gateway
+        try:
+            status, _, _ = await connect(gateway.port, 'unknown')
+            assert ' 400 ' in status
+
+            status, manager, manager_writer = await connect(gateway.port, 'manager', query=f'?Authorization={token}')
+            assert ' 101 ' in status
+            manager_id = next(iter(gateway.connections))
+            status, child, child_writer = await connect(gateway.port, 'session', headers={'ManagerId': manager_id})
+            assert ' 101 ' in status
+            _, joined = await receive(manager)
+            assert joined['action'] == '$connect'
+            child_id = joined['body']['connectionId']
+            assert child_id in gateway.connections
+
+            await send(manager_writer, OP_TEXT, json.dumps({'action': 'status', 'requestId': 'r1'}).encode('utf-8'))
+            _, reply = await receive(manager)
+            assert reply['action'] == 'status'
+            assert reply['statusCode'] == 200
+            assert reply['requestId'] == 'r1'
+            assert reply['body']['claims']['sub'] == 'gateway-user'
+
+            await send(child_writer, OP_TEXT, b'{"action": "unknown"}')
+            _, reply = await receive(child)
+            assert reply['action'] == '$default'
+            assert reply['statusCode'] == 404
+
+            await send(manager_writer, OP_PING, b'ping')
+            assert await receive(manager) == (OP_PONG, b'ping')
+
+            await send(manager_writer, OP_CLOSE, b'\x03\xe8')
+            opcode, _ = await receive(manager)
+            assert opcode == OP_CLOSE
+            opcode, _ = await receive(child)
+            assert opcode == OP_CLOSE
+            for _ in range(100):
+                if len(gateway.connections) == 0:
+                    break
+                await asyncio.sleep(0.01)
+            assert gateway.connections == {}
+            assert child_id in gateway.deleted
+            return manager_id
+        finally:
+            await gateway.close()
+
+    try:
+        manager_id = asyncio.run(scenario())
+    finally:
+        app_context.inject('iot_data', original, force=True)
+
+    connections = app_context.resolve()['connections']
+    assert connections.get('123456789012', item_id=manager_id) is None
+
+
+def test_local_gateway_binary_frames(table, monkeypatch):
+    from pinthesky.resource import load_all_routes
+
+    msgpack = pytest.importorskip('msgpack')
+    monkeypatch.setenv('SERVICE_DOMAIN', 'gateway.local')
+    load_all_routes()
+
+    async def scenario():
+        gateway = LocalGateway(port=0)
+        await gateway.start()
+        management.clients['https://gateway.local'] = gateway
+        try:
+            status, reader, writer = await connect(gateway.port, 'manager+msgpack')
+            assert ' 101 ' in status
+            connection_id = next(iter(gateway.connections))
+            assert gateway.connections[connection_id].protocol == 'manager+msgpack'
+            connection = app_context.resolve()['connections'].get('123456789012', item_id=connection_id)
+            assert connection['encoding'] == 'msgpack'
+            await send(writer, OP_BINARY, msgpack.packb({'action': 'status', 'requestId': 'b1'}))
+            opcode, data = await receive(reader)
+            assert opcode == OP_BINARY
+            reply = msgpack.unpackb(data)['response']
+            assert reply['action'] == 'status'
+            assert reply['requestId'] == 'b1'
+            assert reply['statusCode'] == 401
+            await send(writer, OP_CLOSE, b'\x03\xe8')
+            await receive(reader)
+        finally:
+            await gateway.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,87 @@
+import boto3
+import pytest
+from botocore.config import Config
+from botocore.stub import ANY, Stubber
+from pinthesky import management, tracing
+from pinthesky.metrics import Invocation, current
+
+
+ENDPOINT = 'https://id.execute-api.us-east-1.amazonaws.com/live'
+
+
+@pytest.fixture
+def traced():
+    tracing.reset()
+    yield tracing
+    tracing.reset()
+
+
+def client(service, **kwargs):
+    return tracing.instrument(boto3.client(
+        service,
+        region_name='us-east-1',
+        aws_access_key_id='fake',
+        aws_secret_access_key='fake',
+        **kwargs))
+
+
+def test_frame_calls_are_attributed(traced, connections, monkeypatch):
+    monkeypatch.setenv('SERVICE_DOMAIN', 'id.execute-api.us-east-1.amazonaws.com/live')
+    api_client = client('apigatewaymanagementapi', endpoint_url=ENDPOINT)
+    management.clients[ENDPOINT] = api_client
+    with Stubber(api_client) as stubber:
+        stubber.add_response('post_to_connection', {}, {'ConnectionId': 'traced-missing', 'Data': ANY})
+        connections(routeKey="status", connectionId="traced-missing", body={})
+        stubber.assert_no_pending_responses()
+
+    rows = traced.summary()
+    assert len(rows) == 1
+    assert rows[0]['routeKey'] == 'status'
+    assert rows[0]['service'] == 'apigatewaymanagementapi'
+    assert rows[0]['operation'] == 'PostToConnection'
+    assert rows[0]['calls'] == 1
+    assert rows[0]['requestBytes'] > 0
+
+
+def test_retries_errors_and_report(traced):
+    iot_data = client('iot-data', endpoint_url='https://data.iot.us-east-1.amazonaws.com')
+    token = current.set(Invocation('invoke'))
+    try:
+        with Stubber(iot_data) as stubber:
+            stubber.add_response('publish', {'ResponseMetadata': {'RetryAttempts': 2}})
+            stubber.add_client_error('publish', 'ThrottlingException')
+            iot_data.publish(topic='pinthesky/events/camera/input', payload=b'{"name": "health"}')
+            with pytest.raises(Exception):
+                iot_data.publish(topic='pinthesky/events/camera/input', payload=b'{"name": "health"}')
+    finally:
+        current.reset(token)
+
+    row = traced.summary()[0]
+    assert (row['routeKey'], row['service'], row['operation']) == ('invoke', 'iot-data', 'Publish')
+    assert row['calls'] == 2
+    assert row['errors'] == 1
+    assert row['retries'] == 2
+    assert row['requestBytes'] == 2 * len(b'{"name": "health"}')
+    lines = traced.report().splitlines()
+    assert lines[0].split() == [
+        'routeKey', 'service', 'operation', 'calls', 'errors', 'retries',
+        'meanMs', 'maxMs', 'requestBytes', 'responseBytes',
+    ]
+    assert lines[1].split()[:6] == ['invoke', 'iot-data', 'Publish', '2', '1', '2']
+
+
+def test_failed_connections_are_recorded(traced):
+    iot_data = client(
+        'iot-data',
+        endpoint_url='http://127.0.0.1:9',
+        config=Config(retries={'max_attempts': 0}, connect_timeout=1))
+    token = current.set(Invocation('invoke'))
+    try:
+        with pytest.raises(Exception) as e:
+            iot_data.publish(topic='pinthesky/events/camera/input', payload=b'{"name": "health"}')
+    finally:
+        current.reset(token)
+
+    assert type(e.value).__name__ == 'EndpointConnectionError'
+    row = traced.summary()[0]
+    assert (row['routeKey'], row['operation'], row['calls'], row['errors']) == ('invoke', 'Publish', 1, 1)
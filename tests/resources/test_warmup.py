@@ -0,0 +1,61 @@
+import boto3
+import json
+from ophis.globals import app_context
+from pinthesky import api, management
+from pinthesky.auth import JWTAuthorizer, known_keys, public_keys
+from pinthesky.util import LazyClient
+from test_auth import ENDPOINT, FAKE_KEYS
+from unittest.mock import MagicMock, patch
+
+
+def test_warmup_primes_the_container(requests_mock, monkeypatch, connections):
+    requests_mock.get(ENDPOINT, json=FAKE_KEYS)
+    monkeypatch.setenv('AWS_REGION', 'us-east-2')
+    monkeypatch.setenv('USER_POOL_ID', 'efg-456')
+    monkeypatch.setenv('SERVICE_DOMAIN', 'id.execute-api.us-east-1.amazonaws.com/live')
+    factory = MagicMock(return_value=MagicMock())
+    app_context.inject('warmup_probe', LazyClient('warmup_probe', factory), force=True)
+
+    try:
+        with patch.object(boto3, 'client', return_value=MagicMock()) as mock_client:
+            resp = api({
+                'source': 'aws.events',
+                'detail-type': 'Scheduled Event',
+                'detail': {
+                    'domains': ['other.execute-api.us-east-1.amazonaws.com/live'],
+                },
+            }, None)
+    finally:
+        app_context.remove('warmup_probe')
+
+    assert resp['statusCode'] == 200
+    steps = json.loads(resp['body'])['steps']
+    for name in ['routes', 'warmup_probe', 'management', 'jwks']:
+        assert steps[name]['status'] == 'ok'
+        assert steps[name]['ms'] >= 0
+    factory.assert_called_once()
+    assert mock_client.call_count == 2
+    assert sorted(management.clients) == [
+        'https://id.execute-api.us-east-1.amazonaws.com/live',
+        'https://other.execute-api.us-east-1.amazonaws.com/live',
+    ]
+    assert len(known_keys) == 1
+    assert len(public_keys) == len(FAKE_KEYS['keys'])
+
+    JWTAuthorizer.cached_keys('efg-456')
+    assert requests_mock.call_count == 1
+
+
+def test_warmup_reports_failed_steps(requests_mock, monkeypatch, connections):
+    requests_mock.get(ENDPOINT, status_code=500)
+    monkeypatch.setenv('AWS_REGION', 'us-east-2')
+    monkeypatch.setenv('USER_POOL_ID', 'efg-456')
+    monkeypatch.setenv('SERVICE_DOMAIN', '')
+
+    resp = api({'action': '$warmup'}, None)
+
+    steps = json.loads(resp['body'])['steps']
+    assert steps['routes']['status'] == 'ok'
+    assert steps['jwks']['status'] == 'failed'
+    assert 'management' not in steps
+    assert len(known_keys) == 0
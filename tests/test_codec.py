@@ -0,0 +1,35 @@
+import pytest
+from decimal import Decimal
+from pinthesky import codec
+
+
+def test_negotiate():
+    assert codec.split_protocol('manager') == ('manager', 'json')
+    assert codec.split_protocol(' session+cbor') == ('session', 'cbor')
+    assert codec.negotiate('manager', ['manager', 'session']) == ('manager', 'manager', 'json')
+    assert codec.negotiate('manager+bogus, session', ['manager', 'session']) == ('session', 'session', 'json')
+    assert codec.negotiate('other', ['manager', 'session']) is None
+    assert codec.negotiate(None, ['manager', 'session']) is None
+
+
+@pytest.mark.parametrize('encoding,module', [
+    ('json', 'json'),
+    ('msgpack', 'msgpack'),
+    ('cbor', 'cbor2'),
+])
+def test_round_trip(encoding, module):
+    pytest.importorskip(module)
+    reply = {
+        'response': {
+            'action': 'listSessions',
+            'statusCode': 200,
+            'body': {'items': [{'invokeId': 'a', 'expiresIn': Decimal(1700000000)}], 'nextToken': None},
+            'requestId': 'id',
+        }
+    }
+    data = codec.dumps(reply, encoding)
+    assert codec.sniff(data) == encoding
+    decoded = codec.loads(data)
+    assert decoded['response']['requestId'] == 'id'
+    assert int(decoded['response']['body']['items'][0]['expiresIn']) == 1700000000
+    assert codec.loads(data, encoding) == decoded
@@ -0,0 +1,275 @@
+import json
+import pytest
+import time
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from decimal import Decimal
+from ophis.database import ConflictException, QueryParams, Repository
+from pinthesky.database import (
+    DataBuckets, DataClaims, DataConnections, DataDeviceSessions, DataSessions, TransactionConflictException, transact_write
+)
+from pinthesky.local.database import MemoryDynamoDB
+from pinthesky.util import iterate_all_items
+
+
+@pytest.fixture
+def ddb():
+    return MemoryDynamoDB()
+
+
+@pytest.fixture
+def connections(ddb):
+    return DataConnections(table=ddb.Table('Pits'))
+
+
+def test_create_get_delete(connections):
+    created = connections.create('111', item={'connectionId': 'a', 'authorized': True})
+    assert connections.get('111', item_id='a') == created
+    with pytest.raises(ConflictException):
+        connections.create('111', item={'connectionId': 'a'})
+    connections.delete('111', item_id='a')
+    assert connections.get('111', item_id='a') is None
+
+
+def test_numbers_are_decimal(ddb):
+    table = ddb.Table('Pits')
+    table.put_item(Item={'PK': 'a', 'SK': 'b', 'count': 1, 'nested': {'count': 2}})
+    item = table.get_item(Key={'PK': 'a', 'SK': 'b'})['Item']
+    assert item['count'] == Decimal(1)
+    assert item['nested']['count'] == Decimal(2)
+    with pytest.raises(TypeError):
+        table.put_item(Item={'PK': 'a', 'SK': 'c', 'count': 1.5})
+
+
+def test_update_expressions(ddb):
+    table = ddb.Table('Pits')
+    table.put_item(Item={'PK': 'a', 'SK': 'b', 'name': 'first', 'viewers': {'x'}})
+    resp = table.update_item(
+        Key={'PK': 'a', 'SK': 'b'},
+        UpdateExpression='SET #name = :name, #total = if_not_exists(#total, :zero) + :one ADD #viewers :viewer REMOVE #gone',
+        ConditionExpression='attribute_exists(PK) AND NOT #name = :name',
+        ExpressionAttributeNames={
+            '#name': 'name',
+            '#total': 'total',
+            '#viewers': 'viewers',
+            '#gone': 'gone',
+        },
+        ExpressionAttributeValues={':name': 'second', ':zero': 0, ':one': 1, ':viewer': {'y'}},
+        ReturnValues='UPDATED_NEW',
+    )
+    assert resp['Attributes'] == {'name': 'second', 'total': 1, 'viewers': {'x', 'y'}}
+    with pytest.raises(ClientError) as e:
+        table.update_item(
+            Key={'PK': 'a', 'SK': 'b'},
+            UpdateExpression='SET #name = :name',
+            ConditionExpression='NOT #name = :name',
+            ExpressionAttributeNames={'#name': 'name'},
+            ExpressionAttributeValues={':name': 'second'},
+        )
+    assert e.value.response['Error']['Code'] == 'ConditionalCheckFailedException'
+    table.update_item(
+        Key={'PK': 'a', 'SK': 'b'},
+        UpdateExpression='DELETE #viewers :viewers',
+        ExpressionAttributeNames={'#viewers': 'viewers'},
+        ExpressionAttributeValues={':viewers': {'x', 'y'}},
+    )
+    assert 'viewers' not in table.get_item(Key={'PK': 'a', 'SK': 'b'})['Item']
+
+
+def test_query_pagination(connections):
+    for index in range(25):
+        connections.create('111', item={'connectionId': f'con-{index:02}'})
+    connections.create('222', item={'connectionId': 'other'})
+    page = connections.items('111', params=QueryParams(limit=10))
+    assert [item['connectionId'] for item in page.items] == [f'con-{index:02}' for index in range(10)]
+    assert page.next_token is not None
+    everything = list(iterate_all_items(connections, '111'))
+    assert len(everything) == 25
+    backwards = connections.items('111', params=QueryParams(limit=5, sort_ascending=False))
+    assert backwards.items[0]['connectionId'] == 'con-24'
+
+
+def test_query_index(ddb):
+    table = ddb.Table('Pits')
+    for index in range(5):
+        table.put_item(Item={'PK': f'p{index}', 'SK': 's', 'GS1-PK': 'group', 'createTime': 5 - index})
+    repository = Repository(type='Group', table=table)
+    resp = table.query(
+        IndexName='GS1',
+        KeyConditionExpression=Key('GS1-PK').eq('group'),
+        Limit=3,
+    )
+    assert [item['PK'] for item in resp['Items']] == ['p4', 'p3', 'p2']
+    rest = table.query(
+        IndexName='GS1',
+        KeyConditionExpression=Key('GS1-PK').eq('group'),
+        ExclusiveStartKey=resp['LastEvaluatedKey'],
+    )
+    assert [item['PK'] for item in rest['Items']] == ['p1', 'p0']
+    assert repository.prune_dto(rest['Items'][0]) == {'createTime': 4}
+
+
+def test_batch_read_write(ddb):
+    table = ddb.Table('Pits')
+    connections = DataConnections(table=table)
+    sessions = DataSessions(table=table)
+    Repository.batch_write('111', table=table, updates=[
+        {'repository': connections, 'item': {'connectionId': 'a'}},
+        {'repository': sessions, 'parent_ids': ['Connections', 'a'], 'item': {'invokeId': 'b'}},
+    ])
+    items = Repository.batch_read('111', ddb=ddb, table=table, reads=[
+        {'repository': connections, 'id': 'a'},
+        {'repository': sessions, 'parent_ids': ['Connections', 'a'], 'id': 'b'},
+        {'repository': connections, 'id': 'missing'},
+    ])
+    assert sorted(item.get('connectionId', item.get('invokeId')) for item in items) == ['a', 'b']
+    assert ddb.operations['BatchWriteItem'] == 1
+    assert ddb.operations['BatchGetItem'] == 1
+
+
+def test_transactions_are_atomic(ddb):
+    table = ddb.Table('Pits')
+    connections = DataConnections(table=table)
+    connections.create('111', item={'connectionId': 'a'})
+    with pytest.raises(TransactionConflictException) as e:
+        transact_write('111', ddb=ddb, table=table, updates=[
+            {'repository': connections, 'item': {'connectionId': 'b'}},
+            {
+                'repository': connections,
+                'item': {'connectionId': 'a'},
+                'condition': {'expression': 'attribute_not_exists(PK)'},
+            },
+        ])
+    assert e.value.reasons == ['None', 'ConditionalCheckFailed']
+    assert connections.get('111', item_id='b') is None
+    transact_write('111', ddb=ddb, table=table, updates=[
+        {'repository': connections, 'item': {'connectionId': 'b'}},
+        {'repository': connections, 'update': True, 'item': {'connectionId': 'a', 'authorized': True}},
+    ])
+    assert connections.get('111', item_id='a')['authorized']
+    assert connections.get('111', item_id='b') is not None
+
+
+def test_ttl(ddb, connections):
+    expired = int(time.time()) - 10
+    connections.create('111', item={'connectionId': 'old', 'expiresIn': expired})
+    connections.create('111', item={'connectionId': 'new', 'expiresIn': expired + 60})
+    connections.create('111', item={'connectionId': 'flag', 'expiresIn': False})
+    assert connections.get('111', item_id='old') is None
+    assert [item['connectionId'] for item in connections.items('111').items] == ['flag', 'new']
+    connections.create('111', item={'connectionId': 'old'})
+
+    ddb.Table('Pits').update_time_to_live(TimeToLiveSpecification={'Enabled': False, 'AttributeName': 'expiresIn'})
+    connections.create('111', item={'connectionId': 'kept', 'expiresIn': expired})
+    assert connections.get('111', item_id='kept') is not None
+
+
+def test_tables_are_shared_by_name(ddb):
+    first = ddb.Table('Pits')
+    second = ddb.Table('Pits')
+    first.put_item(Item={'PK': 'a', 'SK': 'b'})
+    assert 'Item' in second.get_item(Key={'PK': 'a', 'SK': 'b'})
+    first.delete()
+    with pytest.raises(ClientError):
+        second.get_item(Key={'PK': 'a', 'SK': 'b'})
+
+
+def test_partition_counters(ddb, connections):
+    connections.create('111', item={'connectionId': 'a'})
+    connections.create('111', item={'connectionId': 'b'})
+    connections.get('111', item_id='a')
+    connections.items('111')
+    connections.delete('111', item_id='b')
+    partition = ('Pits', connections.make_hash_key('111'))
+    assert ddb.partition_writes[partition] == 3
+    assert ddb.partition_reads[partition] == 2
+
+
+def test_consumed_capacity(ddb):
+    table = ddb.Table('Pits')
+    response = table.put_item(Item={'PK': 'a', 'SK': 'b', 'blob': 'x' * 1500}, ReturnConsumedCapacity='TOTAL')
+    assert response['ConsumedCapacity']['WriteCapacityUnits'] == 2
+    assert 'ConsumedCapacity' not in table.get_item(Key={'PK': 'a', 'SK': 'b'})
+    response = table.get_item(Key={'PK': 'a', 'SK': 'b'}, ConsistentRead=True, ReturnConsumedCapacity='TOTAL')
+    assert response['ConsumedCapacity'] == {
+        'TableName': 'Pits',
+        'CapacityUnits': 1.0,
+        'ReadCapacityUnits': 1.0,
+        'WriteCapacityUnits': 0.0,
+    }
+    response = table.query(KeyConditionExpression=Key('PK').eq('a'), ReturnConsumedCapacity='TOTAL')
+    assert response['ConsumedCapacity']['ReadCapacityUnits'] == 0.5
+    assert ddb.consumed[('Pits', 'read')] == 2.0
+    assert ddb.consumed[('Pits', 'write')] == 2.0
+
+
+def test_extend_sessions_in_chunks(ddb):
+    table = ddb.Table('Pits')
+    sessions = DataSessions(table=table)
+    expiresIn = int(time.time()) + 60
+    for index in range(150):
+        sessions.create('111', 'Connections', 'a', item={'invokeId': f'{index}', 'expiresIn': expiresIn})
+    sessions.remove('111', 'Connections', 'a', item_id='7')
+    ddb.operations.clear()
+    extended = sessions.extend(
+        '111', 'Connections', 'a',
+        item_ids=[f'{index}' for index in range(150)],
+        expires_in=4102444800,
+        ddb=ddb)
+
+    assert len(extended) == 149
+    assert '7' not in extended
+    assert ddb.operations['TransactWriteItems'] == 3
+    assert sessions.get('111', 'Connections', 'a', item_id='120')['expiresIn'] == 4102444800
+
+
+def test_device_sessions_are_reference_counted(ddb):
+    devices = DataDeviceSessions(table=ddb.Table('Pits'))
+    args = ['111', 'Cameras', 'PitsCamera1']
+    assert devices.attach(*args, item_id='record', viewer='a', invoke_id='a')['invokeId'] == 'a'
+    device = devices.attach(*args, item_id='record', viewer='b', invoke_id='b')
+    assert device['invokeId'] == 'a'
+    assert device['viewers'] == {'a', 'b'}
+    assert devices.detach(*args, item_id='record', viewer='a') is None
+    devices.attach(*args, item_id='record', viewer='c', invoke_id='c')
+    assert devices.detach(*args, item_id='record', viewer='b') is None
+    assert devices.detach(*args, item_id='record', viewer='c')['invokeId'] == 'a'
+    assert devices.get(*args, item_id='record') is None
+    assert devices.detach(*args, item_id='record', viewer='c') is None
+
+
+def test_device_sessions_keep_the_latest_expiry(ddb):
+    devices = DataDeviceSessions(table=ddb.Table('Pits'))
+    args = ['111', 'Cameras', 'PitsCamera2']
+    now = int(time.time())
+    assert devices.attach(*args, item_id='record', viewer='a', invoke_id='a', expires_in=now + 2000)['expiresIn'] == now + 2000
+    assert devices.attach(*args, item_id='record', viewer='b', invoke_id='b', expires_in=now + 1000)['expiresIn'] == now + 2000
+    assert devices.get(*args, item_id='record')['expiresIn'] == now + 2000
+    assert devices.attach(*args, item_id='record', viewer='c', invoke_id='c', expires_in=now + 3000)['expiresIn'] == now + 3000
+    assert not devices.extend(*args, item_id='record', expires_in=now + 2500)
+    assert devices.extend(*args, item_id='record', expires_in=now + 4000)
+    assert devices.get(*args, item_id='record')['expiresIn'] == now + 4000
+
+
+def test_shared_token_bucket(ddb):
+    buckets = DataBuckets(table=ddb.Table('Pits'))
+    args = ['111', 'Connections', 'a']
+    assert buckets.take(*args, item_id='PitsCamera1:record', capacity=2, rate=0)
+    assert buckets.take(*args, item_id='PitsCamera1:record', capacity=2, rate=0)
+    assert not buckets.take(*args, item_id='PitsCamera1:record', capacity=2, rate=0)
+    assert buckets.take(*args, item_id='PitsCamera2:record', capacity=2, rate=0)
+
+
+def test_claims_resolve_nested_numbers(ddb):
+    claims = {
+        'sub': 'abc',
+        'exp': int(time.time()) + 3600,
+        'auth_time': 1711747711.25,
+        'groups': ['viewers', 1],
+        'address': {'zip': 12345, 'levels': [2, {'floor': 3, 'score': 0.5}]},
+    }
+    stored = DataClaims(table=ddb.Table('Pits'))
+    claims_id = stored.store('111', claims)
+    resolved = DataClaims(table=ddb.Table('Pits')).resolve('111', claims_id)
+    assert resolved == claims
+    assert json.loads(json.dumps(resolved)) == claims
@@ -0,0 +1,92 @@
+import logging
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from pinthesky.util import ContextExecutor, LazyClient, RateLimiter
+from unittest.mock import MagicMock
+
+
+def test_lazy_client_builds_once(caplog):
+    client = MagicMock()
+    client.name = 'Pits'
+    factory = MagicMock(return_value=client)
+    lazy = LazyClient('table', factory)
+
+    factory.assert_not_called()
+    assert not lazy.is_resolved()
+    with caplog.at_level(logging.INFO, logger='pinthesky.util'):
+        assert lazy.name == 'Pits'
+        lazy.get_item(Key={'PK': 'a', 'SK': 'b'})
+        assert lazy.resolve() is client
+
+    factory.assert_called_once()
+    client.get_item.assert_called_once_with(Key={'PK': 'a', 'SK': 'b'})
+    assert lazy.is_resolved()
+    messages = [record.message for record in caplog.records if 'Constructed table' in record.message]
+    assert len(messages) == 1
+
+
+def test_lazy_client_concurrent_resolve():
+    factory = MagicMock(return_value=object())
+    lazy = LazyClient('iot_data', factory)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: lazy.resolve(), range(32)))
+
+    factory.assert_called_once()
+    assert all(client is clients[0] for client in clients)
+
+
+def test_rate_limiter_refills_per_key():
+    now = [0.0]
+    limiter = RateLimiter(capacity=2, rate=0.5, max_keys=2, clock=lambda: now[0])
+
+    assert limiter.admit('a')
+    assert limiter.admit('a')
+    assert not limiter.admit('a')
+    assert limiter.admit('b')
+    now[0] = 2.0
+    assert limiter.admit('a')
+    assert not limiter.admit('a')
+    limiter.admit('c')
+    assert list(limiter.buckets) == ['a', 'c']
+
+
+def test_context_executor_propagates_context():
+    current = ContextVar('current', default=None)
+    executor = ContextExecutor(max_workers=4)
+    barrier = threading.Barrier(3)
+
+    def read(index):
+        barrier.wait(timeout=5)
+        return current.get(), index, threading.current_thread().name
+
+    current.set('frame-1')
+    results = executor.map(read, range(3))
+    assert [(value, index) for value, index, _ in results] == [('frame-1', 0), ('frame-1', 1), ('frame-1', 2)]
+    assert len({name for _, _, name in results}) == 3
+    assert executor.gather() == []
+
+    def nested():
+        assert executor.is_worker()
+        return executor.gather(lambda: threading.current_thread().name)[0] == threading.current_thread().name
+
+    assert executor.gather(lambda: None, nested) == [None, True]
+
+
+def test_context_executor_raises_after_every_call():
+    executor = ContextExecutor(max_workers=4)
+    finished = []
+
+    def fail():
+        raise ValueError('first')
+
+    def slow():
+        threading.Event().wait(0.05)
+        finished.append(True)
+        return 'done'
+
+    with pytest.raises(ValueError, match='first'):
+        executor.gather(fail, slow, slow)
+    assert finished == [True, True]
+    assert ContextExecutor(max_workers=1).gather(lambda: 1, lambda: 2) == [1, 2]